@@ -0,0 +1,59 @@
+"""
+Query parameter and keyset cursor helpers shared by the users and chat APIs.
+
+Each parser raises ValueError on an invalid value; the views turn that into
+a 400 response.
+"""
+from datetime import timezone
+
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.timezone import is_naive
+
+
+def parse_positive_int(request, name, maximum=None):
+    """
+    Return the optional positive integer query parameter `name` (capped at
+    `maximum`), or None when absent. Raises ValueError on invalid values.
+    """
+    value = request.query_params.get(name)
+    if value in (None, ''):
+        return None
+    value = int(value)
+    if value < 1:
+        raise ValueError
+    return min(value, maximum) if maximum else value
+
+
+def parse_date_param(request, name):
+    """Return the optional YYYY-MM-DD query parameter `name`. Raises ValueError on invalid dates."""
+    value = request.query_params.get(name)
+    if value in (None, ''):
+        return None
+    parsed = parse_date(value)
+    if parsed is None:
+        raise ValueError
+    return parsed
+
+
+def parse_progress_cursor(value):
+    """Split a `<session_date>:<id>` progress history cursor. Raises ValueError on invalid cursors."""
+    session_date, _, progress_id = value.partition(':')
+    parsed = parse_date(session_date)
+    if parsed is None:
+        raise ValueError
+    return parsed, int(progress_id)
+
+
+def message_cursor(message):
+    """`<created_at>:<id>` cursor of a message, with a UTC `Z` suffix so it needs no URL escaping"""
+    created_at = message.created_at.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    return f"{created_at}:{message.id}"
+
+
+def parse_message_cursor(value):
+    """Split a `<created_at>:<id>` message cursor. Raises ValueError on invalid cursors."""
+    created_at, _, message_id = value.rpartition(':')
+    parsed = parse_datetime(created_at)
+    if parsed is None or is_naive(parsed):
+        raise ValueError
+    return parsed, int(message_id)
@@ -95,6 +95,27 @@ DATABASES = {
 }
 
 
+# Cache
+# Local memory in development; set REDIS_URL (e.g. redis://127.0.0.1:6379/1) in production
+# so cached data and invalidations are shared by every worker
+
+REDIS_URL = config('REDIS_URL', default='')
+
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -160,6 +181,41 @@ if all(CLOUDINARY_STORAGE.values()):
     DEFAULT_FILE_STORAGE = 'cloudinary_storage.storage.MediaCloudinaryStorage'
     MEDIA_URL = f'https://res.cloudinary.com/{CLOUDINARY_STORAGE["CLOUD_NAME"]}/'
 
+# Maximum concurrent ML service calls for classroom batch handwriting analysis
+HANDWRITING_BATCH_WORKERS = config('HANDWRITING_BATCH_WORKERS', default=4, cast=int)
+
+# Seconds a user's student links stay cached across requests (0 disables the cache).
+# Link changes invalidate the entry; keep it short when the cache is not shared between workers.
+STUDENT_ACCESS_CACHE_TTL = config('STUDENT_ACCESS_CACHE_TTL', default=0, cast=int)
+
+# Seconds computed student aggregates (evaluation summary, Stage 6 tracking,
+# Stage 7 comprehensive data) stay cached; 0 disables the cache
+STUDENT_AGGREGATE_CACHE_TTL = config('STUDENT_AGGREGATE_CACHE_TTL', default=300, cast=int)
+# Count aggregate cache hits and misses for /api/users/cache-stats/ (two cache writes per lookup)
+STUDENT_AGGREGATE_CACHE_STATS = config('STUDENT_AGGREGATE_CACHE_STATS', default=False, cast=bool)
+
+# Seconds the participant ids of a chat room stay cached (0 resolves them on every check).
+# Link changes invalidate the entry, but only in a shared cache (REDIS_URL): with the
+# per-process local memory cache other workers keep a removed user's access until expiry.
+CHAT_PARTICIPANTS_CACHE_TTL = config('CHAT_PARTICIPANTS_CACHE_TTL', default=0, cast=int)
+
+# Chat rooms whose Fernet cipher each worker keeps in memory (least recently used are dropped)
+CHAT_FERNET_CACHE_SIZE = config('CHAT_FERNET_CACHE_SIZE', default=1024, cast=int)
+
+# Milliseconds a worker waits to coalesce websocket chat messages into one bulk insert
+# (0 saves each message on its own), and the most messages per insert
+CHAT_MESSAGE_BATCH_WINDOW_MS = config('CHAT_MESSAGE_BATCH_WINDOW_MS', default=0, cast=int)
+CHAT_MESSAGE_BATCH_SIZE = config('CHAT_MESSAGE_BATCH_SIZE', default=100, cast=int)
+
+# Milliseconds a worker coalesces websocket last-read updates and read receipts
+# into one UPDATE and one event per room (0 writes and broadcasts every mark_read)
+CHAT_READ_RECEIPT_WINDOW_MS = config('CHAT_READ_RECEIPT_WINDOW_MS', default=500, cast=int)
+
+# Milliseconds without a typing frame after which a user stops typing, and the
+# shortest gap between two typing indicator broadcasts to a room
+CHAT_TYPING_TIMEOUT_MS = config('CHAT_TYPING_TIMEOUT_MS', default=5000, cast=int)
+CHAT_TYPING_BROADCAST_INTERVAL_MS = config('CHAT_TYPING_BROADCAST_INTERVAL_MS', default=300, cast=int)
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -196,22 +252,37 @@ SIMPLE_JWT = {
 # Django Channels Configuration
 ASGI_APPLICATION = 'backend.asgi.application'
 
-# Redis configuration for Channels (if you have Redis installed)
-# For development, we'll use in-memory channel layer
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
-    },
-}
-
-# For production with Redis (uncomment when ready):
-# CHANNEL_LAYERS = {
-#     'default': {
-#         'BACKEND': 'channels_redis.core.RedisChannelLayer',
-#         'CONFIG': {
-#             "hosts": [('127.0.0.1', 6379)],
-#         },
-#     },
-# }
+# Channel layer: Redis whenever a Redis URL is configured, so group messages reach
+# sockets held by every Daphne worker. The in-memory layer only works with a single
+# process and stays the default for development.
+CHANNEL_LAYER_REDIS_URL = config('CHANNEL_LAYER_REDIS_URL', default=REDIS_URL)
+
+if CHANNEL_LAYER_REDIS_URL:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'chat.layers.PooledRedisChannelLayer',
+            'CONFIG': {
+                'hosts': [{
+                    'address': CHANNEL_LAYER_REDIS_URL,
+                    # Connections per worker; past this, callers wait up to pool_timeout seconds
+                    'max_connections': config('CHANNEL_LAYER_MAX_CONNECTIONS', default=50, cast=int),
+                    'health_check_interval': 30,
+                }],
+                'pool_timeout': config('CHANNEL_LAYER_POOL_TIMEOUT', default=5, cast=int),
+                # Messages buffered per socket before the oldest are dropped
+                'capacity': config('CHANNEL_LAYER_CAPACITY', default=200, cast=int),
+                # Seconds an undelivered message lives; chat events are stale after a few seconds
+                'expiry': config('CHANNEL_LAYER_EXPIRY', default=10, cast=int),
+                # Seconds a socket stays in a room group without reconnecting
+                'group_expiry': config('CHANNEL_LAYER_GROUP_EXPIRY', default=86400, cast=int),
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
 
 CORS_ALLOW_ALL_ORIGINS = True
@@ -0,0 +1,169 @@
+"""
+Coalescing of chat writes across the sockets of one worker.
+
+With CHAT_MESSAGE_BATCH_WINDOW_MS > 0, ChatConsumer hands each encrypted
+message to the worker's MessageBatcher instead of saving it. The first
+message of a batch starts a timer; when it fires (or the batch reaches
+CHAT_MESSAGE_BATCH_SIZE) every pending message is written with one
+bulk_create in one trip to the database thread, and each sender's await
+resumes with its saved message. A burst of messages from many sockets
+then costs a few round trips instead of one per message, at the price of
+up to one window of extra latency per message. If the bulk insert hits an
+IntegrityError (say a message whose room was deleted meanwhile), the batch
+is saved again one message at a time so only the offending senders fail.
+
+Read state works the same way, always: connect and every mark_read frame
+only note the time in the worker's ReadReceiptBatcher. Once per
+CHAT_READ_RECEIPT_WINDOW_MS the noted participants' last_read_at is moved
+with one UPDATE and each room gets a single messages_read event listing
+everyone who read in that window, so a client that marks read on every
+scroll costs at most one write and one broadcast per window.
+"""
+import asyncio
+import weakref
+from collections import defaultdict
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import IntegrityError
+from django.utils import timezone
+
+from .models import ChatParticipant, save_messages
+
+_batchers = weakref.WeakKeyDictionary()
+_read_batchers = weakref.WeakKeyDictionary()
+
+
+def save_each(messages):
+    """
+    Save `messages` one transaction each, returning for each message the
+    IntegrityError that kept it from being saved, or None
+    """
+    errors = []
+    for message in messages:
+        try:
+            save_messages([message])
+        except IntegrityError as e:
+            errors.append(e)
+        else:
+            errors.append(None)
+    return errors
+
+
+class MessageBatcher:
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max_size
+        self.pending = []
+        self.timer = None
+        # Running writes, referenced until they finish so they cannot be garbage collected
+        self.tasks = set()
+
+    async def save(self, message):
+        """Queue `message` for the next batch and return it once it is saved"""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((message, future))
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.ensure_future(self.write(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def write(self, batch):
+        messages = [message for message, _ in batch]
+        try:
+            await database_sync_to_async(save_messages)(messages)
+            errors = [None] * len(batch)
+        except IntegrityError:
+            errors = await database_sync_to_async(save_each)(messages)
+        except Exception as e:
+            errors = [e] * len(batch)
+        for (message, future), error in zip(batch, errors):
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(message)
+            else:
+                future.set_exception(error)
+
+
+def get_message_batcher():
+    """The running event loop's MessageBatcher, or None when batching is off"""
+    window = settings.CHAT_MESSAGE_BATCH_WINDOW_MS
+    if not window:
+        return None
+    loop = asyncio.get_running_loop()
+    batcher = _batchers.get(loop)
+    if batcher is None:
+        batcher = _batchers[loop] = MessageBatcher(window / 1000, settings.CHAT_MESSAGE_BATCH_SIZE)
+    return batcher
+
+
+class ReadReceiptBatcher:
+    def __init__(self, window):
+        self.window = window
+        self.reads = {}
+        self.receipts = defaultdict(dict)
+        self.timer = None
+        self.tasks = set()
+
+    async def mark_read(self, room_id, group_name, user, notify=True):
+        """
+        Note that `user` has read room `room_id` up to now; with `notify`, also
+        tell the room's group in the next messages_read event
+        """
+        read_at = timezone.now()
+        self.reads[(room_id, user.pk)] = read_at
+        if notify:
+            self.receipts[group_name][user.pk] = {
+                'user_id': user.pk,
+                'username': user.username,
+                'last_read_at': read_at.isoformat()
+            }
+        if not self.window:
+            await self.write(*self.take())
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+
+    def take(self):
+        reads, receipts = self.reads, self.receipts
+        self.reads, self.receipts = {}, defaultdict(dict)
+        return reads, receipts
+
+    def flush(self):
+        self.timer = None
+        task = asyncio.ensure_future(self.write(*self.take()))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def write(self, reads, receipts):
+        try:
+            await database_sync_to_async(ChatParticipant.record_reads)(reads)
+            channel_layer = get_channel_layer()
+            for group_name, room_receipts in receipts.items():
+                await channel_layer.group_send(group_name, {
+                    'type': 'messages_read',
+                    'receipts': list(room_receipts.values())
+                })
+        except Exception as e:
+            print(f"Error updating last read: {e}")
+
+
+def get_read_receipt_batcher():
+    """The running event loop's ReadReceiptBatcher"""
+    loop = asyncio.get_running_loop()
+    batcher = _read_batchers.get(loop)
+    if batcher is None:
+        batcher = _read_batchers[loop] = ReadReceiptBatcher(settings.CHAT_READ_RECEIPT_WINDOW_MS / 1000)
+    return batcher
@@ -2,7 +2,9 @@ import json
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
-from .models import ChatRoom, ChatMessage, ChatParticipant
+from .batching import get_message_batcher, get_read_receipt_batcher
+from .models import ChatRoom, ChatMessage
+from .presence import get_typing_tracker
 from .serializers import ChatMessageSerializer
 
 
@@ -24,6 +26,9 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
         
+        # Loaded once; every message saved on this connection reuses it
+        self.chat_room = await self.get_room(self.room_id)
+        
         # Join room group
         await self.channel_layer.group_add(
             self.room_group_name,
@@ -32,10 +37,13 @@ class ChatConsumer(AsyncWebsocketConsumer):
         
         await self.accept()
         
-        # Update user's last read timestamp
-        await self.update_last_read(user, self.room_id)
+        # Update user's last read timestamp (debounced, no receipt)
+        await self.mark_read(user, notify=False)
     
     async def disconnect(self, close_code):
+        # A closed socket stops typing
+        get_typing_tracker().set_typing(self.room_group_name, self.channel_name, self.scope["user"], False)
+        
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
@@ -70,13 +78,13 @@ class ChatConsumer(AsyncWebsocketConsumer):
         
         # Save message to database
         message = await self.save_message(
-            user, self.room_id, content, message_type, 
+            user, content, message_type, 
             file_url, file_name, file_size
         )
         
         if message:
             # Serialize message for sending
-            message_data = await self.serialize_message(message)
+            message_data = self.serialize_message(message)
             
             # Send message to room group
             await self.channel_layer.group_send(
@@ -89,32 +97,16 @@ class ChatConsumer(AsyncWebsocketConsumer):
     
     async def handle_mark_read(self, data):
         user = self.scope["user"]
-        await self.update_last_read(user, self.room_id)
-        
-        # Notify other participants that messages have been read
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'message_read',
-                'user_id': user.id,
-                'username': user.username
-            }
-        )
+        # Notify other participants that messages have been read, batched
+        # with the room's other receipts of this window
+        await self.mark_read(user)
     
     async def handle_typing(self, data):
         user = self.scope["user"]
-        is_typing = data.get('is_typing', False)
+        is_typing = bool(data.get('is_typing', False))
         
-        # Send typing indicator to room group (excluding sender)
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'typing_indicator',
-                'user_id': user.id,
-                'username': user.username,
-                'is_typing': is_typing
-            }
-        )
+        # Record the room's typing state; only transitions reach the group, rate limited
+        get_typing_tracker().set_typing(self.room_group_name, self.channel_name, user, is_typing)
     
     # Receive message from room group
     async def chat_message(self, event):
@@ -126,40 +118,40 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'message': message
         }))
     
-    async def message_read(self, event):
-        # Send read receipt to WebSocket
+    async def messages_read(self, event):
+        # Send the window's read receipts to WebSocket
         await self.send(text_data=json.dumps({
-            'type': 'message_read',
-            'user_id': event['user_id'],
-            'username': event['username']
+            'type': 'messages_read',
+            'receipts': event['receipts']
         }))
     
-    async def typing_indicator(self, event):
+    async def typing_changes(self, event):
         # Don't send typing indicator to the user who is typing
-        if event['user_id'] != self.scope["user"].id:
-            await self.send(text_data=json.dumps({
-                'type': 'typing_indicator',
-                'username': event['username'],
-                'is_typing': event['is_typing']
-            }))
+        for change in event['changes']:
+            if change['user_id'] != self.scope["user"].id:
+                await self.send(text_data=json.dumps({
+                    'type': 'typing_indicator',
+                    'username': change['username'],
+                    'is_typing': change['is_typing']
+                }))
     
     @database_sync_to_async
     def check_room_permission(self, user, room_id):
         """Check if user has permission to access this chat room"""
-        try:
-            chat_room = ChatRoom.objects.get(id=room_id)
-            participants = chat_room.get_participants()
-            return user in participants
-        except ChatRoom.DoesNotExist:
-            return False
+        return user.pk in ChatRoom.get_participant_ids_for(room_id)
     
     @database_sync_to_async
-    def save_message(self, user, room_id, content, message_type, file_url, file_name, file_size):
-        """Save message to database with encryption"""
+    def get_room(self, room_id):
+        return ChatRoom.objects.only('id', 'encryption_key').get(id=room_id)
+    
+    async def save_message(self, user, content, message_type, file_url, file_name, file_size):
+        """
+        Encrypt and save a message with a single INSERT, coalesced with other
+        sockets' messages into a bulk insert when CHAT_MESSAGE_BATCH_WINDOW_MS is set
+        """
         try:
-            chat_room = ChatRoom.objects.get(id=room_id)
-            message = ChatMessage.objects.create(
-                chat_room=chat_room,
+            message = ChatMessage(
+                chat_room=self.chat_room,
                 sender=user,
                 message_type=message_type,
                 file_url=file_url,
@@ -167,27 +159,21 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 file_size=file_size
             )
             message.set_content(content)
-            message.save()
+            batcher = get_message_batcher()
+            if batcher:
+                await batcher.save(message)
+            else:
+                await database_sync_to_async(message.save)()
             return message
         except Exception as e:
             print(f"Error saving message: {e}")
             return None
     
-    @database_sync_to_async
     def serialize_message(self, message):
-        """Serialize message for JSON response"""
+        """Serialize message for JSON response (no queries: room and sender are already loaded)"""
         serializer = ChatMessageSerializer(message)
         return serializer.data
     
-    @database_sync_to_async
-    def update_last_read(self, user, room_id):
-        """Update user's last read timestamp"""
-        try:
-            chat_room = ChatRoom.objects.get(id=room_id)
-            participant, created = ChatParticipant.objects.get_or_create(
-                chat_room=chat_room,
-                user=user
-            )
-            participant.save()  # This updates last_read_at due to auto_now
-        except Exception as e:
-            print(f"Error updating last read: {e}")
+    async def mark_read(self, user, notify=True):
+        """Update user's last read timestamp, coalesced per CHAT_READ_RECEIPT_WINDOW_MS"""
+        await get_read_receipt_batcher().mark_read(self.chat_room.pk, self.room_group_name, user, notify)
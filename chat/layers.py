@@ -0,0 +1,21 @@
+"""
+Channel layer used when chat runs on more than one worker.
+
+channels_redis opens one connection pool per worker event loop. Its stock
+pool raises "Too many connections" as soon as max_connections is reached,
+which under a burst of group_send calls drops chat messages. This layer
+uses a blocking pool instead: past the limit, callers wait up to
+`pool_timeout` seconds for a connection to be returned.
+"""
+from channels_redis.core import RedisChannelLayer
+from redis.asyncio import BlockingConnectionPool
+
+
+class PooledRedisChannelLayer(RedisChannelLayer):
+    def __init__(self, *args, pool_timeout=5, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool_timeout = pool_timeout
+
+    def create_pool(self, index):
+        host = self.hosts[index].copy()
+        return BlockingConnectionPool.from_url(host.pop('address'), timeout=self.pool_timeout, **host)
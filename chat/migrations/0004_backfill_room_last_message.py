@@ -0,0 +1,55 @@
+import base64
+
+from cryptography.fernet import Fernet
+from django.db import migrations
+
+# Frozen copies of the chat.models helpers as of this migration, so later
+# changes to them cannot alter what it writes
+UNDECRYPTABLE_CONTENT = "[Message could not be decrypted]"
+PREVIEW_LENGTH = 50
+
+
+def preview_text(content):
+    return content[:PREVIEW_LENGTH] + '...' if len(content) > PREVIEW_LENGTH else content
+
+
+def decrypt_content(fernet, encrypted_content):
+    try:
+        return fernet.decrypt(base64.urlsafe_b64decode(encrypted_content.encode())).decode()
+    except Exception:
+        return UNDECRYPTABLE_CONTENT
+
+
+def backfill_last_messages(apps, schema_editor):
+    """Point every room at its latest message, with an encrypted preview"""
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+
+    for room in ChatRoom.objects.iterator(chunk_size=100):
+        latest = ChatMessage.objects.filter(chat_room=room).order_by('-created_at', '-id').first()
+        if latest is None:
+            continue
+        fernet = Fernet(base64.urlsafe_b64decode(room.encryption_key.encode()))
+        content = decrypt_content(fernet, latest.encrypted_content)
+        preview = latest.encrypted_content
+        if len(content) > PREVIEW_LENGTH:
+            preview = base64.urlsafe_b64encode(fernet.encrypt(preview_text(content).encode())).decode()
+
+        room.last_message = latest
+        room.last_message_at = latest.created_at
+        room.last_message_sender_id = latest.sender_id
+        room.last_message_type = latest.message_type
+        room.last_message_preview = preview
+        room.save(update_fields=['last_message', 'last_message_at', 'last_message_sender',
+                                 'last_message_type', 'last_message_preview'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_room_last_message'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_last_messages, migrations.RunPython.noop),
+    ]
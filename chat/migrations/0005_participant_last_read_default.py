@@ -0,0 +1,19 @@
+# Generated by Django 5.2.4 on 2026-10-19 17:48
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_backfill_room_last_message'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatparticipant',
+            name='last_read_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -1,12 +1,138 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, Count, DateTimeField, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
 from django.contrib.auth import get_user_model
-from users.models import Student
+from django.core.cache import cache
+from users.models import Student, StudentUserLink
 from cryptography.fernet import Fernet
 from django.conf import settings
+from collections import OrderedDict, defaultdict
 import base64
+import threading
 
 User = get_user_model()
 
+# room id -> (encryption_key, Fernet), least recently used first
+_room_fernets = OrderedDict()
+_room_fernets_lock = threading.Lock()
+
+
+def _cached_room_fernet(room_id, encryption_key=None):
+    with _room_fernets_lock:
+        cached = _room_fernets.get(room_id)
+        if cached is not None and encryption_key in (None, cached[0]):
+            _room_fernets.move_to_end(room_id)
+            return cached[1]
+    return None
+
+
+def get_room_fernet(room_id, encryption_key=None):
+    """
+    Fernet of a chat room from a process-wide LRU cache bounded by
+    CHAT_FERNET_CACHE_SIZE. Pass the room's encryption_key when the room is
+    loaded; otherwise only the key column is fetched, and only on a miss.
+    """
+    fernet = _cached_room_fernet(room_id, encryption_key)
+    if fernet is not None:
+        return fernet
+
+    if encryption_key is None:
+        encryption_key = ChatRoom.objects.filter(pk=room_id).values_list('encryption_key', flat=True).get()
+    fernet = Fernet(base64.urlsafe_b64decode(encryption_key.encode()))
+
+    with _room_fernets_lock:
+        _room_fernets[room_id] = (encryption_key, fernet)
+        _room_fernets.move_to_end(room_id)
+        while len(_room_fernets) > settings.CHAT_FERNET_CACHE_SIZE:
+            _room_fernets.popitem(last=False)
+    return fernet
+
+
+UNDECRYPTABLE_CONTENT = "[Message could not be decrypted]"
+PREVIEW_LENGTH = 50
+
+
+def preview_text(content):
+    return content[:PREVIEW_LENGTH] + '...' if len(content) > PREVIEW_LENGTH else content
+
+
+def decrypt_content(fernet, encrypted_content):
+    try:
+        return fernet.decrypt(base64.urlsafe_b64decode(encrypted_content.encode())).decode()
+    except Exception:
+        return UNDECRYPTABLE_CONTENT
+
+
+def decrypt_messages(messages):
+    """
+    Decrypt a page of messages in one pass before serialization, storing the
+    plaintext in each message's get_content() memo. Messages are grouped by
+    room so each room's cipher is looked up once, and the keys of rooms that
+    are neither loaded nor cached come from a single query. Returns `messages`.
+    """
+    pending = defaultdict(list)
+    for message in messages:
+        if not message.has_decrypted_content():
+            pending[message.chat_room_id].append(message)
+    if not pending:
+        return messages
+
+    fernets, missing = {}, []
+    for room_id, room_messages in pending.items():
+        if ChatMessage.chat_room.is_cached(room_messages[0]):
+            fernets[room_id] = room_messages[0].chat_room.get_fernet_key()
+        else:
+            fernets[room_id] = _cached_room_fernet(room_id)
+            if fernets[room_id] is None:
+                missing.append(room_id)
+    for room_id, encryption_key in ChatRoom.objects.filter(pk__in=missing).values_list('id', 'encryption_key'):
+        fernets[room_id] = get_room_fernet(room_id, encryption_key)
+
+    for room_id, room_messages in pending.items():
+        fernet = fernets.get(room_id)
+        for message in room_messages:
+            content = decrypt_content(fernet, message.encrypted_content) if fernet else UNDECRYPTABLE_CONTENT
+            message._decrypted = (message.encrypted_content, content)
+    return messages
+
+
+def save_messages(messages):
+    """
+    Insert already encrypted messages with one bulk_create and move each
+    room's last-message pointer once, in one transaction
+    """
+    with transaction.atomic():
+        ChatMessage.objects.bulk_create(messages)
+        latest = {}
+        for message in messages:
+            current = latest.get(message.chat_room_id)
+            if current is None or (message.created_at, message.id) > (current.created_at, current.id):
+                latest[message.chat_room_id] = message
+        for message in latest.values():
+            ChatRoom.record_last_message(message)
+    return messages
+
+
+def participants_cache_key(room_id):
+    return f'chat_participants:{room_id}'
+
+
+def invalidate_chat_participants(student_ids=(), room_ids=()):
+    """
+    Forget the cached participant ids of the given rooms and of the rooms of
+    the given students, once the current transaction commits (so a concurrent
+    check cannot re-cache the pre-commit participants)
+    """
+    if not settings.CHAT_PARTICIPANTS_CACHE_TTL:
+        return
+    room_ids = set(room_ids)
+    if student_ids:
+        room_ids.update(ChatRoom.objects.filter(student_id__in=student_ids).values_list('id', flat=True))
+    keys = [participants_cache_key(room_id) for room_id in room_ids]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
 
 class ChatRoom(models.Model):
     """
@@ -20,6 +146,20 @@ class ChatRoom(models.Model):
     # Encryption key for this chat room (stored encrypted)
     encryption_key = models.TextField()
     
+    # Denormalized latest message for the room list, kept by record_last_message.
+    # The preview is the truncated content, encrypted with the room key.
+    last_message = models.ForeignKey('ChatMessage', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_sender = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_message_type = models.CharField(max_length=10, blank=True)
+    last_message_preview = models.TextField(blank=True)
+    
+    class Meta:
+        indexes = [
+            # Room lists sorted by recent activity, rooms without messages last
+            models.Index(F('last_message_at').desc(nulls_last=True), name='chat_room_activity_idx'),
+        ]
+    
     def save(self, *args, **kwargs):
         if not self.encryption_key:
             # Generate a new encryption key for this chat room
@@ -29,22 +169,87 @@ class ChatRoom(models.Model):
     
     def get_fernet_key(self):
         """Get the Fernet encryption object for this chat room"""
-        key = base64.urlsafe_b64decode(self.encryption_key.encode())
-        return Fernet(key)
+        if self.pk is None:
+            return Fernet(base64.urlsafe_b64decode(self.encryption_key.encode()))
+        return get_room_fernet(self.pk, self.encryption_key)
+    
+    @classmethod
+    def get_participant_ids_for(cls, room_id):
+        """
+        Ids of the users taking part in a room: the student's teacher and every
+        linked doctor and parent. Resolved with one query and cached for
+        CHAT_PARTICIPANTS_CACHE_TTL seconds; chat.signals drops the entry when
+        the student's teacher or links change. Unknown rooms have no participants.
+        """
+        ttl = settings.CHAT_PARTICIPANTS_CACHE_TTL
+        key = participants_cache_key(room_id)
+        participant_ids = cache.get(key) if ttl else None
+        if participant_ids is None:
+            teacher = Student.objects.filter(chat_room__id=room_id).values_list('teacher_id', flat=True)
+            linked = StudentUserLink.objects.filter(student__chat_room__id=room_id).values_list('user_id', flat=True)
+            participant_ids = frozenset(teacher.union(linked, all=True))
+            if ttl:
+                cache.set(key, participant_ids, ttl)
+        return participant_ids
+
+    def get_participant_ids(self):
+        if not hasattr(self, '_participant_ids'):
+            self._participant_ids = ChatRoom.get_participant_ids_for(self.pk)
+        return self._participant_ids
+
+    def has_participant(self, user):
+        return user.pk in self.get_participant_ids()
+    
+    @staticmethod
+    def last_message_fields(message):
+        content = message.get_content()
+        if len(content) > PREVIEW_LENGTH:
+            # A short message is its own preview; only longer ones are encrypted again
+            preview = message.get_fernet().encrypt(preview_text(content).encode())
+            preview = base64.urlsafe_b64encode(preview).decode()
+        else:
+            preview = message.encrypted_content
+        return {
+            'last_message': message,
+            'last_message_at': message.created_at,
+            'last_message_sender_id': message.sender_id,
+            'last_message_type': message.message_type,
+            'last_message_preview': preview,
+        }
+    
+    @classmethod
+    def record_last_message(cls, message):
+        """
+        Point the message's room at it unless the room already points at a
+        newer message, in a single conditional UPDATE (concurrent senders
+        can't move the pointer back)
+        """
+        not_newer = (
+            Q(last_message_at__isnull=True)
+            | Q(last_message_at__lt=message.created_at)
+            | Q(last_message_at=message.created_at, last_message_id__lte=message.id)
+        )
+        cls.objects.filter(not_newer, pk=message.chat_room_id).update(**cls.last_message_fields(message))
     
+    @classmethod
+    def refresh_last_message(cls, room_id):
+        """Re-point a room whose last message was deleted at its latest remaining message"""
+        latest = ChatMessage.objects.filter(chat_room_id=room_id).order_by('-created_at', '-id').first()
+        if latest:
+            fields = cls.last_message_fields(latest)
+        else:
+            fields = dict(last_message=None, last_message_at=None, last_message_sender_id=None,
+                          last_message_type='', last_message_preview='')
+        cls.objects.filter(pk=room_id, last_message__isnull=True).update(**fields)
+    
+    def get_last_message_preview(self):
+        if not self.last_message_preview:
+            return ''
+        return decrypt_content(self.get_fernet_key(), self.last_message_preview)
+
     def get_participants(self):
         """Get all participants in this chat room"""
-        participants = []
-        
-        # Add teacher
-        if self.student.teacher:
-            participants.append(self.student.teacher)
-        
-        # Add doctors and parents through StudentUserLink
-        for link in self.student.student_links.all():
-            participants.append(link.user)
-            
-        return participants
+        return list(User.objects.filter(pk__in=self.get_participant_ids()))
     
     def __str__(self):
         return f"Chat Room - {self.student.name}"
@@ -77,23 +282,45 @@ class ChatMessage(models.Model):
     is_read = models.BooleanField(default=False)
     
     class Meta:
-        ordering = ['created_at']
+        ordering = ['created_at', 'id']
+        indexes = [
+            # Keyset pagination of a room's history on (created_at, id), from either end
+            models.Index(fields=['chat_room', 'created_at', 'id'], name='chat_message_history_idx'),
+        ]
+    
+    def get_fernet(self):
+        # Don't load the whole room just for its key
+        if ChatMessage.chat_room.is_cached(self):
+            return self.chat_room.get_fernet_key()
+        return get_room_fernet(self.chat_room_id)
     
     def set_content(self, content):
         """Encrypt and store the message content"""
-        fernet = self.chat_room.get_fernet_key()
+        fernet = self.get_fernet()
         encrypted_content = fernet.encrypt(content.encode())
         self.encrypted_content = base64.urlsafe_b64encode(encrypted_content).decode()
+        self._decrypted = (self.encrypted_content, content)
+    
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if self.encrypted_content:
+                ChatRoom.record_last_message(self)
+    
+    def has_decrypted_content(self):
+        decrypted = getattr(self, '_decrypted', None)
+        return decrypted is not None and decrypted[0] == self.encrypted_content
     
     def get_content(self):
-        """Decrypt and return the message content"""
+        """Decrypt and return the message content (decrypted once per instance)"""
+        if self.has_decrypted_content():
+            return self._decrypted[1]
         try:
-            fernet = self.chat_room.get_fernet_key()
-            encrypted_data = base64.urlsafe_b64decode(self.encrypted_content.encode())
-            decrypted_content = fernet.decrypt(encrypted_data)
-            return decrypted_content.decode()
-        except Exception:
-            return "[Message could not be decrypted]"
+            content = decrypt_content(self.get_fernet(), self.encrypted_content)
+        except ChatRoom.DoesNotExist:
+            content = UNDECRYPTABLE_CONTENT
+        self._decrypted = (self.encrypted_content, content)
+        return content
     
     def __str__(self):
         return f"{self.sender.username} - {self.message_type} - {self.created_at}"
@@ -106,12 +333,49 @@ class ChatParticipant(models.Model):
     chat_room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='participants')
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     joined_at = models.DateTimeField(auto_now_add=True)
-    last_read_at = models.DateTimeField(auto_now_add=True)
+    last_read_at = models.DateTimeField(default=timezone.now)
     is_active = models.BooleanField(default=True)
     
     class Meta:
         unique_together = ['chat_room', 'user']
     
+    @staticmethod
+    def record_reads(reads):
+        """
+        Move last_read_at forward to `read_at` for every (room_id, user_id) in
+        the `reads` dict with one UPDATE (never backwards), then create the
+        participants that did not exist yet
+        """
+        if not reads:
+            return
+        matches = Q()
+        timestamps = []
+        for (room_id, user_id), read_at in reads.items():
+            matches |= Q(chat_room_id=room_id, user_id=user_id)
+            timestamps.append(When(chat_room_id=room_id, user_id=user_id, then=Value(read_at)))
+        read_at = Case(*timestamps, output_field=DateTimeField())
+        with transaction.atomic():
+            updated = ChatParticipant.objects.filter(matches).update(last_read_at=Greatest(F('last_read_at'), read_at))
+            if updated < len(reads):
+                ChatParticipant.objects.bulk_create([
+                    ChatParticipant(chat_room_id=room_id, user_id=user_id, last_read_at=read_at)
+                    for (room_id, user_id), read_at in reads.items()
+                ], ignore_conflicts=True)
+    
+    @staticmethod
+    def annotate_unread_count(queryset):
+        """
+        Annotate `unread_count` on a ChatParticipant queryset with the rules of
+        get_unread_count, as a correlated subquery of the same query (an index
+        range scan over the messages after last_read_at)
+        """
+        unread = ChatMessage.objects.filter(
+            chat_room=OuterRef('chat_room'),
+            created_at__gt=OuterRef('last_read_at'),
+            is_read=False
+        ).exclude(sender=OuterRef('user')).order_by().values('chat_room').annotate(count=Count('id')).values('count')
+        return queryset.annotate(unread_count=Coalesce(Subquery(unread), 0))
+    
     def get_unread_count(self):
         """Get count of unread messages for this participant"""
         return self.chat_room.messages.filter(
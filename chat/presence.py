@@ -0,0 +1,133 @@
+"""
+Ephemeral typing state of the chat rooms served by one worker.
+
+Clients send a `typing` frame on every keystroke. Rather than forwarding
+each one to the room group, ChatConsumer records it in the worker's
+TypingTracker, which keeps who is typing in each room (in memory only,
+nothing is stored) and when that expires:
+
+- a repeated `is_typing: true` only pushes the expiry back;
+- a socket whose frames stop for CHAT_TYPING_TIMEOUT_MS, or that closes,
+  stops typing; state is kept per socket, so a user is typing while any of
+  their sockets (say another tab) still is;
+- only transitions (started / stopped) are broadcast, as one typing_changes
+  event per room at most every CHAT_TYPING_BROADCAST_INTERVAL_MS, carrying
+  the net changes since the previous event (a user who starts and stops
+  within one interval is never announced).
+
+Each worker tracks its own sockets, so a room spread over several workers
+gets at most one event per interval from each of them.
+"""
+import asyncio
+import weakref
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+_trackers = weakref.WeakKeyDictionary()
+
+
+class TypingTracker:
+    def __init__(self, timeout, interval):
+        self.timeout = timeout
+        self.interval = interval
+        # group name -> {channel name: [user_id, username, expires_at]}
+        self.typing = {}
+        # group name -> {user_id: username} as of the last typing_changes event
+        self.announced = {}
+        self.last_sent = {}
+        self.broadcast_timers = {}
+        self.expiry_timers = {}
+        # Running sends, referenced until they finish so they cannot be garbage collected
+        self.tasks = set()
+
+    def set_typing(self, group_name, channel_name, user, is_typing):
+        if not is_typing:
+            self.stop(group_name, channel_name)
+            return
+        loop = asyncio.get_running_loop()
+        room = self.typing.setdefault(group_name, {})
+        if channel_name in room:
+            room[channel_name][2] = loop.time() + self.timeout
+        else:
+            room[channel_name] = [user.pk, user.username, loop.time() + self.timeout]
+            self.expiry_timers[(group_name, channel_name)] = loop.call_later(self.timeout, self.expire, group_name, channel_name)
+            self.changed(group_name)
+
+    def stop(self, group_name, channel_name):
+        room = self.typing.get(group_name, {})
+        if room.pop(channel_name, None) is None:
+            return
+        timer = self.expiry_timers.pop((group_name, channel_name), None)
+        if timer is not None:
+            timer.cancel()
+        self.changed(group_name)
+
+    def expire(self, group_name, channel_name):
+        loop = asyncio.get_running_loop()
+        self.expiry_timers.pop((group_name, channel_name), None)
+        entry = self.typing.get(group_name, {}).get(channel_name)
+        if entry is None:
+            return
+        if entry[2] > loop.time():
+            # Refreshed since this timer was set
+            self.expiry_timers[(group_name, channel_name)] = loop.call_later(entry[2] - loop.time(), self.expire, group_name, channel_name)
+        else:
+            self.stop(group_name, channel_name)
+
+    def changed(self, group_name):
+        """Schedule the room's next typing_changes event, no sooner than `interval` after the last"""
+        if group_name in self.broadcast_timers:
+            return
+        loop = asyncio.get_running_loop()
+        last_sent = self.last_sent.get(group_name)
+        delay = 0 if last_sent is None else max(0, last_sent + self.interval - loop.time())
+        self.broadcast_timers[group_name] = loop.call_later(delay, self.flush, group_name)
+
+    def flush(self, group_name):
+        loop = asyncio.get_running_loop()
+        del self.broadcast_timers[group_name]
+        typing = {user_id: username for user_id, username, _ in self.typing.get(group_name, {}).values()}
+        announced = self.announced.get(group_name, {})
+        changes = [
+            {'user_id': user_id, 'username': username, 'is_typing': True}
+            for user_id, username in typing.items() if user_id not in announced
+        ] + [
+            {'user_id': user_id, 'username': username, 'is_typing': False}
+            for user_id, username in announced.items() if user_id not in typing
+        ]
+        if typing:
+            self.announced[group_name] = typing
+        else:
+            self.typing.pop(group_name, None)
+            self.announced.pop(group_name, None)
+        if not changes:
+            return
+        sent_at = self.last_sent[group_name] = loop.time()
+        if not typing:
+            loop.call_later(self.interval, self.forget, group_name, sent_at)
+        task = asyncio.ensure_future(self.send(group_name, changes))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def forget(self, group_name, sent_at):
+        """Drop an idle room's rate limit state once it no longer applies"""
+        if self.last_sent.get(group_name) == sent_at and group_name not in self.typing:
+            del self.last_sent[group_name]
+
+    async def send(self, group_name, changes):
+        try:
+            await get_channel_layer().group_send(group_name, {'type': 'typing_changes', 'changes': changes})
+        except Exception as e:
+            print(f"Error sending typing indicator: {e}")
+
+
+def get_typing_tracker():
+    """The running event loop's TypingTracker"""
+    loop = asyncio.get_running_loop()
+    tracker = _trackers.get(loop)
+    if tracker is None:
+        tracker = _trackers[loop] = TypingTracker(
+            settings.CHAT_TYPING_TIMEOUT_MS / 1000, settings.CHAT_TYPING_BROADCAST_INTERVAL_MS / 1000
+        )
+    return tracker
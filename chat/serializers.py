@@ -1,8 +1,21 @@
+from django.db import models
 from rest_framework import serializers
-from .models import ChatRoom, ChatMessage, ChatParticipant
+from .models import ChatRoom, ChatMessage, ChatParticipant, decrypt_messages
 from users.serializers import UserSerializer
 
 
+class ChatMessageListSerializer(serializers.ListSerializer):
+    """
+    Decrypts the whole list in one pass (decrypt_messages) before the messages
+    are serialized.
+    """
+    
+    def to_representation(self, data):
+        messages = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        decrypt_messages(messages)
+        return super().to_representation(messages)
+
+
 class ChatMessageSerializer(serializers.ModelSerializer):
     sender = UserSerializer(read_only=True)
     content = serializers.SerializerMethodField()
@@ -11,9 +24,10 @@ class ChatMessageSerializer(serializers.ModelSerializer):
         model = ChatMessage
         fields = ['id', 'sender', 'message_type', 'content', 'file_url', 
                  'file_name', 'file_size', 'created_at', 'is_read']
+        list_serializer_class = ChatMessageListSerializer
     
     def get_content(self, obj):
-        """Return decrypted content"""
+        """Return decrypted content (already decrypted when serialized as a list)"""
         return obj.get_content()
 
 
@@ -26,6 +40,9 @@ class ChatParticipantSerializer(serializers.ModelSerializer):
         fields = ['id', 'user', 'joined_at', 'last_read_at', 'is_active', 'unread_count']
     
     def get_unread_count(self, obj):
+        # Annotated by ChatParticipant.annotate_unread_count when the room list was prefetched
+        if hasattr(obj, 'unread_count'):
+            return obj.unread_count
         return obj.get_unread_count()
 
 
@@ -40,14 +57,13 @@ class ChatRoomSerializer(serializers.ModelSerializer):
                  'participants', 'recent_message']
     
     def get_recent_message(self, obj):
-        """Get the most recent message in this chat room"""
-        recent_msg = obj.messages.last()
-        if recent_msg:
+        """Get the most recent message in this chat room (from the room's denormalized preview)"""
+        if obj.last_message_at:
             return {
-                'content': recent_msg.get_content()[:50] + '...' if len(recent_msg.get_content()) > 50 else recent_msg.get_content(),
-                'sender': recent_msg.sender.username,
-                'created_at': recent_msg.created_at,
-                'message_type': recent_msg.message_type
+                'content': obj.get_last_message_preview(),
+                'sender': obj.last_message_sender.username if obj.last_message_sender_id else None,
+                'created_at': obj.last_message_at,
+                'message_type': obj.last_message_type
             }
         return None
 
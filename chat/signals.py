@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from users.models import Student, StudentUserLink
+
+from .models import ChatMessage, ChatRoom, invalidate_chat_participants
+
+
+@receiver(pre_save, sender=StudentUserLink)
+def invalidate_previous_link_room(sender, instance, **kwargs):
+    # A link moved to another student also leaves the previous student's room
+    if settings.CHAT_PARTICIPANTS_CACHE_TTL and instance.pk:
+        previous = StudentUserLink.objects.filter(pk=instance.pk).values_list('student_id', flat=True).first()
+        if previous is not None and previous != instance.student_id:
+            invalidate_chat_participants(student_ids=[previous])
+
+
+@receiver(post_save, sender=StudentUserLink)
+@receiver(post_delete, sender=StudentUserLink)
+def invalidate_link_room(sender, instance, **kwargs):
+    invalidate_chat_participants(student_ids=[instance.student_id])
+
+
+@receiver(post_save, sender=Student)
+def invalidate_student_room(sender, instance, created, **kwargs):
+    # The teacher may have changed; a new student has no room yet
+    if not created:
+        invalidate_chat_participants(student_ids=[instance.pk])
+
+
+@receiver(post_save, sender=ChatRoom)
+@receiver(post_delete, sender=ChatRoom)
+def invalidate_room(sender, instance, **kwargs):
+    # An id looked up before the room existed is cached as having no participants
+    invalidate_chat_participants(room_ids=[instance.pk])
+
+
+@receiver(post_delete, sender=ChatMessage)
+def refresh_room_last_message(sender, instance, origin=None, **kwargs):
+    # Messages deleted along with their room or student have no room left to
+    # update; any other origin (a message, its sender's account) moves the pointer
+    if origin is not None and getattr(origin, 'model', type(origin)) in (ChatRoom, Student):
+        return
+    ChatRoom.refresh_last_message(instance.chat_room_id)
@@ -0,0 +1,833 @@
+import asyncio
+import importlib
+import os
+import threading
+import unittest
+from unittest import mock
+from datetime import date, datetime, timedelta, timezone
+
+from asgiref.sync import async_to_sync
+from channels.layers import channel_layers
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from django.urls import re_path
+from cryptography.fernet import Fernet
+from rest_framework_simplejwt.tokens import AccessToken
+
+from users.models import User, Student, StudentUserLink
+
+from .consumers import ChatConsumer
+from .layers import PooledRedisChannelLayer
+from .middleware import JWTAuthMiddleware
+from . import models as chat_models
+from .serializers import ChatMessageSerializer
+from .batching import get_message_batcher, get_read_receipt_batcher
+from .presence import get_typing_tracker
+from .models import ChatMessage, ChatParticipant, ChatRoom, decrypt_messages
+
+try:
+    from fakeredis import TcpFakeServer
+except ImportError:
+    TcpFakeServer = None
+
+
+def create_student(teacher, **kwargs):
+    defaults = {
+        'name': 'Student',
+        'birthday': date(2015, 1, 1),
+        'school': 'School',
+        'grade': '3',
+        'gender': 'other',
+    }
+    defaults.update(kwargs)
+    return Student.objects.create(teacher=teacher, **defaults)
+
+
+def redis_channel_layer(url, **config):
+    return {
+        'BACKEND': 'chat.layers.PooledRedisChannelLayer',
+        'CONFIG': {'hosts': [{'address': url, 'max_connections': 10}], 'expiry': 10, **config},
+    }
+
+
+class RedisChannelLayerTestCase(TransactionTestCase):
+    """
+    Runs against the Redis at TEST_REDIS_URL when set, otherwise against an
+    in-process fakeredis server. Two layer aliases, 'default' and 'worker2',
+    share that Redis the way two Daphne workers do.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        url = os.environ.get('TEST_REDIS_URL')
+        if not url:
+            if TcpFakeServer is None:
+                raise unittest.SkipTest('Set TEST_REDIS_URL or install fakeredis[lua]')
+            server = TcpFakeServer(('127.0.0.1', 0))
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            cls.addClassCleanup(server.server_close)
+            cls.addClassCleanup(server.shutdown)
+            url = f'redis://127.0.0.1:{server.server_address[1]}/0'
+        cls.redis_url = url
+
+        layers = override_settings(CHANNEL_LAYERS={
+            'default': redis_channel_layer(url),
+            'worker2': redis_channel_layer(url),
+        })
+        layers.enable()
+        cls.addClassCleanup(layers.disable)
+        super().setUpClass()
+
+    def tearDown(self):
+        for alias in ('default', 'worker2'):
+            async_to_sync(channel_layers[alias].flush)()
+
+
+class RedisChannelLayerTests(RedisChannelLayerTestCase):
+    async def test_group_send_reaches_channels_of_another_worker(self):
+        first, second = channel_layers['default'], channel_layers['worker2']
+        channel = await first.new_channel()
+        await first.group_add('chat_1', channel)
+
+        await second.group_send('chat_1', {'type': 'chat_message', 'message': 'hello'})
+
+        self.assertEqual(await first.receive(channel), {'type': 'chat_message', 'message': 'hello'})
+
+    async def test_pool_waits_for_a_free_connection(self):
+        layer = PooledRedisChannelLayer(hosts=[{'address': self.redis_url, 'max_connections': 1}])
+        channels = [await layer.new_channel() for _ in range(3)]
+        for channel in channels:
+            await layer.group_add('chat_1', channel)
+
+        # With the stock pool this raises "Too many connections"
+        await asyncio.gather(*[layer.group_send('chat_1', {'type': 'chat_message', 'n': n}) for n in range(20)])
+
+        self.assertEqual((await layer.receive(channels[0]))['type'], 'chat_message')
+        await layer.flush()
+
+
+class ChatConsumerFanOutTests(RedisChannelLayerTestCase):
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', 'teacher@example.com', 'pass', role='teacher')
+        self.parent = User.objects.create_user('parent', 'parent@example.com', 'pass', role='parent')
+        student = create_student(self.teacher)
+        StudentUserLink.objects.create(student=student, user=self.parent, role='parent')
+        self.room = ChatRoom.objects.create(student=student)
+
+    def connect(self, user, channel_layer_alias):
+        application = JWTAuthMiddleware(URLRouter([
+            re_path(r'ws/chat/(?P<room_id>\w+)/$', ChatConsumer.as_asgi(channel_layer_alias=channel_layer_alias)),
+        ]))
+        return WebsocketCommunicator(application, f'/ws/chat/{self.room.id}/?token={AccessToken.for_user(user)}')
+
+    async def test_message_reaches_participant_connected_to_another_worker(self):
+        teacher = self.connect(self.teacher, 'default')
+        parent = self.connect(self.parent, 'worker2')
+        self.assertTrue((await teacher.connect())[0])
+        self.assertTrue((await parent.connect())[0])
+
+        await teacher.send_json_to({'type': 'chat_message', 'content': 'See you tomorrow'})
+
+        received = await parent.receive_json_from(timeout=5)
+        self.assertEqual(received['type'], 'chat_message')
+        self.assertEqual(received['message']['content'], 'See you tomorrow')
+        self.assertEqual((await teacher.receive_json_from(timeout=5))['message']['id'], received['message']['id'])
+
+        await teacher.disconnect()
+        await parent.disconnect()
+
+
+@override_settings(CHAT_PARTICIPANTS_CACHE_TTL=300)
+class ChatParticipantCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.teacher = User.objects.create_user('teacher', 'teacher@example.com', 'pass', role='teacher')
+        self.doctor = User.objects.create_user('doctor', 'doctor@example.com', 'pass', role='doctor')
+        self.parent = User.objects.create_user('parent', 'parent@example.com', 'pass', role='parent')
+        self.student = create_student(self.teacher)
+        StudentUserLink.objects.create(student=self.student, user=self.doctor, role='doctor')
+        self.link = StudentUserLink.objects.create(student=self.student, user=self.parent, role='parent')
+        self.room = ChatRoom.objects.create(student=self.student)
+
+    def participant_ids(self):
+        return ChatRoom.get_participant_ids_for(self.room.id)
+
+    def test_participants_are_resolved_in_one_query_and_cached(self):
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.participant_ids(), {self.teacher.id, self.doctor.id, self.parent.id})
+        self.assertEqual(len(context.captured_queries), 1)
+
+        with CaptureQueriesContext(connection) as context:
+            self.participant_ids()
+        self.assertEqual(len(context.captured_queries), 0)
+
+    def test_link_changes_invalidate_the_room(self):
+        other = User.objects.create_user('parent2', 'parent2@example.com', 'pass', role='parent')
+        self.participant_ids()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            StudentUserLink.objects.create(student=self.student, user=other, role='parent')
+        self.assertIn(other.id, self.participant_ids())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.link.delete()
+        self.assertNotIn(self.parent.id, self.participant_ids())
+
+    def test_link_moved_to_another_student_leaves_the_room(self):
+        other_room = ChatRoom.objects.create(student=create_student(self.teacher, name='Other'))
+        self.participant_ids()
+        ChatRoom.get_participant_ids_for(other_room.id)
+
+        self.link.student = other_room.student
+        with self.captureOnCommitCallbacks(execute=True):
+            self.link.save()
+
+        self.assertNotIn(self.parent.id, self.participant_ids())
+        self.assertIn(self.parent.id, ChatRoom.get_participant_ids_for(other_room.id))
+
+    def test_teacher_change_invalidates_the_room(self):
+        new_teacher = User.objects.create_user('teacher2', 'teacher2@example.com', 'pass', role='teacher')
+        self.participant_ids()
+
+        self.student.teacher = new_teacher
+        with self.captureOnCommitCallbacks(execute=True):
+            self.student.save()
+
+        self.assertEqual(self.participant_ids(), {new_teacher.id, self.doctor.id, self.parent.id})
+
+    def test_room_created_after_lookup_is_not_cached_empty(self):
+        room_id = self.room.id + 1
+        self.assertEqual(ChatRoom.get_participant_ids_for(room_id), set())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            room = ChatRoom.objects.create(student=create_student(self.teacher, name='Other'))
+
+        self.assertEqual(room.id, room_id)
+        self.assertEqual(room.get_participant_ids(), {self.teacher.id})
+
+    def test_removed_link_keeps_access_until_commit(self):
+        self.participant_ids()
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                self.link.delete()
+                # A concurrent check before the commit still sees the parent
+                cache.set(chat_models.participants_cache_key(self.room.id), frozenset({self.parent.id}))
+
+        self.assertNotIn(self.parent.id, self.participant_ids())
+
+    @override_settings(CHAT_PARTICIPANTS_CACHE_TTL=0)
+    def test_link_saves_skip_invalidation_when_caching_is_off(self):
+        with CaptureQueriesContext(connection) as context:
+            self.link.role = 'parent'
+            self.link.save()
+        self.assertEqual(sum(query['sql'].startswith('SELECT') for query in context.captured_queries), 0)
+
+    def test_rest_actions_check_membership_without_participant_queries(self):
+        client = APIClient()
+        client.force_authenticate(self.parent)
+        url = f'/api/chat/rooms/{self.room.id}/mark_read/'
+        client.post(url)
+
+        with CaptureQueriesContext(connection) as context:
+            response = client.post(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(any('UNION' in query['sql'] for query in context.captured_queries))
+
+        outsider = User.objects.create_user('doctor2', 'doctor2@example.com', 'pass', role='doctor')
+        self.assertFalse(self.room.has_participant(outsider))
+
+
+class ChatHistoryTests(TestCase):
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', 'teacher@example.com', 'pass', role='teacher')
+        self.parent = User.objects.create_user('parent', 'parent@example.com', 'pass', role='parent')
+        student = create_student(self.teacher)
+        StudentUserLink.objects.create(student=student, user=self.parent, role='parent')
+        self.room = ChatRoom.objects.create(student=student)
+        self.client = APIClient()
+        self.client.force_authenticate(self.parent)
+        self.url = f'/api/chat/rooms/{self.room.id}/messages/'
+
+    def create_messages(self, count):
+        start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        messages = []
+        for index in range(count):
+            message = ChatMessage(chat_room=self.room, sender=self.teacher if index % 2 else self.parent)
+            message.set_content(f'Message {index}')
+            messages.append(message)
+        messages = ChatMessage.objects.bulk_create(messages)
+        # Pairs of messages share a timestamp, so pages must break ties on id
+        for index, message in enumerate(messages):
+            ChatMessage.objects.filter(pk=message.pk).update(created_at=start + timedelta(seconds=index // 2))
+        return [message.id for message in messages]
+
+    def get(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_default_page_is_the_latest_messages_oldest_first(self):
+        ids = self.create_messages(60)
+
+        data = self.get(limit=25)
+
+        self.assertEqual([message['id'] for message in data['messages']], ids[-25:])
+        self.assertEqual(data['messages'][-1]['content'], 'Message 59')
+        self.assertIsNotNone(data['next_before'])
+        self.assertIsNone(data['next_after'])
+
+    def test_before_cursor_pages_back_to_the_first_message(self):
+        ids = self.create_messages(45)
+
+        pages, data = [], self.get(limit=10)
+        pages.insert(0, [message['id'] for message in data['messages']])
+        while data['next_before']:
+            data = self.get(limit=10, before=data['next_before'])
+            pages.insert(0, [message['id'] for message in data['messages']])
+            self.assertIsNotNone(data['next_after'])
+
+        self.assertEqual(len(pages), 5)
+        self.assertEqual([message_id for page in pages for message_id in page], ids)
+
+    def test_after_cursor_pages_forward_to_the_latest_message(self):
+        ids = self.create_messages(25)
+        oldest = self.get(limit=10, before=self.get(limit=10)['next_before'])
+        oldest = self.get(limit=10, before=oldest['next_before'])
+        collected = [message['id'] for message in oldest['messages']]
+
+        data = oldest
+        while True:
+            data = self.get(limit=10, after=oldest['next_after'] if data is oldest else data['next_after'])
+            collected += [message['id'] for message in data['messages']]
+            self.assertIsNotNone(data['next_before'])
+            if not data['next_after']:
+                break
+
+        self.assertEqual(collected, ids)
+
+    def test_query_count_does_not_grow_with_history_depth(self):
+        self.create_messages(10)
+        self.get(limit=5)  # warm the participant cache
+        with CaptureQueriesContext(connection) as context:
+            self.get(limit=5)
+        shallow = len(context.captured_queries)
+
+        self.create_messages(300)
+        cursor = self.get(limit=200)['next_before']
+        with CaptureQueriesContext(connection) as context:
+            self.get(limit=5, before=cursor)
+        self.assertEqual(len(context.captured_queries), shallow)
+        with CaptureQueriesContext(connection) as context:
+            self.get(limit=50)
+        self.assertEqual(len(context.captured_queries), shallow)
+
+    def test_invalid_parameters(self):
+        self.create_messages(3)
+        cursor = self.get(limit=1)['next_before']
+        for params in ({'limit': 0}, {'before': 'yesterday:1'}, {'after': '2025-01-01T00:00:00:1'},
+                       {'before': cursor, 'after': cursor}):
+            self.assertEqual(self.client.get(self.url, params).status_code, 400, params)
+
+
+class MessageEncryptionTests(TestCase):
+    def setUp(self):
+        chat_models._room_fernets.clear()
+        self.teacher = User.objects.create_user('teacher', 'teacher@example.com', 'pass', role='teacher')
+        self.room = ChatRoom.objects.create(student=create_student(self.teacher))
+
+    def create_message(self, room, content):
+        message = ChatMessage(chat_room=room, sender=self.teacher)
+        message.set_content(content)
+        message.save()
+        return message
+
+    def test_content_is_decrypted_once_per_message(self):
+        message_id = self.create_message(self.room, 'Hello').id
+        message = self.room.messages.get(id=message_id)
+
+        with mock.patch.object(Fernet, 'decrypt', autospec=True, side_effect=Fernet.decrypt) as decrypt:
+            self.assertEqual([message.get_content() for _ in range(3)], ['Hello'] * 3)
+        self.assertEqual(decrypt.call_count, 1)
+
+        message.set_content('Edited')
+        self.assertEqual(message.get_content(), 'Edited')
+
+    def test_messages_loaded_without_their_room_reuse_the_cached_cipher(self):
+        for index in range(5):
+            self.create_message(self.room, f'Message {index}')
+        messages = list(ChatMessage.objects.filter(chat_room_id=self.room.id))
+
+        with self.assertNumQueries(0):
+            self.assertEqual([message.get_content() for message in messages], [f'Message {index}' for index in range(5)])
+
+    @override_settings(CHAT_FERNET_CACHE_SIZE=1)
+    def test_cipher_cache_is_bounded(self):
+        message_id = self.create_message(self.room, 'First room').id
+        self.create_message(ChatRoom.objects.create(student=create_student(self.teacher, name='Other')), 'Second room')
+        message = ChatMessage.objects.get(id=message_id)
+
+        # The second room evicted the first, whose key is fetched again
+        with self.assertNumQueries(1):
+            self.assertEqual(message.get_content(), 'First room')
+
+    def test_undecryptable_content(self):
+        message = self.create_message(self.room, 'Hello')
+        message.encrypted_content = 'garbage'
+
+        self.assertEqual(message.get_content(), '[Message could not be decrypted]')
+
+
+class BatchDecryptionTests(TestCase):
+    def setUp(self):
+        chat_models._room_fernets.clear()
+        self.teacher = User.objects.create_user('teacher', 'teacher@example.com', 'pass', role='teacher')
+        self.rooms = [ChatRoom.objects.create(student=create_student(self.teacher, name=f'Student {index}')) for index in range(3)]
+        for room in self.rooms:
+            for index in range(4):
+                message = ChatMessage(chat_room=room, sender=self.teacher)
+                message.set_content(f'Room {room.id} message {index}')
+                message.save()
+        chat_models._room_fernets.clear()
+
+    def expected(self, messages):
+        return [f'Room {message.chat_room_id} message {index % 4}' for index, message in enumerate(messages)]
+
+    def test_room_keys_are_loaded_in_one_query(self):
+        messages = list(ChatMessage.objects.order_by('chat_room_id', 'id'))
+
+        with self.assertNumQueries(1):
+            decrypt_messages(messages)
+        with self.assertNumQueries(0), mock.patch.object(Fernet, 'decrypt') as decrypt:
+            self.assertEqual([message.get_content() for message in messages], self.expected(messages))
+        decrypt.assert_not_called()
+
+    def test_undecryptable_message_does_not_fail_the_batch(self):
+        messages = list(ChatMessage.objects.order_by('chat_room_id', 'id'))
+        messages[5].encrypted_content = 'garbage'
+
+        decrypt_messages(messages)
+
+        expected = self.expected(messages)
+        expected[5] = '[Message could not be decrypted]'
+        self.assertEqual([message.get_content() for message in messages], expected)
+
+    def test_list_serializer_decrypts_the_page_up_front(self):
+        messages = ChatMessage.objects.filter(chat_room=self.rooms[0]).select_related('sender')
+
+        with mock.patch('chat.serializers.decrypt_messages', wraps=decrypt_messages) as batch:
+            data = ChatMessageSerializer(messages, many=True).data
+
+        batch.assert_called_once()
+        self.assertEqual([item['content'] for item in data], [f'Room {self.rooms[0].id} message {index}' for index in range(4)])
+
+
+class UnreadCountTests(TestCase):
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', 'teacher@example.com', 'pass', role='teacher')
+        self.parent = User.objects.create_user('parent', 'parent@example.com', 'pass', role='parent')
+        self.start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        self.rooms = []
+        for index in range(4):
+            student = create_student(self.teacher, name=f'Student {index}')
+            StudentUserLink.objects.create(student=student, user=self.parent, role='parent')
+            room = ChatRoom.objects.create(student=student)
+            for user, read_minutes in ((self.teacher, index), (self.parent, 2 * index)):
+                participant = ChatParticipant.objects.create(chat_room=room, user=user)
+                ChatParticipant.objects.filter(pk=participant.pk).update(last_read_at=self.start + timedelta(minutes=read_minutes))
+            for minute in range(index * 3):
+                message = ChatMessage.objects.create(chat_room=room, sender=self.teacher if minute % 3 else self.parent,
+                                                     encrypted_content='x', is_read=minute == 4)
+                ChatMessage.objects.filter(pk=message.pk).update(created_at=self.start + timedelta(minutes=minute, seconds=30))
+            self.rooms.append(room)
+
+    def test_annotation_matches_get_unread_count(self):
+        participants = ChatParticipant.annotate_unread_count(ChatParticipant.objects.all())
+
+        counts = {participant.pk: participant.unread_count for participant in participants}
+        expected = {participant.pk: participant.get_unread_count() for participant in ChatParticipant.objects.all()}
+        self.assertEqual(counts, expected)
+        self.assertGreater(sum(counts.values()), 0)
+        self.assertIn(0, counts.values())
+
+    def test_room_list_counts_unread_messages_in_one_query(self):
+        client = APIClient()
+        client.force_authenticate(self.parent)
+
+        with CaptureQueriesContext(connection) as context:
+            response = client.get('/api/chat/rooms/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 4)
+        self.assertEqual(sum('COUNT(' in query['sql'] for query in context.captured_queries), 1)
+        for room in response.data:
+            for participant in room['participants']:
+                self.assertEqual(
+                    participant['unread_count'], ChatParticipant.objects.get(pk=participant['id']).get_unread_count()
+                )
+
+
+class RoomLastMessageTests(TestCase):
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', 'teacher@example.com', 'pass', role='teacher')
+        self.parent = User.objects.create_user('parent', 'parent@example.com', 'pass', role='parent')
+        self.client = APIClient()
+        self.client.force_authenticate(self.parent)
+        self.rooms = [self.create_room(index) for index in range(3)]
+
+    def create_room(self, index):
+        student = create_student(self.teacher, name=f'Student {index}')
+        StudentUserLink.objects.create(student=student, user=self.parent, role='parent')
+        return ChatRoom.objects.create(student=student)
+
+    def send(self, room, content):
+        response = self.client.post(f'/api/chat/rooms/{room.id}/send_message/', {'content': content})
+        self.assertEqual(response.status_code, 201)
+        return ChatMessage.objects.get(id=response.data['id'])
+
+    def list_rooms(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/chat/rooms/')
+        self.assertEqual(response.status_code, 200)
+        return response.data, len(context.captured_queries)
+
+    def test_room_list_shows_previews_sorted_by_activity(self):
+        self.send(self.rooms[1], 'Short note')
+        self.send(self.rooms[0], 'A much longer message that goes on and on about the homework for this week')
+        rooms, queries = self.list_rooms()
+
+        self.assertEqual([room['id'] for room in rooms], [self.rooms[0].id, self.rooms[1].id, self.rooms[2].id])
+        self.assertEqual(rooms[0]['recent_message']['content'], 'A much longer message that goes on and on about th...')
+        self.assertEqual(rooms[0]['recent_message']['sender'], 'parent')
+        self.assertEqual(rooms[1]['recent_message']['content'], 'Short note')
+        self.assertIsNone(rooms[2]['recent_message'])
+
+        # The preview lives on the room: more rooms with messages cost no extra queries
+        for index in range(3, 6):
+            self.send(self.create_room(index), f'Hello {index}')
+        rooms, more_queries = self.list_rooms()
+        self.assertEqual(len(rooms), 6)
+        self.assertEqual(more_queries, queries)
+
+    def test_preview_is_stored_encrypted(self):
+        self.send(self.rooms[0], 'Private details about the student')
+        room = ChatRoom.objects.get(id=self.rooms[0].id)
+
+        self.assertNotIn('Private', room.last_message_preview)
+        self.assertEqual(room.get_last_message_preview(), 'Private details about the student')
+
+    def test_older_message_does_not_move_the_pointer_back(self):
+        first = self.send(self.rooms[0], 'First')
+        second = self.send(self.rooms[0], 'Second')
+
+        ChatRoom.record_last_message(first)
+
+        self.assertEqual(ChatRoom.objects.get(id=self.rooms[0].id).last_message_id, second.id)
+
+    def test_deleting_the_last_message_falls_back_to_the_previous_one(self):
+        first = self.send(self.rooms[0], 'First')
+        second = self.send(self.rooms[0], 'Second')
+
+        second.delete()
+        room = ChatRoom.objects.get(id=self.rooms[0].id)
+        self.assertEqual((room.last_message_id, room.get_last_message_preview()), (first.id, 'First'))
+
+        first.delete()
+        room = ChatRoom.objects.get(id=self.rooms[0].id)
+        self.assertEqual((room.last_message_id, room.last_message_at, room.last_message_preview), (None, None, ''))
+
+    def test_deleting_the_senders_account_falls_back_to_the_previous_message(self):
+        teacher_client = APIClient()
+        teacher_client.force_authenticate(self.teacher)
+        response = teacher_client.post(f'/api/chat/rooms/{self.rooms[0].id}/send_message/', {'content': 'From the teacher'})
+        self.assertEqual(response.status_code, 201)
+        self.send(self.rooms[0], 'parent secret')
+
+        self.parent.delete()
+
+        room = ChatRoom.objects.get(id=self.rooms[0].id)
+        self.assertEqual(room.last_message_id, response.data['id'])
+        self.assertEqual((room.last_message_sender_id, room.get_last_message_preview()), (self.teacher.id, 'From the teacher'))
+        self.assertIsNone(ChatRoom.objects.get(id=self.rooms[1].id).last_message_at)
+
+    def test_backfill_migration(self):
+        from django.apps import apps
+
+        self.send(self.rooms[0], 'First')
+        latest = self.send(self.rooms[0], 'x' * 60)
+        ChatRoom.objects.update(last_message=None, last_message_at=None, last_message_preview='')
+
+        importlib.import_module('chat.migrations.0004_backfill_room_last_message').backfill_last_messages(apps, None)
+
+        room = ChatRoom.objects.get(id=self.rooms[0].id)
+        self.assertEqual((room.last_message_id, room.last_message_at), (latest.id, latest.created_at))
+        self.assertEqual(room.get_last_message_preview(), 'x' * 50 + '...')
+        self.assertIsNone(ChatRoom.objects.get(id=self.rooms[1].id).last_message_at)
+
+
+class ConsumerWritePathTests(TransactionTestCase):
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', 'teacher@example.com', 'pass', role='teacher')
+        self.parent = User.objects.create_user('parent', 'parent@example.com', 'pass', role='parent')
+        student = create_student(self.teacher)
+        StudentUserLink.objects.create(student=student, user=self.parent, role='parent')
+        self.room = ChatRoom.objects.create(student=student)
+
+    def connect(self, user):
+        application = JWTAuthMiddleware(URLRouter([re_path(r'ws/chat/(?P<room_id>\w+)/$', ChatConsumer.as_asgi())]))
+        return WebsocketCommunicator(application, f'/ws/chat/{self.room.id}/?token={AccessToken.for_user(user)}')
+
+    def test_message_is_written_with_a_single_insert(self):
+        async def chat():
+            teacher = self.connect(self.teacher)
+            self.assertTrue((await teacher.connect())[0])
+            for index in range(3):
+                await teacher.send_json_to({'type': 'chat_message', 'content': f'Message {index}'})
+                received.append(await teacher.receive_json_from(timeout=5))
+            await teacher.disconnect()
+
+        received = []
+        with CaptureQueriesContext(connection) as context:
+            async_to_sync(chat)()
+
+        self.assertEqual([item['message']['content'] for item in received], ['Message 0', 'Message 1', 'Message 2'])
+        self.assertEqual(received[0]['message']['sender']['username'], 'teacher')
+        queries = [query['sql'] for query in context.captured_queries]
+        # The room is loaded once per connection; each message is one INSERT plus the room pointer UPDATE
+        self.assertEqual(sum(sql.startswith('SELECT') and 'FROM "chat_chatroom"' in sql for sql in queries), 1)
+        self.assertEqual(sum(sql.startswith('INSERT INTO "chat_chatmessage"') for sql in queries), 3)
+        self.assertEqual(sum(sql.startswith('UPDATE "chat_chatmessage"') for sql in queries), 0)
+        self.assertEqual(sum(sql.startswith('UPDATE "chat_chatroom"') for sql in queries), 3)
+
+    @override_settings(CHAT_MESSAGE_BATCH_WINDOW_MS=50)
+    async def test_messages_from_many_sockets_are_coalesced(self):
+        sockets = [self.connect(user) for user in (self.teacher, self.parent, self.teacher)]
+        for socket in sockets:
+            self.assertTrue((await socket.connect())[0])
+
+        with mock.patch('chat.batching.save_messages', wraps=chat_models.save_messages) as save_messages:
+            for index, socket in enumerate(sockets):
+                await socket.send_json_to({'type': 'chat_message', 'content': f'Message {index}'})
+            received = [await sockets[0].receive_json_from(timeout=5) for _ in sockets]
+        for socket in sockets:
+            await socket.disconnect()
+
+        save_messages.assert_called_once()
+        self.assertEqual(sorted(item['message']['content'] for item in received), ['Message 0', 'Message 1', 'Message 2'])
+        newest = await ChatMessage.objects.order_by('-created_at', '-id').afirst()
+        room = await ChatRoom.objects.aget(pk=self.room.pk)
+        self.assertEqual(room.last_message_id, newest.id)
+
+    @override_settings(CHAT_MESSAGE_BATCH_WINDOW_MS=1000, CHAT_MESSAGE_BATCH_SIZE=2)
+    async def test_full_batch_is_written_without_waiting_for_the_window(self):
+        batcher = get_message_batcher()
+        messages = []
+        for index in range(2):
+            message = ChatMessage(chat_room=self.room, sender=self.teacher)
+            message.set_content(f'Message {index}')
+            messages.append(message)
+
+        saved = await asyncio.wait_for(asyncio.gather(*(batcher.save(message) for message in messages)), timeout=0.5)
+
+        self.assertTrue(all(message.pk for message in saved))
+        self.assertEqual(await ChatMessage.objects.filter(chat_room=self.room).acount(), 2)
+
+    @override_settings(CHAT_MESSAGE_BATCH_WINDOW_MS=1000, CHAT_MESSAGE_BATCH_SIZE=3)
+    async def test_integrity_error_only_fails_the_offending_message(self):
+        batcher = get_message_batcher()
+        messages = []
+        for index, sender_id in enumerate((self.teacher.pk, self.parent.pk + 1000, self.parent.pk)):
+            message = ChatMessage(chat_room=self.room, sender_id=sender_id)
+            message.set_content(f'Message {index}')
+            messages.append(message)
+
+        with mock.patch('chat.batching.save_messages', wraps=chat_models.save_messages) as save_messages:
+            results = await asyncio.wait_for(
+                asyncio.gather(*(batcher.save(message) for message in messages), return_exceptions=True), timeout=5
+            )
+
+        # One bulk insert, then one insert per message
+        self.assertEqual(save_messages.call_count, 4)
+        self.assertIs(results[0], messages[0])
+        self.assertIsInstance(results[1], IntegrityError)
+        self.assertIs(results[2], messages[2])
+        saved = [message async for message in ChatMessage.objects.filter(chat_room=self.room).order_by('id')]
+        self.assertEqual([message.get_content() for message in saved], ['Message 0', 'Message 2'])
+        room = await ChatRoom.objects.aget(pk=self.room.pk)
+        self.assertEqual(room.last_message_id, saved[-1].id)
+        self.assertFalse(batcher.tasks)
+
+
+class ReadReceiptTests(TransactionTestCase):
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', 'teacher@example.com', 'pass', role='teacher')
+        self.parent = User.objects.create_user('parent', 'parent@example.com', 'pass', role='parent')
+        student = create_student(self.teacher)
+        StudentUserLink.objects.create(student=student, user=self.parent, role='parent')
+        self.room = ChatRoom.objects.create(student=student)
+
+    def connect(self, user):
+        application = JWTAuthMiddleware(URLRouter([re_path(r'ws/chat/(?P<room_id>\w+)/$', ChatConsumer.as_asgi())]))
+        return WebsocketCommunicator(application, f'/ws/chat/{self.room.id}/?token={AccessToken.for_user(user)}')
+
+    def test_reads_are_one_update_and_never_move_backwards(self):
+        earlier = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        later = earlier + timedelta(hours=1)
+        ChatParticipant.objects.create(chat_room=self.room, user=self.teacher, last_read_at=later)
+
+        with CaptureQueriesContext(connection) as context:
+            ChatParticipant.record_reads({(self.room.id, self.teacher.id): earlier, (self.room.id, self.parent.id): earlier})
+
+        updates = [query for query in context.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        reads = dict(ChatParticipant.objects.values_list('user_id', 'last_read_at'))
+        self.assertEqual(reads, {self.teacher.id: later, self.parent.id: earlier})
+
+        ChatParticipant.record_reads({(self.room.id, self.parent.id): later})
+        self.assertEqual(ChatParticipant.objects.get(user=self.parent).last_read_at, later)
+
+    def test_rest_mark_read_moves_last_read_at(self):
+        participant = ChatParticipant.objects.create(
+            chat_room=self.room, user=self.parent, last_read_at=datetime(2024, 1, 1, tzinfo=timezone.utc)
+        )
+        client = APIClient()
+        client.force_authenticate(self.parent)
+
+        response = client.post(f'/api/chat/rooms/{self.room.id}/mark_read/')
+
+        self.assertEqual(response.status_code, 200)
+        participant.refresh_from_db()
+        self.assertGreater(participant.last_read_at, datetime(2024, 1, 2, tzinfo=timezone.utc))
+
+    @override_settings(CHAT_READ_RECEIPT_WINDOW_MS=50)
+    async def test_mark_read_frames_are_coalesced_into_one_write_and_one_receipt(self):
+        teacher, parent = self.connect(self.teacher), self.connect(self.parent)
+        self.assertTrue((await teacher.connect())[0])
+        self.assertTrue((await parent.connect())[0])
+        await asyncio.sleep(0.1)
+
+        with mock.patch.object(ChatParticipant, 'record_reads', wraps=ChatParticipant.record_reads) as record_reads:
+            for _ in range(5):
+                await teacher.send_json_to({'type': 'mark_read'})
+            receipt = await parent.receive_json_from(timeout=5)
+            self.assertTrue(await parent.receive_nothing(timeout=0.1))
+        await teacher.disconnect()
+        await parent.disconnect()
+
+        record_reads.assert_called_once()
+        self.assertEqual(receipt['type'], 'messages_read')
+        self.assertEqual([item['user_id'] for item in receipt['receipts']], [self.teacher.id])
+        participants = ChatParticipant.objects.filter(chat_room=self.room)
+        self.assertEqual({participant.user_id async for participant in participants}, {self.teacher.id, self.parent.id})
+
+    @override_settings(CHAT_READ_RECEIPT_WINDOW_MS=0)
+    async def test_zero_window_writes_each_read(self):
+        batcher = get_read_receipt_batcher()
+
+        await batcher.mark_read(self.room.id, f'chat_{self.room.id}', self.parent, notify=False)
+
+        self.assertTrue(await ChatParticipant.objects.filter(chat_room=self.room, user=self.parent).aexists())
+
+
+class TypingIndicatorTests(TransactionTestCase):
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', 'teacher@example.com', 'pass', role='teacher')
+        self.parent = User.objects.create_user('parent', 'parent@example.com', 'pass', role='parent')
+        student = create_student(self.teacher)
+        StudentUserLink.objects.create(student=student, user=self.parent, role='parent')
+        self.room = ChatRoom.objects.create(student=student)
+
+    def connect(self, user):
+        application = JWTAuthMiddleware(URLRouter([re_path(r'ws/chat/(?P<room_id>\w+)/$', ChatConsumer.as_asgi())]))
+        return WebsocketCommunicator(application, f'/ws/chat/{self.room.id}/?token={AccessToken.for_user(user)}')
+
+    async def group_events(self, layer, channel):
+        events = []
+        while True:
+            try:
+                events.append(await asyncio.wait_for(layer.receive(channel), timeout=0.2))
+            except asyncio.TimeoutError:
+                return events
+
+    @override_settings(CHAT_TYPING_BROADCAST_INTERVAL_MS=100)
+    async def test_only_transitions_are_broadcast_at_a_bounded_rate(self):
+        layer = channel_layers['default']
+        channel = await layer.new_channel()
+        await layer.group_add('chat_typing', channel)
+        tracker = get_typing_tracker()
+        users = [await User.objects.acreate(username=f'user{index}', email=f'user{index}@example.com') for index in range(5)]
+
+        # Five users each sending a frame per keystroke
+        for _ in range(20):
+            for user in users:
+                tracker.set_typing('chat_typing', f'socket{user.pk}', user, True)
+            await asyncio.sleep(0.01)
+        started = await self.group_events(layer, channel)
+        for user in users:
+            tracker.set_typing('chat_typing', f'socket{user.pk}', user, False)
+        stopped = await self.group_events(layer, channel)
+
+        self.assertLessEqual(len(started), 3)
+        self.assertEqual(sorted(change['user_id'] for event in started for change in event['changes']), sorted(user.id for user in users))
+        self.assertEqual(len(stopped), 1)
+        self.assertEqual({change['is_typing'] for change in stopped[0]['changes']}, {False})
+        self.assertEqual(tracker.typing, {})
+
+    @override_settings(CHAT_TYPING_BROADCAST_INTERVAL_MS=50)
+    async def test_short_burst_within_an_interval_is_not_announced(self):
+        layer = channel_layers['default']
+        channel = await layer.new_channel()
+        await layer.group_add('chat_typing', channel)
+        tracker = get_typing_tracker()
+        tracker.set_typing('chat_typing', 'socket', self.teacher, True)
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(await self.group_events(layer, channel)), 1)
+
+        tracker.set_typing('chat_typing', 'socket', self.teacher, False)
+        tracker.set_typing('chat_typing', 'socket', self.teacher, True)
+
+        self.assertEqual(await self.group_events(layer, channel), [])
+
+    @override_settings(CHAT_TYPING_TIMEOUT_MS=200, CHAT_TYPING_BROADCAST_INTERVAL_MS=10)
+    async def test_typing_expires_and_stops_on_disconnect(self):
+        teacher, parent = self.connect(self.teacher), self.connect(self.parent)
+        self.assertTrue((await teacher.connect())[0])
+        self.assertTrue((await parent.connect())[0])
+
+        for _ in range(5):
+            await teacher.send_json_to({'type': 'typing', 'is_typing': True})
+        self.assertEqual(await parent.receive_json_from(timeout=1), {'type': 'typing_indicator', 'username': 'teacher', 'is_typing': True})
+        # Frames keep typing alive past the timeout; silence ends it
+        await asyncio.sleep(0.12)
+        await teacher.send_json_to({'type': 'typing', 'is_typing': True})
+        await asyncio.sleep(0.12)
+        self.assertTrue(await parent.receive_nothing(timeout=0.01))
+        self.assertEqual(await parent.receive_json_from(timeout=1), {'type': 'typing_indicator', 'username': 'teacher', 'is_typing': False})
+        # The typing user never hears about themselves
+        self.assertTrue(await teacher.receive_nothing(timeout=0.05))
+
+        await teacher.send_json_to({'type': 'typing', 'is_typing': True})
+        self.assertTrue((await parent.receive_json_from(timeout=1))['is_typing'])
+        await teacher.disconnect()
+        self.assertFalse((await parent.receive_json_from(timeout=1))['is_typing'])
+        await parent.disconnect()
+
+    @override_settings(CHAT_TYPING_TIMEOUT_MS=1000, CHAT_TYPING_BROADCAST_INTERVAL_MS=10)
+    async def test_closing_one_tab_keeps_typing_from_another(self):
+        first_tab, second_tab, parent = self.connect(self.teacher), self.connect(self.teacher), self.connect(self.parent)
+        for socket in (first_tab, second_tab, parent):
+            self.assertTrue((await socket.connect())[0])
+
+        await first_tab.send_json_to({'type': 'typing', 'is_typing': True})
+        self.assertTrue((await parent.receive_json_from(timeout=1))['is_typing'])
+        await second_tab.send_json_to({'type': 'typing', 'is_typing': True})
+        await second_tab.disconnect()
+        self.assertTrue(await parent.receive_nothing(timeout=0.1))
+
+        await first_tab.disconnect()
+        self.assertFalse((await parent.receive_json_from(timeout=1))['is_typing'])
+        await parent.disconnect()
@@ -3,7 +3,8 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from django.shortcuts import get_object_or_404
-from django.db.models import Q
+from django.db.models import F, Prefetch, Q
+from django.utils.timezone import now
 from .models import ChatRoom, ChatMessage, ChatParticipant
 from .serializers import (
     ChatRoomSerializer, 
@@ -12,9 +13,22 @@ from .serializers import (
     CreateMessageSerializer
 )
 from users.models import Student
+from backend.pagination import message_cursor, parse_message_cursor, parse_positive_int
 import cloudinary.uploader
 
 
+def with_room_serializer_data(rooms):
+    """Prefetch what ChatRoomSerializer reads, participants' unread counts included, in a fixed number of queries"""
+    participants = ChatParticipant.annotate_unread_count(ChatParticipant.objects.select_related('user'))
+    return rooms.select_related('student', 'last_message_sender').prefetch_related(
+        Prefetch('participants', queryset=participants)
+    )
+
+
+CHAT_HISTORY_PAGE_SIZE = 50
+CHAT_HISTORY_MAX_PAGE_SIZE = 200
+
+
 class ChatRoomViewSet(viewsets.ModelViewSet):
     """
     ViewSet for managing chat rooms
@@ -42,26 +56,80 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
         else:
             student_ids = []
         
-        return ChatRoom.objects.filter(student__student_id__in=student_ids)
+        # Most recently active rooms first (chat_room_activity_idx)
+        rooms = ChatRoom.objects.filter(student__student_id__in=student_ids).order_by(
+            F('last_message_at').desc(nulls_last=True), '-id'
+        )
+        if self.action in ('list', 'retrieve'):
+            rooms = with_room_serializer_data(rooms)
+        return rooms
     
     @action(detail=True, methods=['get'])
     def messages(self, request, pk=None):
-        """Get all messages for a chat room"""
+        """
+        Get a page of messages for a chat room, oldest first
+
+        Optional query parameters (keyset pagination on (created_at, id)):
+        - limit: page size (default 50, at most 200)
+        - before: the `limit` messages preceding this cursor; without a cursor
+          the latest messages are returned
+        - after: the `limit` messages following this cursor (catching up after a reconnect)
+        The response's `next_before` / `next_after` are the cursors of the
+        adjacent pages, or null when there are no older / newer messages.
+        """
         chat_room = self.get_object()
         
         # Check if user has permission to access this chat room
-        if request.user not in chat_room.get_participants():
+        if not chat_room.has_participant(request.user):
             return Response(
                 {'error': 'You do not have permission to access this chat room'}, 
                 status=status.HTTP_403_FORBIDDEN
             )
         
-        # Get messages with pagination
-        page_size = request.query_params.get('page_size', 50)
-        messages = chat_room.messages.all()[:int(page_size)]
+        before = request.query_params.get('before')
+        after = request.query_params.get('after')
+        try:
+            limit = parse_positive_int(request, 'limit', maximum=CHAT_HISTORY_MAX_PAGE_SIZE) or CHAT_HISTORY_PAGE_SIZE
+            if before and after:
+                raise ValueError
+            cursor = parse_message_cursor(before or after) if before or after else None
+        except ValueError:
+            return Response(
+                {'error': 'Invalid limit, before or after parameter (pass at most one cursor)'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        messages = chat_room.messages.select_related('sender')
+        if after:
+            created_at, message_id = cursor
+            # The redundant created_at bound lets the index seek to the cursor instead of filtering
+            messages = messages.filter(created_at__gte=created_at).filter(
+                Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=message_id)
+            )
+            messages = list(messages.order_by('created_at', 'id')[:limit + 1])
+            has_more = len(messages) > limit
+            messages = messages[:limit]
+            # The cursor message itself is older, so there is always a previous page
+            next_before = message_cursor(messages[0]) if messages else after
+            next_after = message_cursor(messages[-1]) if has_more else None
+        else:
+            if before:
+                created_at, message_id = cursor
+                messages = messages.filter(created_at__lte=created_at).filter(
+                    Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id)
+                )
+            messages = list(messages.order_by('-created_at', '-id')[:limit + 1])
+            has_more = len(messages) > limit
+            messages = messages[:limit][::-1]
+            next_before = message_cursor(messages[0]) if has_more else None
+            next_after = (message_cursor(messages[-1]) if messages else before) if before else None
         
         serializer = ChatMessageSerializer(messages, many=True)
-        return Response(serializer.data)
+        return Response({
+            'messages': serializer.data,
+            'next_before': next_before,
+            'next_after': next_after,
+        })
     
     @action(detail=True, methods=['post'])
     def send_message(self, request, pk=None):
@@ -69,7 +137,7 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
         chat_room = self.get_object()
         
         # Check if user has permission to send messages
-        if request.user not in chat_room.get_participants():
+        if not chat_room.has_participant(request.user):
             return Response(
                 {'error': 'You do not have permission to send messages to this chat room'}, 
                 status=status.HTTP_403_FORBIDDEN
@@ -78,7 +146,7 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
         serializer = CreateMessageSerializer(data=request.data)
         if serializer.is_valid():
             # Create message
-            message = ChatMessage.objects.create(
+            message = ChatMessage(
                 chat_room=chat_room,
                 sender=request.user,
                 message_type=serializer.validated_data.get('message_type', 'text'),
@@ -86,6 +154,7 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
                 file_name=serializer.validated_data.get('file_name', ''),
                 file_size=serializer.validated_data.get('file_size', None)
             )
+            # Encrypted before the INSERT, so the message is written once
             message.set_content(serializer.validated_data['content'])
             message.save()
             
@@ -106,7 +175,7 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
         chat_room = self.get_object()
         
         # Check permissions
-        if request.user not in chat_room.get_participants():
+        if not chat_room.has_participant(request.user):
             return Response(
                 {'error': 'You do not have permission to upload files to this chat room'}, 
                 status=status.HTTP_403_FORBIDDEN
@@ -141,7 +210,7 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
             file_type = 'image' if file_extension in image_extensions else 'file'
             
             # Create message with file
-            message = ChatMessage.objects.create(
+            message = ChatMessage(
                 chat_room=chat_room,
                 sender=request.user,
                 message_type=file_type,
@@ -170,18 +239,14 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
         chat_room = self.get_object()
         
         # Check permissions
-        if request.user not in chat_room.get_participants():
+        if not chat_room.has_participant(request.user):
             return Response(
                 {'error': 'You do not have permission to access this chat room'}, 
                 status=status.HTTP_403_FORBIDDEN
             )
         
-        # Update participant's last read timestamp
-        participant, created = ChatParticipant.objects.get_or_create(
-            chat_room=chat_room,
-            user=request.user
-        )
-        participant.save()  # This updates last_read_at due to auto_now
+        # Update participant's last read timestamp (one UPDATE, or an INSERT on first read)
+        ChatParticipant.record_reads({(chat_room.pk, request.user.pk): now()})
         
         return Response({'status': 'Messages marked as read'}, status=status.HTTP_200_OK)
 
@@ -237,5 +302,5 @@ class StudentChatViewSet(viewsets.ViewSet):
                     user=link.user
                 )
         
-        serializer = ChatRoomSerializer(chat_room)
+        serializer = ChatRoomSerializer(with_room_serializer_data(ChatRoom.objects.filter(pk=chat_room.pk)).get())
         return Response(serializer.data)
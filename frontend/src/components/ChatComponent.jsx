@@ -47,7 +47,7 @@ const ChatComponent = ({ studentId, currentUser }) => {
           { headers: { Authorization: `Bearer ${token}` } }
         );
         
-        setMessages(messagesResponse.data);
+        setMessages(messagesResponse.data.messages);
         
         // Connect to WebSocket
         connectWebSocket(response.data.id, token);
@@ -117,8 +117,8 @@ const ChatComponent = ({ studentId, currentUser }) => {
           [data.username]: data.is_typing
         }));
         break;
-      case 'message_read':
-        // Handle read receipts if needed
+      case 'messages_read':
+        // Handle read receipts if needed (data.receipts: one entry per reader)
         break;
       default:
         console.log('Unknown message type:', data.type);
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Measure chat fan-out latency through the Redis channel layer.
+
+Starts `workers` processes, each holding its share of `sockets` websocket
+channels joined to one room group the way ChatConsumer does, then
+group_sends `messages` chat events from a separate process and records
+when every socket receives each one. Reports per-delivery latency and the
+time until the last socket of the room has a message (fan-out complete).
+
+Uses the Redis at BENCHMARK_REDIS_URL, or an in-process fakeredis server
+when unset (fakeredis is far slower than Redis: compare rows, not absolute
+numbers).
+
+Usage: python scripts/benchmark_channel_fanout.py [sockets] [messages] [workers ...]
+"""
+import asyncio
+import multiprocessing
+import os
+import statistics
+import sys
+import threading
+import time
+
+import benchmark_utils  # noqa: F401  (project path and Django settings)
+
+from chat.layers import PooledRedisChannelLayer
+
+GROUP = 'chat_benchmark'
+SEND_INTERVAL = 0.02
+
+
+def make_layer(url):
+    return PooledRedisChannelLayer(hosts=[{'address': url, 'max_connections': 50}], capacity=200, expiry=10)
+
+
+def worker(url, sockets, messages, ready, results):
+    async def main():
+        layer = make_layer(url)
+        channels = [await layer.new_channel() for _ in range(sockets)]
+        for channel in channels:
+            await layer.group_add(GROUP, channel)
+        ready.release()
+
+        latencies = []
+
+        async def socket(channel):
+            for _ in range(messages):
+                message = await layer.receive(channel)
+                latencies.append((message['n'], time.monotonic() - message['sent']))
+
+        await asyncio.wait_for(asyncio.gather(*(socket(channel) for channel in channels)), timeout=120)
+        results.put(latencies)
+
+    asyncio.run(main())
+
+
+def run_case(url, sockets, messages, workers):
+    ready, results = multiprocessing.Semaphore(0), multiprocessing.Queue()
+    shares = [sockets // workers + (index < sockets % workers) for index in range(workers)]
+    processes = [
+        multiprocessing.Process(target=worker, args=(url, share, messages, ready, results)) for share in shares
+    ]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        ready.acquire()
+
+    async def send():
+        layer = make_layer(url)
+        for n in range(messages):
+            await layer.group_send(GROUP, {'type': 'chat_message', 'n': n, 'sent': time.monotonic()})
+            await asyncio.sleep(SEND_INTERVAL)
+
+    asyncio.run(send())
+    deliveries = [latency for _ in processes for latency in results.get(timeout=180)]
+    for process in processes:
+        process.join()
+    # Start the next case with an empty group
+    asyncio.run(make_layer(url).flush())
+
+    per_message = {}
+    for n, latency in deliveries:
+        per_message[n] = max(latency, per_message.get(n, 0))
+    delivery_ms = sorted(latency * 1000 for _, latency in deliveries)
+    complete_ms = sorted(latency * 1000 for latency in per_message.values())
+    return delivery_ms, complete_ms
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def start_fake_redis():
+    from fakeredis import TcpFakeServer
+
+    server = TcpFakeServer(('127.0.0.1', 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'redis://127.0.0.1:{server.server_address[1]}/0'
+
+
+if __name__ == '__main__':
+    sockets = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    worker_counts = [int(value) for value in sys.argv[3:]] or [1, 2, 4]
+    url = os.environ.get('BENCHMARK_REDIS_URL') or start_fake_redis()
+
+    print(f"\nChat fan-out over {url} ({sockets} sockets, {messages} messages every {SEND_INTERVAL * 1000:.0f} ms)")
+    print(f"{'workers':>8} {'delivery p50':>13} {'p95':>8} {'p99':>8} {'fan-out p50':>12} {'p95':>8}   (ms)")
+    for workers in worker_counts:
+        delivery, complete = run_case(url, sockets, messages, workers)
+        assert len(delivery) == sockets * messages, 'messages were dropped'
+        print(f"{workers:>8} {statistics.median(delivery):>13.2f} {percentile(delivery, 0.95):>8.2f} "
+              f"{percentile(delivery, 0.99):>8.2f} {statistics.median(complete):>12.2f} {percentile(complete, 0.95):>8.2f}")
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Benchmark decrypting a chat room's history.
+
+Seeds a room with `messages` messages (default 1,000) and decrypts them the
+way the previous ChatMessage.get_content did (a new Fernet built from the
+room's key per call, the room fetched lazily when the message was loaded
+without it) and with the per-room Fernet cache and per-message memo, reading
+each message once (a history page) and three times (the previous room
+list preview). Then compares serializing the history one message at a
+time with the batch decrypt of ChatMessageSerializer(many=True), and an
+export spanning many rooms decrypted per message and in one batch.
+
+Usage: python scripts/benchmark_chat_decryption.py [messages]
+"""
+import base64
+import sys
+
+from benchmark_utils import benchmark_database, create_benchmark_users, measure, print_results, seed_student_history
+
+from cryptography.fernet import Fernet
+from rest_framework.serializers import ListSerializer
+
+# One read per message (history page) and three (the previous room list preview)
+READS_PER_MESSAGE = (1, 3)
+EXPORT_ROOMS = 50
+
+
+def legacy_get_content(message):
+    """The previous ChatMessage.get_content"""
+    fernet = Fernet(base64.urlsafe_b64decode(message.chat_room.encryption_key.encode()))
+    return fernet.decrypt(base64.urlsafe_b64decode(message.encrypted_content.encode())).decode()
+
+
+def run(count):
+    from chat import models as chat_models
+    from chat.models import ChatMessage, ChatRoom, decrypt_messages
+    from chat.serializers import ChatMessageSerializer
+
+    teacher, doctor = create_benchmark_users()
+    room = ChatRoom.objects.create(student=seed_student_history(teacher, doctor, activities=1, sessions=1))
+    messages = []
+    for index in range(count):
+        message = ChatMessage(chat_room=room, sender=teacher if index % 2 else doctor)
+        message.set_content(f'Message {index}: the reading homework went well today, see you on Thursday.')
+        messages.append(message)
+    ChatMessage.objects.bulk_create(messages)
+
+    results = []
+    for reads in READS_PER_MESSAGE:
+        for label, page in (
+            ('loaded with room', lambda: list(room.messages.all())),
+            ('loaded without room', lambda: list(ChatMessage.objects.filter(chat_room_id=room.pk))),
+        ):
+            history = page()
+            with measure(f'previous: {label}, {reads} read(s)', results):
+                for message in history:
+                    for _ in range(reads):
+                        legacy_get_content(message)
+
+            history = page()
+            chat_models._room_fernets.clear()
+            with measure(f'cached: {label}, {reads} read(s)', results):
+                for message in history:
+                    for _ in range(reads):
+                        message.get_content()
+
+    # Serialization, cold cipher cache: the previous plain ListSerializer vs decrypt_messages first
+    history = list(room.messages.select_related('sender'))
+    chat_models._room_fernets.clear()
+    with measure('serializer page, decrypt per method field', results):
+        ListSerializer(history, child=ChatMessageSerializer()).data
+
+    history = list(room.messages.select_related('sender'))
+    chat_models._room_fernets.clear()
+    with measure('serializer page, many=True (batch decrypt)', results):
+        ChatMessageSerializer(history, many=True).data
+
+    # An export spanning many rooms, messages loaded without their rooms
+    for index in range(1, EXPORT_ROOMS):
+        other = ChatRoom.objects.create(student=seed_student_history(teacher, doctor, name=f'Student {index}', activities=1, sessions=1))
+        other_messages = []
+        for number in range(count // EXPORT_ROOMS):
+            message = ChatMessage(chat_room=other, sender=teacher)
+            message.set_content(f'Message {number} in room {index}.')
+            other_messages.append(message)
+        ChatMessage.objects.bulk_create(other_messages)
+
+    export = list(ChatMessage.objects.order_by('id'))
+    chat_models._room_fernets.clear()
+    with measure(f'export ({EXPORT_ROOMS} rooms), get_content', results):
+        [message.get_content() for message in export]
+
+    export = list(ChatMessage.objects.order_by('id'))
+    chat_models._room_fernets.clear()
+    with measure(f'export ({EXPORT_ROOMS} rooms), decrypt_messages', results):
+        decrypt_messages(export)
+
+    print_results(f'Decrypting a {count}-message history', results)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    with benchmark_database():
+        run(count)
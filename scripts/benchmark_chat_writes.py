@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Benchmark the chat write path under many concurrent sockets.
+
+Opens `sockets` websocket connections (each in its own room, authenticated
+with a JWT through JWTAuthMiddleware like production) and has every socket
+send `messages` chat messages, waiting for each broadcast before sending the
+next. Reports messages per second and the statements sent to the database
+(BEGIN and COMMIT included, socket setup too), with each message saved on
+its own and with CHAT_MESSAGE_BATCH_WINDOW_MS coalescing inserts.
+
+The sockets are driven in-process through the ASGI application (channels'
+WebsocketCommunicator), so the numbers leave out network and protocol
+overhead: compare rows, not absolute numbers.
+
+Usage: python scripts/benchmark_chat_writes.py [sockets] [messages] [window_ms ...]
+"""
+import asyncio
+import sys
+import time
+from datetime import date
+
+from benchmark_utils import benchmark_database, create_benchmark_users, measure
+
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.test import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+
+def run(sockets, messages, windows):
+    from chat.middleware import JWTAuthMiddleware
+    from chat.models import ChatMessage, ChatRoom
+    from chat.routing import websocket_urlpatterns
+    from users.models import Student
+
+    application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+    teacher, _ = create_benchmark_users()
+    token = str(AccessToken.for_user(teacher))
+    rooms = [
+        ChatRoom.objects.create(student=Student.objects.create(
+            name=f'Student {index}', birthday=date(2015, 1, 1), school='Benchmark School',
+            grade='3', gender='other', teacher=teacher
+        ))
+        for index in range(sockets)
+    ]
+
+    async def chat():
+        communicators = [
+            WebsocketCommunicator(application, f'/ws/chat/{room.pk}/?token={token}') for room in rooms
+        ]
+        for communicator in communicators:
+            connected, _ = await communicator.connect()
+            assert connected, 'socket was refused'
+
+        async def socket(communicator):
+            for n in range(messages):
+                await communicator.send_json_to({'type': 'chat_message', 'content': f'Message {n}: see you on Thursday.'})
+                await communicator.receive_json_from(timeout=30)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(socket(communicator) for communicator in communicators))
+        elapsed = time.perf_counter() - start
+        for communicator in communicators:
+            await communicator.disconnect()
+        return elapsed
+
+    total = sockets * messages
+    print(f"\nChat writes: {sockets} sockets x {messages} messages")
+    print(f"{'case':<28} {'msg/s':>10} {'queries':>8} {'per msg':>8}")
+    for window in windows:
+        ChatMessage.objects.all().delete()
+        results = []
+        with override_settings(CHAT_MESSAGE_BATCH_WINDOW_MS=window), measure('', results):
+            elapsed = async_to_sync(chat)()
+        assert ChatMessage.objects.count() == total, 'messages were lost'
+        queries = results[0][2]
+        label = f'batched, {window} ms window' if window else 'one INSERT per message'
+        print(f"{label:<28} {total / elapsed:>10.0f} {queries:>8} {queries / total:>8.2f}")
+
+
+if __name__ == '__main__':
+    sockets = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    windows = [int(value) for value in sys.argv[3:]] or [0, 5, 20]
+    with benchmark_database():
+        run(sockets, messages, windows)
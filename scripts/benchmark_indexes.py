@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""
+EXPLAIN ANALYZE the hot lookups of users.models with and without candidate
+composite / partial indexes.
+
+Seeds a throwaway database with `students` students (default 100,000)
+spread over 200 teachers, each student with a parent and a doctor link,
+two activity assignments with progress and one therapy report. Each query
+is explained against the migrated schema and again, inside a rolled-back
+savepoint, with its index toggled: declared indexes are dropped, rejected
+candidates are created. Only candidates that change the plan for the
+better are declared in Meta.indexes.
+
+Usage: python scripts/benchmark_indexes.py [students]
+"""
+import re
+import statistics
+import sys
+
+from benchmark_utils import benchmark_database
+
+from django.db import connection, transaction
+
+TEACHERS = 200
+CLASSROOMS_PER_TEACHER = 10
+DOCTORS = 100
+PARENTS = 2000
+SESSIONS_PER_ASSIGNMENT = 5
+LONG_HISTORY_SESSIONS = 3000
+REPEAT = 21
+
+
+def execute(sql, params=()):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+def create_users(role, count):
+    from users.models import User
+
+    users = User.objects.bulk_create([
+        User(username=f'{role}{index}', email=f'{role}{index}@example.com', role=role) for index in range(count)
+    ])
+    return [user.id for user in users]
+
+
+def seed(students):
+    from users.models import Classroom
+
+    teachers = create_users('teacher', TEACHERS)
+    doctors = create_users('doctor', DOCTORS)
+    parents = create_users('parent', PARENTS)
+    classrooms = [
+        classroom.id for classroom in Classroom.objects.bulk_create([
+            Classroom(name=f'Class {index}', teacher_id=teacher)
+            for teacher in teachers for index in range(CLASSROOMS_PER_TEACHER)
+        ])
+    ]
+
+    # Student i belongs to teacher i % TEACHERS; one in five is not in a classroom yet
+    execute("""
+        INSERT INTO users_student (name, birthday, school, grade, gender, teacher_id, classroom_id)
+        SELECT 'Student ' || i, DATE '2015-01-01', 'School', '3', 'other',
+               (%(teachers)s::bigint[])[1 + i %% %(t)s],
+               CASE WHEN (i / %(t)s) %% 5 = 0 THEN NULL
+                    ELSE (%(classrooms)s::bigint[])[1 + (i %% %(t)s) * %(c)s + (i / %(t)s) %% %(c)s] END
+        FROM generate_series(0, %(n)s - 1) AS i
+    """, {'teachers': teachers, 'classrooms': classrooms, 't': TEACHERS, 'c': CLASSROOMS_PER_TEACHER, 'n': students})
+
+    execute("""
+        INSERT INTO users_studentuserlink (student_id, user_id, role)
+        SELECT student_id, (%(doctors)s::bigint[])[1 + student_id %% %(d)s], 'doctor' FROM users_student
+        UNION ALL
+        SELECT student_id, (%(parents)s::bigint[])[1 + student_id %% %(p)s], 'parent' FROM users_student
+    """, {'doctors': doctors, 'parents': parents, 'd': DOCTORS, 'p': PARENTS})
+
+    execute("""
+        INSERT INTO users_activityassignment (student_id, doctor_id, activity_name, activity_type, description,
+            instructions, difficulty, frequency, duration_minutes, target_audience, expected_outcomes,
+            success_criteria, is_active, created_at, updated_at)
+        SELECT s.student_id, (%(doctors)s::bigint[])[1 + s.student_id %% %(d)s], 'Activity ' || a, 'reading',
+               'Read aloud', 'Read one page', 'medium', 'daily', 15, 'both', 'Fluency', '', TRUE, now(), now()
+        FROM users_student s CROSS JOIN generate_series(1, 2) AS a
+    """, {'doctors': doctors, 'd': DOCTORS})
+
+    execute("""
+        INSERT INTO users_activityprogress (activity_assignment_id, recorder_id, session_date, status, performer,
+            completion_percentage, notes, challenges, improvements, student_engagement, difficulty_level,
+            created_at, updated_at)
+        SELECT a.id, s.teacher_id, DATE '2024-01-01' + day, 'completed', 'teacher', 100, '', '', '', 7, 5, now(), now()
+        FROM users_activityassignment a JOIN users_student s ON s.student_id = a.student_id
+        CROSS JOIN generate_series(0, %(sessions)s - 1) AS day
+    """, {'sessions': SESSIONS_PER_ASSIGNMENT})
+
+    # One daily activity that has been running for years, recorded by teacher and parent
+    execute("""
+        INSERT INTO users_activityprogress (activity_assignment_id, recorder_id, session_date, status, performer,
+            completion_percentage, notes, challenges, improvements, student_engagement, difficulty_level,
+            created_at, updated_at)
+        SELECT (SELECT MIN(id) FROM users_activityassignment), (%(teachers)s::bigint[])[1],
+               DATE '2010-01-01' + day, 'completed', performer, 100, '', '', '', 7, 5, now(), now()
+        FROM generate_series(0, %(sessions)s - 1) AS day CROSS JOIN (VALUES ('teacher'), ('parent')) AS p(performer)
+    """, {'teachers': teachers, 'sessions': LONG_HISTORY_SESSIONS})
+
+    execute("""
+        INSERT INTO users_therapysessionreport (student_id, session_number, activity_assignments_data,
+            activity_progress_data, final_evaluation_data, session_start_date, session_end_date,
+            session_outcome, created_at)
+        SELECT student_id, 1, '[]', '[]', '{}', now(), now(), 'completed', now() FROM users_student
+    """)
+    execute('ANALYZE')
+    return teachers, doctors, parents
+
+
+def explain(queryset):
+    """
+    Median execution time (ms), shared buffers touched and the first scan
+    node of EXPLAIN (ANALYZE, BUFFERS). Buffers are stable across runs,
+    sub-millisecond timings are not.
+    """
+    times, plan = [], ''
+    for _ in range(REPEAT):
+        plan = queryset.explain(analyze=True, buffers=True)
+        times.append(float(re.search(r'Execution Time: ([\d.]+) ms', plan).group(1)))
+    buffers = re.search(r'Buffers: shared(?: hit=(\d+))?(?: read=(\d+))?', plan)
+    pages = sum(int(value) for value in buffers.groups() if value) if buffers else 0
+    node = re.search(r'((?:Index Only Scan|Index Scan|Bitmap Index Scan|Seq Scan)(?: Backward)?(?: (?:using|on) \w+)?)', plan)
+    return statistics.median(times), pages, node.group(1) if node else plan.splitlines()[0]
+
+
+def explain_toggled(ddl, queryset):
+    """Explain `queryset` after running `ddl`, then roll the schema change back"""
+    with transaction.atomic():
+        sid = transaction.savepoint()
+        execute(ddl)
+        result = explain(queryset)
+        transaction.savepoint_rollback(sid)
+    return result
+
+
+def run(students):
+    from users.models import ActivityAssignment, ActivityProgress, Student, StudentUserLink, TherapySessionReport
+
+    teachers, doctors, parents = seed(students)
+    student = Student.objects.order_by('student_id')[students // 2]
+    teacher = student.teacher_id
+    classroom = Student.objects.filter(teacher_id=teacher, classroom__isnull=False).values_list('classroom_id', flat=True)[0]
+    doctor = StudentUserLink.objects.get(student=student, role='doctor').user_id
+    parent = StudentUserLink.objects.get(student=student, role='parent').user_id
+    long_history = ActivityAssignment.objects.order_by('id').values_list('id', flat=True)[0]
+    page = ActivityProgress.objects.filter(activity_assignment_id=long_history).order_by('-session_date', '-id')
+
+    # (declared index or None, candidate DDL or None, label, query)
+    cases = [
+        (None, 'CREATE INDEX link_candidate ON users_studentuserlink (student_id, user_id, role)',
+         'parent link check', StudentUserLink.objects.filter(student=student, user_id=parent).values('id')),
+        (None, 'CREATE INDEX link_candidate ON users_studentuserlink (student_id, user_id, role)',
+         'doctor link check (role)',
+         StudentUserLink.objects.filter(student=student, user_id=doctor, role='doctor').values('id')),
+        (None, 'CREATE INDEX assignment_candidate ON users_activityassignment (student_id, doctor_id)',
+         'doctor assigned activities', ActivityAssignment.objects.filter(student=student, doctor_id=doctor).values('id')),
+        (None, 'CREATE INDEX student_candidate ON users_student (teacher_id, classroom_id)',
+         'teacher classroom students', Student.objects.filter(teacher_id=teacher, classroom_id=classroom)),
+        ('student_unassigned_idx', None, 'teacher unassigned students', Student.objects.filter(teacher_id=teacher, classroom__isnull=True)),
+        ('progress_history_idx', None, 'history first page (50)', page[:50]),
+        ('progress_history_idx', None, 'history keyset page (50)', page.filter(session_date__lt='2014-01-01')[:50]),
+        (None, None, 'therapy report listing',
+         TherapySessionReport.objects.filter(student=student).order_by('-session_number')[:10]),
+    ]
+
+    print(f"\nIndex review on {students} students "
+          f"({ActivityProgress.objects.count()} progress rows, {StudentUserLink.objects.count()} links)")
+    print(f"{'query':<28} {'ms without':>10} {'ms with':>8} {'buffers':>13}  plan without / with index")
+    for declared, candidate, label, queryset in cases:
+        current = explain(queryset)
+        if declared:
+            without, with_index = explain_toggled(f'DROP INDEX {declared}', queryset), current
+        elif candidate:
+            without, with_index = current, explain_toggled(candidate, queryset)
+        else:
+            print(f"{label:<28} {current[0]:>10.3f} {'-':>8} {current[1]:>13}  {current[2]} (existing index)")
+            continue
+        buffers = f"{without[1]} -> {with_index[1]}"
+        print(f"{label:<28} {without[0]:>10.3f} {with_index[0]:>8.3f} {buffers:>13}  {without[2]} / {with_index[2]}")
+
+
+if __name__ == '__main__':
+    students = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with benchmark_database():
+        run(students)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+Benchmark compact therapy session snapshot storage.
+
+Seeds a student whose therapy is restarted several times with the same
+activity plan, then compares the compact storage (envelopes, with long
+texts in shared compressed blobs) with inline JSON snapshots on size and
+read latency.
+
+Usage: python scripts/benchmark_snapshot_storage.py [sessions] [progress_per_activity]
+"""
+import json
+import random
+import sys
+import time
+
+from benchmark_utils import benchmark_database, create_benchmark_users, seed_student_history
+
+from django.db import connection
+
+
+WORDS = ('read', 'aloud', 'story', 'retell', 'letters', 'sounds', 'phonics', 'rhyme', 'syllable', 'pause',
+         'practice', 'parent', 'teacher', 'page', 'slowly', 'point', 'word', 'picture', 'spell', 'trace')
+
+
+def prose(rng, words=90):
+    """Non-repetitive free text, like the instructions doctors write"""
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+
+def column_bytes(sql, params=()):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchone()[0] or 0
+
+
+def run(sessions, progress_per_activity):
+    from users.models import ActivityAssignment, ActivityProgress, SnapshotBlob, TherapySessionReport
+    from users.snapshots import text_ids, unpack
+
+    teacher, doctor = create_benchmark_users()
+    student = seed_student_history(teacher, doctor, activities=10, sessions=progress_per_activity)
+    rng = random.Random(0)
+    plan = [
+        dict(activity_name=f'Activity {index}', activity_type='reading', description=prose(rng, 30),
+             instructions=prose(rng), frequency='daily', duration_minutes=15, target_audience='both',
+             expected_outcomes=prose(rng))
+        for index in range(10)
+    ]
+    student.clear_activity_plan()
+    ActivityAssignment.objects.bulk_create([ActivityAssignment(student=student, doctor=doctor, **activity) for activity in plan])
+
+    for _ in range(sessions):
+        TherapySessionReport.create_report_from_current_data(student)
+        student.clear_activity_plan()
+
+        # Re-assign the same plan, as doctors usually do when continuing therapy
+        assignments = ActivityAssignment.objects.bulk_create([
+            ActivityAssignment(student=student, doctor=doctor, **activity) for activity in plan
+        ])
+        ActivityProgress.objects.bulk_create([
+            ActivityProgress(
+                activity_assignment=assignment, recorder=teacher, performer='teacher',
+                session_date=f'2021-01-{day % 28 + 1:02d}', status='completed', score=day % 10,
+                notes=f'Session {day}: completed the reading with minor hesitation.'
+            )
+            for assignment in assignments
+            for day in range(min(progress_per_activity, 28))
+        ])
+
+    reports = list(TherapySessionReport.objects.filter(student=student))
+    snapshots = TherapySessionReport.expand_snapshots(reports)
+
+    # Inline layout: the full documents stored directly as jsonb
+    with connection.cursor() as cursor:
+        cursor.execute('CREATE TEMP TABLE inline_reports (id bigint primary key, a jsonb, p jsonb, e jsonb)')
+        for report in reports:
+            assignments, progress, evaluation = snapshots[report.pk]
+            cursor.execute(
+                'INSERT INTO inline_reports VALUES (%s, %s, %s, %s)',
+                [report.pk, json.dumps(assignments), json.dumps(progress), json.dumps(evaluation)]
+            )
+
+    inline_size = column_bytes('SELECT SUM(pg_column_size(a) + pg_column_size(p) + pg_column_size(e)) FROM inline_reports')
+    envelope_size = column_bytes(
+        'SELECT SUM(pg_column_size(activity_assignments_data) + pg_column_size(activity_progress_data) '
+        '+ pg_column_size(final_evaluation_data)) FROM users_therapysessionreport WHERE student_id = %s',
+        [student.pk]
+    )
+    blob_size = column_bytes('SELECT SUM(pg_column_size(data)) FROM users_snapshotblob WHERE student_id = %s', [student.pk])
+
+    def time_reads(read, repeat=20):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for report in reports:
+                read(report.pk)
+        return (time.perf_counter() - start) * 1000 / (repeat * len(reports))
+
+    def read_inline(pk):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT a::text, p::text, e::text FROM inline_reports WHERE id = %s', [pk])
+            return [json.loads(value) for value in cursor.fetchone()]
+
+    def read_compact(pk):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT activity_assignments_data::text, activity_progress_data::text, final_evaluation_data::text '
+                'FROM users_therapysessionreport WHERE id = %s', [pk]
+            )
+            envelopes = [json.loads(value) for value in cursor.fetchone()]
+        texts = SnapshotBlob.load(set().union(*map(text_ids, envelopes)))
+        return [unpack(envelope, texts) for envelope in envelopes]
+
+    inline_ms = time_reads(read_inline)
+    compact_ms = time_reads(read_compact)
+
+    print(f"\nTherapy snapshot storage ({len(reports)} sessions, "
+          f"{SnapshotBlob.objects.filter(student=student).count()} shared texts)")
+    print(f"{'layout':<28} {'bytes':>12} {'read ms/report':>16}")
+    print(f"{'inline JSON':<28} {inline_size:>12} {inline_ms:>16.2f}")
+    print(f"{'envelopes + blobs':<28} {envelope_size + blob_size:>12} {compact_ms:>16.2f}")
+    print(f"{'  of which envelopes':<28} {envelope_size:>12}")
+    print(f"{'  of which blobs':<28} {blob_size:>12}")
+
+
+if __name__ == '__main__':
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    progress_per_activity = int(sys.argv[2]) if len(sys.argv) > 2 else 28
+    with benchmark_database():
+        run(sessions, progress_per_activity)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Benchmark terminate_progress / restart_therapy_from_stage5 data resets.
+
+Compares the ORM cascade collector (QuerySet.delete()) with the set-based
+Student.clear_therapy_data() / clear_activity_plan() on students with
+thousands of ActivityProgress rows.
+
+Usage: python scripts/benchmark_therapy_reset.py [sessions_per_activity ...]
+"""
+import sys
+
+from benchmark_utils import benchmark_database, create_benchmark_users, measure, print_results, seed_student_history
+
+from django.db import transaction
+from django.db.models.signals import post_delete
+
+
+def orm_terminate(student):
+    """The previous terminate_progress delete sequence"""
+    student.handwriting_samples.all().delete()
+    student.tasks.all().delete()
+    student.assessment_summary.delete()
+    student.activity_assignments.all().delete()
+    student.final_evaluation.delete()
+    student.therapy_reports.all().delete()
+    student.stakeholder_recommendations.all().delete()
+
+
+def run(sessions_per_activity):
+    from users.models import ActivityProgress, Student
+
+    results = []
+    teacher, doctor = create_benchmark_users()
+    activities = 10
+
+    for sessions in sessions_per_activity:
+        rows = activities * sessions
+
+        student = seed_student_history(teacher, doctor, activities=activities, sessions=sessions)
+        with transaction.atomic():
+            with measure(f'ORM cascade delete ({rows} progress rows)', results):
+                orm_terminate(Student.objects.get(pk=student.pk))
+
+        # Any post_delete receiver disables fast deletes, so the collector
+        # loads every ActivityProgress row before deleting it
+        student = seed_student_history(teacher, doctor, activities=activities, sessions=sessions)
+        receiver = lambda **kwargs: None
+        post_delete.connect(receiver, sender=ActivityProgress)
+        try:
+            with transaction.atomic():
+                with measure(f'ORM cascade + signal ({rows} progress rows)', results):
+                    orm_terminate(Student.objects.get(pk=student.pk))
+        finally:
+            post_delete.disconnect(receiver, sender=ActivityProgress)
+
+        student = seed_student_history(teacher, doctor, activities=activities, sessions=sessions)
+        with transaction.atomic():
+            with measure(f'set-based clear_therapy_data ({rows} progress rows)', results):
+                Student.objects.get(pk=student.pk).clear_therapy_data()
+
+    print_results('Therapy data reset', results)
+
+
+if __name__ == '__main__':
+    sessions = [int(arg) for arg in sys.argv[1:]] or [100, 500, 2000]
+    with benchmark_database():
+        run(sessions)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Shared helpers for the benchmark scripts in this directory.
+
+Benchmarks run against a throwaway test database (created and destroyed
+around each run) so they never touch development data.
+"""
+import os
+import sys
+import time
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+import django
+
+# Setup Django
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+django.setup()
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+@contextmanager
+def benchmark_database():
+    """Create a fresh migrated test database for the duration of the block"""
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+@contextmanager
+def measure(label, results):
+    """Record wall time and query count of the block under `label`"""
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+    results.append((label, elapsed * 1000, len(queries.captured_queries)))
+
+
+def print_results(title, results):
+    print(f"\n{title}")
+    print(f"{'case':<48} {'ms':>10} {'queries':>8}")
+    for label, ms, queries in results:
+        print(f"{label:<48} {ms:>10.1f} {queries:>8}")
+
+
+def seed_student_history(teacher, doctor, name='Benchmark student', activities=10, sessions=300):
+    """
+    Create a student with a full Stage 1-7 history: `activities` assignments
+    with `sessions` ActivityProgress rows each.
+    """
+    from users.models import (Student, StageProgress, HandwritingSample, StudentTask, AssessmentSummary,
+                              ActivityAssignment, ActivityProgress, FinalEvaluation, StudentUserLink)
+
+    student = Student.objects.create(
+        name=name, birthday=date(2015, 1, 1), school='Benchmark School',
+        grade='3', gender='other', teacher=teacher
+    )
+    StageProgress.objects.create(student=student, current_stage=7, completed_stages=[1, 2, 3, 4, 5, 6])
+    StudentUserLink.objects.create(student=student, user=doctor, role='doctor')
+    HandwritingSample.objects.create(student=student, image='handwriting_samples/benchmark.png', dyslexia_score=40.0)
+    StudentTask.objects.bulk_create([
+        StudentTask(student=student, task_name=f'Task {index}', max_score=10, score_obtained=5)
+        for index in range(20)
+    ])
+    AssessmentSummary.objects.create(
+        student=student, doctor=doctor, cutoff_percentage=60, total_score=100,
+        total_max_score=200, percentage_score=50, risk_level='high', dyslexia_indication=True
+    )
+
+    assignments = ActivityAssignment.objects.bulk_create([
+        ActivityAssignment(
+            student=student, doctor=doctor, activity_name=f'Activity {index}', activity_type='reading',
+            description='Read aloud with a parent', instructions='Read one page, then retell the story. ' * 10,
+            frequency='daily', duration_minutes=15, target_audience='both',
+            expected_outcomes='Improved fluency and comprehension. ' * 10
+        )
+        for index in range(activities)
+    ])
+
+    start = date(2020, 1, 1)
+    ActivityProgress.objects.bulk_create([
+        ActivityProgress(
+            activity_assignment=assignment, recorder=teacher, performer='teacher',
+            session_date=start + timedelta(days=day),
+            status='completed' if day % 3 else 'in_progress', completion_percentage=80,
+            score=day % 10, student_engagement=day % 10 + 1, notes='Session notes ' * 5
+        )
+        for assignment in assignments
+        for day in range(sessions)
+    ], batch_size=2000)
+
+    FinalEvaluation.objects.create(
+        student=student, doctor=doctor, handwriting_analysis_summary='Summary',
+        task_performance_summary='Summary', activity_progress_summary='Summary',
+        final_diagnosis='mild_dyslexia', supporting_evidence='Evidence', intervention_priority='medium',
+        short_term_goals='Goals', long_term_goals='Goals', recommended_interventions='Interventions',
+        follow_up_timeline='Monthly', monitoring_indicators='Indicators'
+    )
+    return student
+
+
+def create_benchmark_users(suffix=''):
+    from users.models import User
+
+    teacher = User.objects.create_user(f'bench_teacher{suffix}', f'bench_teacher{suffix}@example.com', 'pass', role='teacher')
+    doctor = User.objects.create_user(f'bench_doctor{suffix}', f'bench_doctor{suffix}@example.com', 'pass', role='doctor')
+    return teacher, doctor
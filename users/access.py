@@ -0,0 +1,74 @@
+"""
+Student access control shared by the permission classes and views.
+
+A user's links to students are loaded with one query the first time a
+request needs them and reused by every later check in that request.
+With STUDENT_ACCESS_CACHE_TTL > 0 the link map is also cached across
+requests; users.signals drops it, once the transaction commits, whenever one
+of the user's links changes.
+"""
+from functools import cached_property
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import ActivityAssignment, StudentUserLink
+
+
+def access_cache_key(user_id):
+    return f'student_access:{user_id}'
+
+
+def invalidate_student_access(*user_ids):
+    """
+    Forget the cached link maps of the given users once the current
+    transaction commits (so a concurrent request cannot re-cache the links
+    as they were before the commit)
+    """
+    if not settings.STUDENT_ACCESS_CACHE_TTL:
+        return
+    keys = [access_cache_key(user_id) for user_id in user_ids if user_id]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+class StudentAccess:
+    """What one user may see and do for students"""
+
+    def __init__(self, user):
+        self.user = user
+        self._assigned = {}
+
+    @cached_property
+    def links(self):
+        """{student_id: link role} for every student linked to the user"""
+        ttl = settings.STUDENT_ACCESS_CACHE_TTL
+        key = access_cache_key(self.user.id)
+        links = cache.get(key) if ttl else None
+        if links is None:
+            links = dict(StudentUserLink.objects.filter(user=self.user).values_list('student_id', 'role'))
+            if ttl:
+                cache.set(key, links, ttl)
+        return links
+
+    def is_teacher_of(self, student):
+        return self.user.role == 'teacher' and student.teacher_id == self.user.id
+
+    def is_linked(self, student, role=None):
+        link_role = self.links.get(student.pk)
+        return link_role is not None and (role is None or link_role == role)
+
+    def has_assigned(self, student):
+        """Whether the user (a doctor) has assigned activities to the student"""
+        if student.pk not in self._assigned:
+            self._assigned[student.pk] = ActivityAssignment.objects.filter(student=student, doctor=self.user).exists()
+        return self._assigned[student.pk]
+
+
+def get_student_access(request):
+    """Return the StudentAccess of the request's user, created once per request"""
+    access = getattr(request, '_student_access', None)
+    if access is None or access.user is not request.user:
+        access = request._student_access = StudentAccess(request.user)
+    return access
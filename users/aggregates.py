@@ -0,0 +1,110 @@
+from django.db.models import Count, Exists, OuterRef, Prefetch, Q
+from .models import Student, ActivityAssignment, ActivityProgress
+from .serializers import StudentSerializer, HandwritingSampleSerializer, StudentTaskSerializer, AssessmentSummarySerializer, ActivityAssignmentSerializer, ActivityProgressSerializer
+
+# Sections of the Stage 7 comprehensive payload, in response order
+COMPREHENSIVE_SECTIONS = (
+    'student',
+    'handwriting_analysis',
+    'task_performance',
+    'assessment_summary',
+    'activity_assignments',
+    'activity_progress',
+)
+
+
+def parse_sections(fields_param):
+    """
+    Turn a `fields=a,b` query parameter into a tuple of section names.
+    Returns (sections, invalid) where invalid lists unknown names.
+    """
+    if not fields_param:
+        return COMPREHENSIVE_SECTIONS, []
+
+    requested = [field.strip() for field in fields_param.split(',') if field.strip()]
+    invalid = [field for field in requested if field not in COMPREHENSIVE_SECTIONS]
+    sections = tuple(section for section in COMPREHENSIVE_SECTIONS if section in requested)
+    return sections, invalid
+
+
+def get_doctor_access(student_id, doctor):
+    """
+    Check in one query whether the student exists and whether the doctor has
+    assigned activities to them. Returns None (no such student), False or True.
+    """
+    return Student.objects.filter(student_id=student_id).annotate(
+        doctor_has_access=Exists(
+            ActivityAssignment.objects.filter(student=OuterRef('pk'), doctor=doctor)
+        )
+    ).values_list('doctor_has_access', flat=True).first()
+
+
+def get_comprehensive_student(student_id, doctor, sections=COMPREHENSIVE_SECTIONS):
+    """
+    Load a student with everything the requested sections need in as few
+    round trips as possible: one query for the student, its one-to-one
+    relations and task counts, plus one query per requested list section.
+    """
+    queryset = Student.objects.filter(student_id=student_id)
+
+    related = []
+    if 'student' in sections:
+        related += ['stage_progress', 'final_evaluation']
+    if 'assessment_summary' in sections:
+        related.append('assessment_summary')
+    if related:
+        queryset = queryset.select_related(*related)
+
+    if 'task_performance' in sections:
+        queryset = queryset.annotate(
+            total_tasks=Count('tasks'),
+            completed_tasks=Count('tasks', filter=Q(tasks__score_obtained__isnull=False))
+        ).prefetch_related('tasks')
+
+    if 'handwriting_analysis' in sections:
+        queryset = queryset.prefetch_related('handwriting_samples')
+
+    if 'activity_assignments' in sections:
+        queryset = queryset.prefetch_related(Prefetch(
+            'activity_assignments',
+            queryset=ActivityAssignment.objects.filter(doctor=doctor),
+            to_attr='doctor_activities'
+        ))
+
+    return queryset.first()
+
+
+def build_comprehensive_data(student, doctor, sections=COMPREHENSIVE_SECTIONS):
+    """Serialize the requested sections for a student from get_comprehensive_student"""
+    data = {}
+
+    if 'student' in sections:
+        data['student'] = StudentSerializer(student).data
+
+    if 'handwriting_analysis' in sections:
+        data['handwriting_analysis'] = HandwritingSampleSerializer(student.handwriting_samples.all(), many=True).data
+
+    if 'task_performance' in sections:
+        data['task_performance'] = {
+            'tasks': StudentTaskSerializer(student.tasks.all(), many=True).data,
+            'total_tasks': student.total_tasks,
+            'completed_tasks': student.completed_tasks
+        }
+
+    if 'assessment_summary' in sections:
+        if hasattr(student, 'assessment_summary'):
+            data['assessment_summary'] = AssessmentSummarySerializer(student.assessment_summary).data
+        else:
+            data['assessment_summary'] = None
+
+    if 'activity_assignments' in sections:
+        data['activity_assignments'] = ActivityAssignmentSerializer(student.doctor_activities, many=True).data
+
+    if 'activity_progress' in sections:
+        progress_records = ActivityProgress.objects.filter(
+            activity_assignment__student=student,
+            activity_assignment__doctor=doctor
+        ).select_related('activity_assignment')
+        data['activity_progress'] = ActivityProgressSerializer(progress_records, many=True).data
+
+    return data
@@ -0,0 +1,99 @@
+"""
+Cross-request cache for computed per-student aggregates.
+
+Entries live in Django's default cache (LocMem in development, Redis when
+REDIS_URL is set) under a per-student version number. Invalidating a
+student replaces that version, which orphans every cached aggregate of the
+student for every viewer at once; orphaned entries simply expire.
+users.signals invalidates on model saves and deletes, and code paths that
+bypass signals (bulk_create, bulk_update, raw deletes) invalidate explicitly.
+
+Invalidation waits for the surrounding transaction to commit: a version
+replaced earlier would let a concurrent request rebuild the aggregate from
+the pre-commit rows under the new version and serve it for the full TTL.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+HITS_KEY = 'student_aggregates:hits'
+MISSES_KEY = 'student_aggregates:misses'
+
+
+def version_key(student_id):
+    return f'student_aggregates:version:{student_id}'
+
+
+def get_student_version(student_id):
+    # A time-based version never repeats, even if the version key was evicted
+    key = version_key(student_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def invalidate_student_aggregates(*student_ids):
+    """Drop every cached aggregate of the given students once the current transaction commits"""
+    keys = [version_key(student_id) for student_id in set(student_ids) if student_id]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def _count(key):
+    # Two extra cache round trips per lookup: only when stats are enabled
+    if not settings.STUDENT_AGGREGATE_CACHE_STATS:
+        return
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Evicted between add() and incr()
+        pass
+
+
+def cached_student_aggregate(student_id, name, variant, build):
+    """
+    Return the aggregate `name` of a student for a viewer `variant` (a tuple
+    of whatever shapes the payload, e.g. role and doctor id), calling
+    `build()` on a miss. Exceptions raised by `build` are not cached.
+    """
+    ttl = settings.STUDENT_AGGREGATE_CACHE_TTL
+    if not ttl:
+        return build()
+
+    variant = ':'.join(str(part) for part in variant)
+    key = f'student_aggregates:{student_id}:{get_student_version(student_id)}:{name}:{variant}'
+    data = cache.get(key)
+    if data is not None:
+        _count(HITS_KEY)
+        return data
+
+    _count(MISSES_KEY)
+    data = build()
+    cache.set(key, data, ttl)
+    return data
+
+
+def aggregate_cache_stats():
+    """
+    Hit/miss counters of the aggregate cache since the counters were last
+    reset (only counted while STUDENT_AGGREGATE_CACHE_STATS is on)
+    """
+    hits, misses = cache.get(HITS_KEY, 0), cache.get(MISSES_KEY, 0)
+    total = hits + misses
+    return {
+        'enabled': settings.STUDENT_AGGREGATE_CACHE_STATS,
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / total, 4) if total else None,
+        'ttl_seconds': settings.STUDENT_AGGREGATE_CACHE_TTL,
+        'backend': settings.CACHES['default']['BACKEND'],
+    }
+
+
+def reset_aggregate_cache_stats():
+    cache.delete_many([HITS_KEY, MISSES_KEY])
@@ -0,0 +1,248 @@
+import asyncio
+import hashlib
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import IntegrityError, transaction
+from .models import HandwritingSample
+
+ML_ANALYZE_URL = 'http://localhost:8001/analyze-handwriting/'
+
+# How long a Stage 1 preview stays available for the save step
+PREVIEW_TIMEOUT = 60 * 60
+
+IDEMPOTENCY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+
+
+class MLServiceError(Exception):
+    """Raised when the ML service answers with a non-200 status"""
+
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def hash_image(image_data):
+    """Return the SHA-256 hex digest of the raw image bytes"""
+    return hashlib.sha256(image_data).hexdigest()
+
+
+def get_idempotency_key(request):
+    """Client-supplied key from the Idempotency-Key header or form field"""
+    key = request.META.get(IDEMPOTENCY_HEADER) or request.data.get('idempotency_key') or ''
+    return str(key)[:64]
+
+
+def preview_cache_key(student_id, image_hash):
+    return f'handwriting:preview:{student_id}:{image_hash}'
+
+
+def call_ml_service(name, image_data, content_type, session=None):
+    """
+    Send an image to the FastAPI analysis service and return the prediction.
+    Raises MLServiceError on a non-200 reply and lets RequestException through.
+    """
+    files = {'image': (name, image_data, content_type)}
+    response = (session or requests).post(ML_ANALYZE_URL, files=files)
+
+    if response.status_code != 200:
+        raise MLServiceError(response.status_code, response.text)
+
+    data = response.json()
+    return {
+        'dyslexia_score': data.get('dyslexia_score'),
+        'interpretation': data.get('interpretation'),
+        'letter_counts': data.get('letter_counts'),
+    }
+
+
+def get_cached_analysis(student_id, image_hash):
+    return cache.get(preview_cache_key(student_id, image_hash))
+
+
+def analyze_image(student_id, name, image_data, content_type):
+    """
+    Return the analysis for an image, reusing a cached preview for the same
+    student and image content instead of calling the ML service again.
+    """
+    image_hash = hash_image(image_data)
+    result = get_cached_analysis(student_id, image_hash)
+    if result is None:
+        result = call_ml_service(name, image_data, content_type)
+        cache.set(preview_cache_key(student_id, image_hash), result, PREVIEW_TIMEOUT)
+    return image_hash, result
+
+
+def find_saved_sample(student, image_hash, idempotency_key):
+    return HandwritingSample.objects.filter(
+        student=student,
+        image_hash=image_hash,
+        idempotency_key=idempotency_key
+    ).first()
+
+
+def save_sample(student, image, image_hash, idempotency_key, result):
+    """
+    Store a handwriting sample once per (student, image hash, client key).
+    Returns (sample, created); a concurrent duplicate returns the existing row.
+    """
+    existing = find_saved_sample(student, image_hash, idempotency_key)
+    if existing:
+        return existing, False
+
+    sample = HandwritingSample(
+        student=student,
+        image=image,
+        image_hash=image_hash,
+        idempotency_key=idempotency_key,
+        **result
+    )
+    try:
+        with transaction.atomic():
+            sample.save()
+        return sample, True
+    except IntegrityError:
+        # The image file was stored before the INSERT lost the race
+        if sample.image.name:
+            sample.image.delete(save=False)
+        return find_saved_sample(student, image_hash, idempotency_key), False
+
+
+def _sample_payload(sample):
+    return {
+        'sample_id': sample.id,
+        'dyslexia_score': sample.dyslexia_score,
+        'interpretation': sample.interpretation,
+        'letter_counts': sample.letter_counts,
+    }
+
+
+def read_batch(jobs):
+    """
+    Read and hash every image of a batch. Returns the (student, image,
+    image_data, image_hash) jobs still to analyze and the (student, sample)
+    pairs of images already saved, found in one query.
+    """
+    hashed = []
+    for student, image in jobs:
+        image_data = image.read()
+        hashed.append((student, image, image_data, hash_image(image_data)))
+
+    existing = {
+        (sample.student_id, sample.image_hash): sample
+        for sample in HandwritingSample.objects.filter(
+            student__in=[student for student, _ in jobs],
+            image_hash__in=[image_hash for *_, image_hash in hashed],
+            idempotency_key=''
+        )
+    }
+
+    to_analyze, duplicates = [], []
+    for student, image, image_data, image_hash in hashed:
+        sample = existing.get((student.pk, image_hash))
+        if sample:
+            duplicates.append((student, sample))
+        else:
+            to_analyze.append((student, image, image_data, image_hash))
+    return to_analyze, duplicates
+
+
+def save_samples(analyzed):
+    """
+    Store the samples of analyses that completed together with one bulk
+    INSERT. `analyzed` holds (student, name, image_data, image_hash, result)
+    entries; returns a (sample, created) pair for each. If a concurrent upload
+    saved one of the images first, the files stored for the failed INSERT are
+    removed and each sample goes through save_sample instead.
+    """
+    samples = [
+        HandwritingSample(student=student, image=ContentFile(image_data, name=name), image_hash=image_hash, **result)
+        for student, name, image_data, image_hash, result in analyzed
+    ]
+    try:
+        with transaction.atomic():
+            HandwritingSample.objects.bulk_create(samples)
+    except IntegrityError:
+        for sample in samples:
+            if sample.image.name:
+                sample.image.delete(save=False)
+        return [
+            save_sample(student, ContentFile(image_data, name=name), image_hash, '', result)
+            for student, name, image_data, image_hash, result in analyzed
+        ]
+    return [(sample, True) for sample in samples]
+
+
+async def analyze_batch(jobs, unknown_ids=()):
+    """
+    Analyze one image per student with bounded parallelism, as an async
+    iterator of progress events.
+
+    `jobs` is a list of (student, image) pairs. The ML calls run on a thread
+    pool; whenever analyses finish, the ones that finished together are saved
+    with one bulk INSERT and only then reported, so a client that stops
+    reading mid-stream loses no finished work. A final `complete` event
+    summarizes the batch. Failures are reported per student.
+    """
+    total = len(jobs) + len(unknown_ids)
+    completed = 0
+    results = []
+
+    def progress(student_id, **fields):
+        nonlocal completed
+        completed += 1
+        event = {'event': 'progress', 'student_id': student_id, **fields, 'completed': completed, 'total': total}
+        results.append(event)
+        return event
+
+    for student_id in unknown_ids:
+        yield progress(student_id, status='failed', error='Student not found in this classroom')
+
+    # Hash every image up front so already-saved uploads are found in one query
+    to_analyze, duplicates = await sync_to_async(read_batch)(jobs)
+    for student, sample in duplicates:
+        yield progress(student.pk, status='duplicate', **_sample_payload(sample))
+
+    # Worker threads only talk to the ML service; DB work goes through sync_to_async
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=max(1, min(settings.HANDWRITING_BATCH_WORKERS, len(to_analyze) or 1)))
+    try:
+        futures = {
+            loop.run_in_executor(executor, analyze_image, student.pk, image.name, image_data, image.content_type):
+                (student, image, image_data, image_hash)
+            for student, image, image_data, image_hash in to_analyze
+        }
+        pending = set(futures)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            analyzed = []
+            for future in done:
+                student, image, image_data, image_hash = futures[future]
+                try:
+                    _, result = future.result()
+                except MLServiceError as e:
+                    yield progress(student.pk, status='failed', error='ML service error', detail=e.detail)
+                except requests.exceptions.RequestException as e:
+                    yield progress(student.pk, status='failed', error='ML service unreachable', detail=str(e))
+                else:
+                    analyzed.append((student, image.name, image_data, image_hash, result))
+            if analyzed:
+                saved = await sync_to_async(save_samples)(analyzed)
+                for (student, *_), (sample, created) in zip(analyzed, saved):
+                    # A concurrent upload of the same image may have saved it first
+                    yield progress(student.pk, status='saved' if created else 'duplicate', **_sample_payload(sample))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    yield {
+        'event': 'complete',
+        'total': total,
+        'saved': sum(1 for event in results if event['status'] == 'saved'),
+        'duplicates': sum(1 for event in results if event['status'] == 'duplicate'),
+        'failed': sum(1 for event in results if event['status'] == 'failed'),
+        'results': results,
+    }
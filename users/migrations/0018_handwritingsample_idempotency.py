@@ -0,0 +1,27 @@
+# Generated by Django 5.2.4 on 2026-10-19 16:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0017_classroom_student_classroom'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='handwritingsample',
+            name='idempotency_key',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='handwritingsample',
+            name='image_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AddConstraint(
+            model_name='handwritingsample',
+            constraint=models.UniqueConstraint(condition=models.Q(('image_hash', ''), _negated=True), fields=('student', 'image_hash', 'idempotency_key'), name='unique_handwriting_sample_upload'),
+        ),
+    ]
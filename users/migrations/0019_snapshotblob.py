@@ -0,0 +1,42 @@
+# Generated by Django 5.2.4 on 2026-10-19 16:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0018_handwritingsample_idempotency'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='therapysessionreport',
+            name='activity_assignments_data',
+            field=models.JSONField(help_text='Envelope of the assigned activities snapshot'),
+        ),
+        migrations.AlterField(
+            model_name='therapysessionreport',
+            name='activity_progress_data',
+            field=models.JSONField(help_text='Envelope of the activity progress snapshot'),
+        ),
+        migrations.AlterField(
+            model_name='therapysessionreport',
+            name='final_evaluation_data',
+            field=models.JSONField(help_text='Envelope of the final evaluation snapshot'),
+        ),
+        migrations.CreateModel(
+            name='SnapshotBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64)),
+                ('data', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshot_blobs', to='users.student')),
+            ],
+            options={
+                'unique_together': {('student', 'digest')},
+            },
+        ),
+    ]
@@ -0,0 +1,112 @@
+import hashlib
+import zlib
+
+from django.db import migrations
+
+SNAPSHOT_FIELDS = ('activity_assignments_data', 'activity_progress_data', 'final_evaluation_data')
+
+# Frozen copy of the snapshot format of users/snapshots.py, so later changes
+# to it cannot change what this migration does
+SNAPSHOT_FORMAT = 'snapshot/1'
+TEXT_MIN_LENGTH = 200
+SUMMARY_FIELDS = ('final_diagnosis', 'intervention_priority', 'teacher_recommendations', 'parent_recommendations')
+
+
+def is_long_text(value):
+    return isinstance(value, str) and len(value) >= TEXT_MIN_LENGTH
+
+
+def digest_text(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def long_texts(document, texts):
+    for entry in [document] if isinstance(document, dict) else document:
+        if isinstance(entry, dict):
+            for value in entry.values():
+                if is_long_text(value):
+                    texts[digest_text(value)] = value
+    return texts
+
+
+def split(entries, text_ids):
+    stripped, refs = [], {}
+    for index, entry in enumerate(entries):
+        if isinstance(entry, dict) and any(is_long_text(value) for value in entry.values()):
+            refs[str(index)] = {key: text_ids[digest_text(value)] for key, value in entry.items() if is_long_text(value)}
+            entry = {key: value for key, value in entry.items() if not is_long_text(value)}
+        stripped.append(entry)
+    return stripped, refs
+
+
+def pack(document, text_ids):
+    envelope = {'format': SNAPSHOT_FORMAT, 'items': len(document)}
+    if isinstance(document, dict):
+        (envelope['entry'],), envelope['texts'] = split([document], text_ids)
+        envelope['summary'] = {field: document[field] for field in SUMMARY_FIELDS if document.get(field) is not None}
+    else:
+        envelope['entries'], envelope['texts'] = split(document, text_ids)
+    return envelope
+
+
+def unpack(envelope, texts):
+    entries = [envelope['entry']] if 'entry' in envelope else list(envelope['entries'])
+    for index, entry_refs in envelope['texts'].items():
+        index = int(index)
+        entries[index] = {**entries[index], **{key: texts[text_id] for key, text_id in entry_refs.items()}}
+    return entries[0] if 'entry' in envelope else entries
+
+
+def student_reports(apps):
+    """Yield (student_id, reports) for every student with therapy reports"""
+    TherapySessionReport = apps.get_model('users', 'TherapySessionReport')
+    student_ids = TherapySessionReport.objects.order_by().values_list('student_id', flat=True).distinct()
+    for student_id in student_ids.iterator():
+        yield student_id, list(TherapySessionReport.objects.filter(student_id=student_id).only('student_id', *SNAPSHOT_FIELDS))
+
+
+def compact_snapshots(apps, schema_editor):
+    """Replace inline snapshot documents with envelopes, moving long texts into per-student blobs"""
+    TherapySessionReport = apps.get_model('users', 'TherapySessionReport')
+    SnapshotBlob = apps.get_model('users', 'SnapshotBlob')
+
+    for student_id, reports in student_reports(apps):
+        texts = {}
+        for report in reports:
+            for field in SNAPSHOT_FIELDS:
+                long_texts(getattr(report, field), texts)
+        SnapshotBlob.objects.bulk_create(
+            [SnapshotBlob(student_id=student_id, digest=digest, data=zlib.compress(text.encode(), 6)) for digest, text in texts.items()],
+            ignore_conflicts=True
+        )
+        text_ids = dict(SnapshotBlob.objects.filter(student_id=student_id).values_list('digest', 'id'))
+        for report in reports:
+            for field in SNAPSHOT_FIELDS:
+                setattr(report, field, pack(getattr(report, field), text_ids))
+        TherapySessionReport.objects.bulk_update(reports, SNAPSHOT_FIELDS)
+
+
+def expand_snapshots(apps, schema_editor):
+    """Inline the full snapshot documents again and drop the blobs"""
+    TherapySessionReport = apps.get_model('users', 'TherapySessionReport')
+    SnapshotBlob = apps.get_model('users', 'SnapshotBlob')
+
+    for student_id, reports in student_reports(apps):
+        blobs = SnapshotBlob.objects.filter(student_id=student_id)
+        texts = {text_id: zlib.decompress(bytes(data)).decode() for text_id, data in blobs.values_list('id', 'data')}
+        for report in reports:
+            for field in SNAPSHOT_FIELDS:
+                setattr(report, field, unpack(getattr(report, field), texts))
+        TherapySessionReport.objects.bulk_update(reports, SNAPSHOT_FIELDS)
+        blobs.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0019_snapshotblob'),
+    ]
+
+    operations = [
+        migrations.RunPython(compact_snapshots, expand_snapshots),
+    ]
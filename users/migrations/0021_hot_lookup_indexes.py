@@ -0,0 +1,21 @@
+# Generated by Django 5.2.4 on 2026-10-19 17:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0020_compact_therapy_snapshots'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='activityprogress',
+            index=models.Index(fields=['activity_assignment', '-session_date', '-id'], name='progress_history_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(condition=models.Q(('classroom__isnull', True)), fields=['teacher'], name='student_unassigned_idx'),
+        ),
+    ]
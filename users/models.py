@@ -3,6 +3,8 @@ from django.db import models
 from django.conf import settings
 from django.contrib.postgres.fields import ArrayField
 from cloudinary.models import CloudinaryField
+from .caching import invalidate_student_aggregates
+from .snapshots import compress_text, decompress_text, long_texts, pack, text_ids, unpack
 
 class User(AbstractUser):
     ROLE_CHOICES = (
@@ -13,6 +15,15 @@ class User(AbstractUser):
     role = models.CharField(max_length=10, choices=ROLE_CHOICES)
     phone = models.CharField(max_length=15, blank=True)
 
+def raw_delete(queryset):
+    """
+    Delete every row matching the queryset with one DELETE statement.
+    Unlike QuerySet.delete() this never loads rows into memory, so it skips
+    signals and cascades: callers must delete dependent rows first.
+    """
+    return queryset._raw_delete(queryset.db)
+
+
 class Student(models.Model):
     GENDER_CHOICES = (
         ('male', 'Male'),
@@ -33,6 +44,32 @@ class Student(models.Model):
     def __str__(self):
         return self.name
 
+    def clear_activity_plan(self):
+        """Delete Stage 5/6 data: activity assignments and their progress records"""
+        raw_delete(ActivityProgress.objects.filter(activity_assignment__in=ActivityAssignment.objects.filter(student=self)))
+        raw_delete(ActivityAssignment.objects.filter(student=self))
+        # Raw deletes send no signals
+        invalidate_student_aggregates(self.pk)
+
+    def clear_therapy_data(self):
+        """Delete all data produced by Stages 1-7, keeping only the student record"""
+        raw_delete(HandwritingSample.objects.filter(student=self))
+        raw_delete(StudentTask.objects.filter(student=self))
+        raw_delete(AssessmentSummary.objects.filter(student=self))
+        self.clear_activity_plan()
+        raw_delete(FinalEvaluation.objects.filter(student=self))
+        raw_delete(TherapySessionReport.objects.filter(student=self))
+        raw_delete(SnapshotBlob.objects.filter(student=self))
+        raw_delete(StakeholderRecommendation.objects.filter(student=self))
+        invalidate_student_aggregates(self.pk)
+
+    class Meta:
+        indexes = [
+            # A teacher's unassigned students (classroom assignment screens) are a small
+            # slice of the roster; the plain teacher index had to filter the whole roster
+            models.Index(fields=['teacher'], condition=models.Q(classroom__isnull=True), name='student_unassigned_idx'),
+        ]
+
 class Classroom(models.Model):
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True)
@@ -73,9 +110,22 @@ class HandwritingSample(models.Model):
     interpretation = models.CharField(max_length=50, null=True, blank=True)
     letter_counts = models.JSONField(null=True, blank=True)
 
+    # Idempotency: content hash of the image plus an optional client key
+    image_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    idempotency_key = models.CharField(max_length=64, blank=True)
+
     def __str__(self):
         return f"Sample for {self.student.name} on {self.uploaded_at.date()}"
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['student', 'image_hash', 'idempotency_key'],
+                condition=~models.Q(image_hash=''),
+                name='unique_handwriting_sample_upload',
+            ),
+        ]
+
 class StageProgress(models.Model):
     student = models.OneToOneField('Student', on_delete=models.CASCADE, related_name='stage_progress')
     current_stage = models.IntegerField(default=1)
@@ -231,6 +281,11 @@ class ActivityProgress(models.Model):
     class Meta:
         ordering = ['-session_date']
         unique_together = ['activity_assignment', 'session_date', 'performer']
+        indexes = [
+            # Keyset pagination of an activity's history on (session_date, id); the unique
+            # index above orders by performer rather than id, so later pages had to sort
+            models.Index(fields=['activity_assignment', '-session_date', '-id'], name='progress_history_idx'),
+        ]
 
 
 class FinalEvaluation(models.Model):
@@ -337,14 +392,17 @@ class TherapySessionReport(models.Model):
     student = models.ForeignKey(Student, on_delete=models.CASCADE, related_name='therapy_reports')
     session_number = models.PositiveIntegerField()
     
+    # Snapshot columns hold envelopes whose long texts live in SnapshotBlob
+    # (see users/snapshots.py). Use get_snapshot() / expand_snapshots() to read them.
+
     # Stage 5 data snapshot
-    activity_assignments_data = models.JSONField(help_text="Snapshot of assigned activities")
+    activity_assignments_data = models.JSONField(help_text="Envelope of the assigned activities snapshot")
     
     # Stage 6 data snapshot  
-    activity_progress_data = models.JSONField(help_text="Snapshot of activity progress records")
+    activity_progress_data = models.JSONField(help_text="Envelope of the activity progress snapshot")
     
     # Stage 7 data snapshot
-    final_evaluation_data = models.JSONField(help_text="Snapshot of final evaluation")
+    final_evaluation_data = models.JSONField(help_text="Envelope of the final evaluation snapshot")
     
     # Session metadata
     session_start_date = models.DateTimeField(help_text="When this therapy session started")
@@ -360,89 +418,124 @@ class TherapySessionReport(models.Model):
     def __str__(self):
         return f"Therapy Session {self.session_number} - {self.student.name}"
     
+    # Rows fetched per round trip when snapshotting long histories
+    SNAPSHOT_CHUNK_SIZE = 2000
+
+    ASSIGNMENT_SNAPSHOT_FIELDS = (
+        'activity_name', 'activity_type', 'description', 'difficulty', 'frequency',
+        'duration_minutes', 'target_audience', 'instructions', 'expected_outcomes',
+        'success_criteria', 'created_at', 'is_active',
+    )
+
+    PROGRESS_SNAPSHOT_FIELDS = (
+        'session_date', 'performer', 'status', 'completion_percentage', 'score',
+        'duration_actual', 'notes', 'challenges', 'improvements', 'student_engagement',
+        'difficulty_level', 'created_at',
+    )
+
+    EVALUATION_SNAPSHOT_FIELDS = (
+        'therapy_session_number', 'therapy_decision', 'therapy_termination_reason',
+        'handwriting_analysis_summary', 'task_performance_summary', 'activity_progress_summary',
+        'final_diagnosis', 'diagnosis_confidence', 'supporting_evidence', 'intervention_priority',
+        'short_term_goals', 'long_term_goals', 'recommended_interventions', 'follow_up_timeline',
+        'monitoring_indicators', 'clinical_notes', 'referrals_needed', 'case_completed',
+        'completion_date', 'created_at',
+    )
+
+    @staticmethod
+    def _isoformat_dates(row, *fields):
+        for field in fields:
+            if row[field] is not None:
+                row[field] = row[field].isoformat()
+        return row
+
+    @classmethod
+    def build_snapshot(cls, student):
+        """
+        Collect the Stage 5-7 snapshot for a student from .values() queries.
+        No model instances are created and rows are fetched from a server-side
+        cursor SNAPSHOT_CHUNK_SIZE at a time, but the returned documents hold
+        the whole history: the report stores each one as a single JSON value.
+        Returns (assignments, progress, evaluation, first_assignment_created_at).
+        """
+        # Collect Stage 5 data (Activity Assignments)
+        activity_assignments = []
+        first_assigned_at = None
+        assignment_rows = ActivityAssignment.objects.filter(student=student).values(
+            *cls.ASSIGNMENT_SNAPSHOT_FIELDS
+        ).iterator(chunk_size=cls.SNAPSHOT_CHUNK_SIZE)
+        for row in assignment_rows:
+            if first_assigned_at is None or row['created_at'] < first_assigned_at:
+                first_assigned_at = row['created_at']
+            activity_assignments.append(cls._isoformat_dates(row, 'created_at'))
+
+        # Collect Stage 6 data (Activity Progress), joined to the activity name in SQL
+        progress_rows = ActivityProgress.objects.filter(activity_assignment__student=student).values(
+            *cls.PROGRESS_SNAPSHOT_FIELDS,
+            activity_name=models.F('activity_assignment__activity_name')
+        ).iterator(chunk_size=cls.SNAPSHOT_CHUNK_SIZE)
+        activity_progress = [cls._isoformat_dates(row, 'session_date', 'created_at') for row in progress_rows]
+
+        # Collect Stage 7 data (Final Evaluation)
+        evaluation = FinalEvaluation.objects.filter(student=student).values(*cls.EVALUATION_SNAPSHOT_FIELDS).first()
+        final_evaluation_data = cls._isoformat_dates(evaluation, 'completion_date', 'created_at') if evaluation else {}
+
+        return activity_assignments, activity_progress, final_evaluation_data, first_assigned_at
+
+    @classmethod
+    def compact_snapshot(cls, student, *documents):
+        """
+        Store the documents' long texts as per-student blobs (once per
+        distinct text) and return the envelopes to save on the report.
+        """
+        texts = {}
+        for document in documents:
+            long_texts(document, texts)
+        ids = SnapshotBlob.store(student, texts)
+        return [pack(document, ids) for document in documents]
+
+    def get_snapshot(self):
+        """Return the full (assignments, progress, evaluation) snapshot"""
+        return self.expand_snapshots([self])[self.pk]
+
+    @classmethod
+    def expand_snapshots(cls, reports):
+        """
+        Rebuild the full snapshots of several reports with one blob query.
+        Returns {report.pk: (assignments, progress, evaluation)}.
+        """
+        ids = set()
+        for report in reports:
+            for envelope in (report.activity_assignments_data, report.activity_progress_data, report.final_evaluation_data):
+                ids |= text_ids(envelope)
+        texts = SnapshotBlob.load(ids)
+        return {
+            report.pk: (
+                unpack(report.activity_assignments_data, texts),
+                unpack(report.activity_progress_data, texts),
+                unpack(report.final_evaluation_data, texts),
+            )
+            for report in reports
+        }
+
     @classmethod
     def create_report_from_current_data(cls, student):
         """Create a therapy session report from current student data"""
         from django.utils import timezone
-        import json
         
         # Get current session number
-        last_report = cls.objects.filter(student=student).order_by('-session_number').first()
-        session_number = (last_report.session_number + 1) if last_report else 1
-        
-        # Collect Stage 5 data (Activity Assignments)
-        activity_assignments = []
-        for assignment in student.activity_assignments.all():
-            activity_assignments.append({
-                'activity_name': assignment.activity_name,
-                'activity_type': assignment.activity_type,
-                'description': assignment.description,
-                'difficulty': assignment.difficulty,
-                'frequency': assignment.frequency,
-                'duration_minutes': assignment.duration_minutes,
-                'target_audience': assignment.target_audience,
-                'instructions': assignment.instructions,
-                'expected_outcomes': assignment.expected_outcomes,
-                'success_criteria': assignment.success_criteria,
-                'created_at': assignment.created_at.isoformat(),
-                'is_active': assignment.is_active,
-            })
+        last_session = cls.objects.filter(student=student).aggregate(last=models.Max('session_number'))['last']
+        session_number = (last_session + 1) if last_session else 1
         
-        # Collect Stage 6 data (Activity Progress)
-        activity_progress = []
-        for progress in ActivityProgress.objects.filter(activity_assignment__student=student):
-            activity_progress.append({
-                'activity_name': progress.activity_assignment.activity_name,
-                'session_date': progress.session_date.isoformat(),
-                'performer': progress.performer,
-                'status': progress.status,
-                'completion_percentage': progress.completion_percentage,
-                'score': progress.score,
-                'duration_actual': progress.duration_actual,
-                'notes': progress.notes,
-                'challenges': progress.challenges,
-                'improvements': progress.improvements,
-                'student_engagement': progress.student_engagement,
-                'difficulty_level': progress.difficulty_level,
-                'created_at': progress.created_at.isoformat(),
-            })
-        
-        # Collect Stage 7 data (Final Evaluation)
-        final_evaluation_data = {}
-        if hasattr(student, 'final_evaluation'):
-            evaluation = student.final_evaluation
-            final_evaluation_data = {
-                'therapy_session_number': evaluation.therapy_session_number,
-                'therapy_decision': evaluation.therapy_decision,
-                'therapy_termination_reason': evaluation.therapy_termination_reason,
-                'handwriting_analysis_summary': evaluation.handwriting_analysis_summary,
-                'task_performance_summary': evaluation.task_performance_summary,
-                'activity_progress_summary': evaluation.activity_progress_summary,
-                'final_diagnosis': evaluation.final_diagnosis,
-                'diagnosis_confidence': evaluation.diagnosis_confidence,
-                'supporting_evidence': evaluation.supporting_evidence,
-                'intervention_priority': evaluation.intervention_priority,
-                'short_term_goals': evaluation.short_term_goals,
-                'long_term_goals': evaluation.long_term_goals,
-                'recommended_interventions': evaluation.recommended_interventions,
-                'follow_up_timeline': evaluation.follow_up_timeline,
-                'monitoring_indicators': evaluation.monitoring_indicators,
-                'clinical_notes': evaluation.clinical_notes,
-                'referrals_needed': evaluation.referrals_needed,
-                'case_completed': evaluation.case_completed,
-                'completion_date': evaluation.completion_date.isoformat() if evaluation.completion_date else None,
-                'created_at': evaluation.created_at.isoformat(),
-            }
+        activity_assignments, activity_progress, final_evaluation_data, first_assigned_at = cls.build_snapshot(student)
+        activity_assignments, activity_progress, final_evaluation_data = cls.compact_snapshot(
+            student, activity_assignments, activity_progress, final_evaluation_data
+        )
         
-        # Determine session dates
-        session_start_date = timezone.now()
+        # Determine session dates, using the first activity assignment as the start when available
+        session_start_date = first_assigned_at or timezone.now()
         session_end_date = timezone.now()
         
-        # Try to get actual session dates from activity assignments
-        if student.activity_assignments.exists():
-            first_assignment = student.activity_assignments.order_by('created_at').first()
-            session_start_date = first_assignment.created_at
-        
         return cls.objects.create(
             student=student,
             session_number=session_number,
@@ -459,6 +552,41 @@ class TherapySessionReport(models.Model):
         unique_together = ['student', 'session_number']
 
 
+class SnapshotBlob(models.Model):
+    """
+    A compressed long text of a student's therapy session snapshots, shared
+    by every report that contains it and addressed by its SHA-256 digest.
+    """
+    student = models.ForeignKey(Student, on_delete=models.CASCADE, related_name='snapshot_blobs')
+    digest = models.CharField(max_length=64)
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Snapshot blob {self.digest[:12]} for {self.student_id}"
+
+    @classmethod
+    def store(cls, student, texts):
+        """Insert the digest -> text blobs a student does not have yet and return {digest: id} for all of them"""
+        if not texts:
+            return {}
+        cls.objects.bulk_create(
+            [cls(student=student, digest=digest, data=compress_text(text)) for digest, text in texts.items()],
+            ignore_conflicts=True
+        )
+        return dict(cls.objects.filter(student=student, digest__in=texts).values_list('digest', 'id'))
+
+    @classmethod
+    def load(cls, ids):
+        """Return {id: text} for the given ids"""
+        if not ids:
+            return {}
+        return {pk: decompress_text(data) for pk, data in cls.objects.filter(pk__in=ids).values_list('id', 'data')}
+
+    class Meta:
+        unique_together = ['student', 'digest']
+
+
 class StakeholderRecommendation(models.Model):
     """
     Recommendations provided by teachers and parents for Stage 7 final evaluation
@@ -1,5 +1,5 @@
 from rest_framework import permissions
-from .models import StudentUserLink
+from .access import get_student_access
 
 class IsTeacherOrReadOnly(permissions.BasePermission):
     """
@@ -17,13 +17,15 @@ class IsTeacherOrReadOnly(permissions.BasePermission):
         return request.method in permissions.SAFE_METHODS
 
     def has_object_permission(self, request, view, obj):
+        access = get_student_access(request)
+
         # Teachers: Full access to their own students
-        if request.user.role == 'teacher' and obj.teacher == request.user:
+        if access.is_teacher_of(obj):
             return True
 
         # Others: Only view assigned students
         if request.method in permissions.SAFE_METHODS:
-            return obj.student_links.filter(user=request.user).exists()
+            return access.is_linked(obj)
 
         return False
 
@@ -42,5 +44,5 @@ class IsLinkedDoctorOrParentReadOnly(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
         # Check if user is linked to the student
         if request.method in permissions.SAFE_METHODS:
-            return StudentUserLink.objects.filter(user=request.user, student=obj).exists()
+            return get_student_access(request).is_linked(obj)
         return False
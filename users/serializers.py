@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from .models import User, Student, StudentUserLink, StageProgress, HandwritingSample, StudentTask, AssessmentSummary, ActivityAssignment, ActivityProgress, FinalEvaluation, StakeholderRecommendation, Classroom
+from .caching import invalidate_student_aggregates
 from django.contrib.auth.password_validation import validate_password
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 
@@ -220,11 +221,27 @@ class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
         token['username'] = user.username
         return token
 
+class StudentTaskListSerializer(serializers.ListSerializer):
+    """Create all validated tasks with a single INSERT"""
+    def create(self, validated_data):
+        tasks = StudentTask.objects.bulk_create([StudentTask(**item) for item in validated_data])
+        # bulk_create sends no post_save signals
+        invalidate_student_aggregates(*(task.student_id for task in tasks))
+        return tasks
+
+
 class StudentTaskSerializer(serializers.ModelSerializer):
     class Meta:
         model = StudentTask
         fields = ['id', 'student', 'task_name', 'max_score', 'score_obtained']
         read_only_fields = ['id', 'student', 'score_obtained']
+        list_serializer_class = StudentTaskListSerializer
+
+
+class TaskScoreSerializer(serializers.Serializer):
+    """One entry of a Stage 3 score_tasks request"""
+    task_id = serializers.IntegerField()
+    score = serializers.IntegerField()
 
 class AssessmentSummarySerializer(serializers.ModelSerializer):
     class Meta:
@@ -237,6 +254,15 @@ class AssessmentSummarySerializer(serializers.ModelSerializer):
         ]
         read_only_fields = ['id', 'student', 'doctor', 'created_at', 'updated_at']
 
+class ActivityAssignmentListSerializer(serializers.ListSerializer):
+    """Create all validated activity assignments with a single INSERT"""
+    def create(self, validated_data):
+        assignments = ActivityAssignment.objects.bulk_create([ActivityAssignment(**item) for item in validated_data])
+        # bulk_create sends no post_save signals
+        invalidate_student_aggregates(*(assignment.student_id for assignment in assignments))
+        return assignments
+
+
 class ActivityAssignmentSerializer(serializers.ModelSerializer):
     class Meta:
         model = ActivityAssignment
@@ -247,6 +273,7 @@ class ActivityAssignmentSerializer(serializers.ModelSerializer):
             'is_active', 'created_at', 'updated_at'
         ]
         read_only_fields = ['id', 'student', 'doctor', 'created_at', 'updated_at']
+        list_serializer_class = ActivityAssignmentListSerializer
 
 
 class ActivityProgressSerializer(serializers.ModelSerializer):
@@ -371,12 +398,13 @@ class StudentClassroomSerializer(serializers.ModelSerializer):
         fields = ['student_id', 'name', 'birthday', 'school', 'grade', 'gender', 'classroom', 'classroom_name', 'linked_users', 'stage_progress']
     
     def get_linked_users(self, obj):
-        links = StudentUserLink.objects.filter(student=obj)
+        # Reads prefetched student_links__user when the view provides them
+        links = obj.student_links.all()
         return [{'user_id': link.user.id, 'username': link.user.username, 'role': link.role} for link in links]
     
     def get_stage_progress(self, obj):
         try:
-            progress = StageProgress.objects.get(student=obj)
+            progress = obj.stage_progress
             return {
                 'current_stage': progress.current_stage,
                 'completed_stages': progress.completed_stages
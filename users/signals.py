@@ -0,0 +1,59 @@
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .access import invalidate_student_access
+from .caching import invalidate_student_aggregates
+from .models import (ActivityAssignment, ActivityProgress, AssessmentSummary, FinalEvaluation, HandwritingSample,
+                     StageProgress, Student, StudentTask, StudentUserLink)
+
+
+@receiver(pre_save, sender=StudentUserLink)
+def invalidate_previous_link_user(sender, instance, **kwargs):
+    # A link moved to another user also changes the previous user's access
+    if settings.STUDENT_ACCESS_CACHE_TTL and instance.pk:
+        previous = StudentUserLink.objects.filter(pk=instance.pk).values_list('user_id', flat=True).first()
+        if previous != instance.user_id:
+            invalidate_student_access(previous)
+
+
+@receiver(post_save, sender=StudentUserLink)
+@receiver(post_delete, sender=StudentUserLink)
+def invalidate_link_user(sender, instance, **kwargs):
+    invalidate_student_access(instance.user_id)
+
+
+@receiver(post_save, sender=Student)
+@receiver(post_delete, sender=Student)
+def invalidate_student(sender, instance, **kwargs):
+    invalidate_student_aggregates(instance.pk)
+
+
+@receiver(post_save, sender=StageProgress)
+@receiver(post_delete, sender=StageProgress)
+@receiver(post_save, sender=HandwritingSample)
+@receiver(post_delete, sender=HandwritingSample)
+@receiver(post_save, sender=StudentTask)
+@receiver(post_delete, sender=StudentTask)
+@receiver(post_save, sender=AssessmentSummary)
+@receiver(post_delete, sender=AssessmentSummary)
+@receiver(post_save, sender=ActivityAssignment)
+@receiver(post_delete, sender=ActivityAssignment)
+@receiver(post_save, sender=FinalEvaluation)
+@receiver(post_delete, sender=FinalEvaluation)
+def invalidate_student_data(sender, instance, **kwargs):
+    invalidate_student_aggregates(instance.student_id)
+
+
+@receiver(post_save, sender=ActivityProgress)
+@receiver(post_delete, sender=ActivityProgress)
+def invalidate_progress_student(sender, instance, origin=None, **kwargs):
+    # Deletes cascading from an assignment or student are covered by that
+    # object's own receiver; don't look up the student once per progress row
+    if origin is not None and getattr(origin, 'model', type(origin)) is not ActivityProgress:
+        return
+    if ActivityProgress.activity_assignment.is_cached(instance):
+        student_id = instance.activity_assignment.student_id
+    else:
+        student_id = ActivityAssignment.objects.filter(pk=instance.activity_assignment_id).values_list('student_id', flat=True).first()
+    invalidate_student_aggregates(student_id)
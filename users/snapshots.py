@@ -0,0 +1,100 @@
+"""
+Compact storage for therapy session snapshots.
+
+A snapshot document is the activity assignment list, the activity progress
+list or the final evaluation. The report column keeps an envelope of it:
+
+    {"format": "snapshot/1", "items": 2, "entries": [{...}, {...}], "texts": {"0": {"instructions": 17}}}
+
+The entries (the list items, or the evaluation itself under "entry") keep
+all their fields but the long free-text ones, which `texts` maps by entry
+index and key to SnapshotBlob ids. Long texts, like the instructions and
+expected outcomes copied verbatim into every session's snapshot, are stored
+once per student in SnapshotBlob, compressed and addressed by the SHA-256
+of the text, so reassigning the same plan adds no text at all. The rest
+stays in the column, where Postgres compresses large values on its own.
+
+`format` marks the value as an envelope; a column value without it is
+rejected rather than guessed at. `items` is the document's length (list
+entries or evaluation keys) and the evaluation's `summary` carries the few
+fields report listings show, so listings never read the blobs.
+"""
+import hashlib
+import zlib
+
+SNAPSHOT_FORMAT = 'snapshot/1'
+
+# Shorter strings cost less inline than a blob row
+TEXT_MIN_LENGTH = 200
+
+# Evaluation fields copied into the envelope for report listings
+SUMMARY_FIELDS = ('final_diagnosis', 'intervention_priority', 'teacher_recommendations', 'parent_recommendations')
+
+
+def digest_text(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def compress_text(text):
+    return zlib.compress(text.encode(), 6)
+
+
+def decompress_text(data):
+    return zlib.decompress(bytes(data)).decode()
+
+
+def _is_long_text(value):
+    return isinstance(value, str) and len(value) >= TEXT_MIN_LENGTH
+
+
+def long_texts(document, texts):
+    """Add the long texts of a document's entries to the digest -> text map `texts`"""
+    for entry in [document] if isinstance(document, dict) else document:
+        if isinstance(entry, dict):
+            for value in entry.values():
+                if _is_long_text(value):
+                    texts[digest_text(value)] = value
+    return texts
+
+
+def _split(entries, text_ids):
+    """Return the entries without their long texts, and the {index: {key: id}} map of those"""
+    stripped, refs = [], {}
+    for index, entry in enumerate(entries):
+        if isinstance(entry, dict) and any(_is_long_text(value) for value in entry.values()):
+            refs[str(index)] = {key: text_ids[digest_text(value)] for key, value in entry.items() if _is_long_text(value)}
+            entry = {key: value for key, value in entry.items() if not _is_long_text(value)}
+        stripped.append(entry)
+    return stripped, refs
+
+
+def pack(document, text_ids):
+    """Return the envelope for `document`, its long texts replaced by their ids from a digest -> id map"""
+    envelope = {'format': SNAPSHOT_FORMAT, 'items': len(document)}
+    if isinstance(document, dict):
+        (envelope['entry'],), envelope['texts'] = _split([document], text_ids)
+        envelope['summary'] = {field: document[field] for field in SUMMARY_FIELDS if document.get(field) is not None}
+    else:
+        envelope['entries'], envelope['texts'] = _split(document, text_ids)
+    return envelope
+
+
+def _refs(envelope):
+    if not isinstance(envelope, dict) or envelope.get('format') != SNAPSHOT_FORMAT:
+        raise ValueError('Not a therapy snapshot envelope')
+    return envelope['texts']
+
+
+def text_ids(envelope):
+    """The ids of the texts an envelope refers to"""
+    return {text_id for refs in _refs(envelope).values() for text_id in refs.values()}
+
+
+def unpack(envelope, texts):
+    """The document of an envelope, from an id -> text map"""
+    refs = _refs(envelope)
+    entries = [envelope['entry']] if 'entry' in envelope else list(envelope['entries'])
+    for index, entry_refs in refs.items():
+        index = int(index)
+        entries[index] = {**entries[index], **{key: texts[text_id] for key, text_id in entry_refs.items()}}
+    return entries[0] if 'entry' in envelope else entries
@@ -1,3 +1,849 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+import threading
+from datetime import date, timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import caching, handwriting
+from .access import StudentAccess, access_cache_key
+from .models import User, Student, StudentUserLink, StageProgress, AssessmentSummary, ActivityAssignment, ActivityProgress, FinalEvaluation, TherapySessionReport, SnapshotBlob, Classroom, HandwritingSample, StudentTask
+
+
+def create_student(teacher, **kwargs):
+    defaults = {
+        'name': 'Student',
+        'birthday': date(2015, 1, 1),
+        'school': 'School',
+        'grade': '3',
+        'gender': 'other',
+    }
+    defaults.update(kwargs)
+    student = Student.objects.create(teacher=teacher, **defaults)
+    StageProgress.objects.create(student=student, current_stage=6, completed_stages=[1, 2, 3, 4, 5])
+    return student
+
+
+def create_activity(student, doctor, sessions=3, **kwargs):
+    defaults = {
+        'activity_name': 'Reading practice',
+        'activity_type': 'reading',
+        'description': 'Read aloud',
+        'instructions': 'Read one page',
+        'frequency': 'daily',
+        'duration_minutes': 15,
+        'target_audience': 'both',
+        'expected_outcomes': 'Better fluency',
+    }
+    defaults.update(kwargs)
+    activity = ActivityAssignment.objects.create(student=student, doctor=doctor, **defaults)
+    for day in range(sessions):
+        ActivityProgress.objects.create(
+            activity_assignment=activity,
+            recorder=student.teacher,
+            session_date=date(2025, 1, 1) + timedelta(days=day),
+            status='completed' if day % 2 == 0 else 'in_progress',
+            performer='teacher',
+        )
+    return activity
+
+
+@override_settings(STUDENT_AGGREGATE_CACHE_TTL=0)
+class QueryCountTestCase(TestCase):
+    """Helpers for pinning the number of queries an endpoint issues (with the aggregate cache off)"""
+
+    def count_queries(self, client, url):
+        with CaptureQueriesContext(connection) as context:
+            response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries), response
+
+
+class ActivityTrackingQueryTests(QueryCountTestCase):
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', 'teacher@example.com', 'pass', role='teacher')
+        self.doctor = User.objects.create_user('doctor', 'doctor@example.com', 'pass', role='doctor')
+        self.student = create_student(self.teacher)
+        self.client = APIClient()
+        self.client.force_authenticate(self.teacher)
+        self.url = f'/api/users/students/{self.student.student_id}/activities/tracking/'
+
+    def test_query_count_does_not_grow_with_activities(self):
+        create_activity(self.student, self.doctor)
+        baseline, _ = self.count_queries(self.client, self.url)
+
+        for index in range(10):
+            create_activity(self.student, self.doctor, sessions=5, activity_name=f'Activity {index}')
+        queries, response = self.count_queries(self.client, self.url)
+
+        self.assertEqual(queries, baseline)
+        self.assertEqual(len(response.data['activities']), 11)
+
+    def test_session_counts_and_progress_records(self):
+        activity = create_activity(self.student, self.doctor, sessions=5)
+        create_activity(self.student, self.doctor, sessions=2, activity_name='Inactive', is_active=False)
+
+        response = self.client.get(self.url)
+
+        activities = response.data['activities']
+        self.assertEqual(len(activities), 1)
+        self.assertEqual(activities[0]['id'], activity.id)
+        self.assertEqual(activities[0]['total_sessions'], 5)
+        self.assertEqual(activities[0]['completed_sessions'], 3)
+        self.assertEqual(
+            [record['session_date'] for record in activities[0]['progress_records']],
+            [str(date(2025, 1, 1) + timedelta(days=day)) for day in range(4, -1, -1)]
+        )
+        self.assertEqual(activities[0]['progress_records'][0]['activity_assignment']['id'], activity.id)
+
+
+class ComprehensiveStudentDataQueryTests(QueryCountTestCase):
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', 'teacher@example.com', 'pass', role='teacher')
+        self.doctor = User.objects.create_user('doctor', 'doctor@example.com', 'pass', role='doctor')
+        self.student = create_student(self.teacher)
+        self.client = APIClient()
+        self.client.force_authenticate(self.doctor)
+        self.url = f'/api/users/students/{self.student.student_id}/comprehensive-data/'
+
+    def add_tasks(self, count, scored=True):
+        for index in range(count):
+            self.student.tasks.create(task_name=f'Task {index}', max_score=10, score_obtained=5 if scored else None)
+
+    def test_query_count_does_not_grow_with_history(self):
+        create_activity(self.student, self.doctor)
+        self.add_tasks(1)
+        baseline, _ = self.count_queries(self.client, self.url)
+
+        for index in range(5):
+            create_activity(self.student, self.doctor, sessions=4, activity_name=f'Activity {index}')
+        self.add_tasks(5, scored=False)
+        queries, response = self.count_queries(self.client, self.url)
+
+        self.assertEqual(queries, baseline)
+        self.assertEqual(len(response.data['activity_assignments']), 6)
+        self.assertEqual(len(response.data['activity_progress']), 23)
+        self.assertEqual(response.data['task_performance']['total_tasks'], 6)
+        self.assertEqual(response.data['task_performance']['completed_tasks'], 1)
+        self.assertIsNone(response.data['assessment_summary'])
+
+    def test_fields_selector_limits_sections_and_queries(self):
+        create_activity(self.student, self.doctor)
+        full_queries, _ = self.count_queries(self.client, self.url)
+        queries, response = self.count_queries(self.client, self.url + '?fields=student,task_performance')
+
+        self.assertEqual(set(response.data), {'student', 'task_performance'})
+        self.assertLess(queries, full_queries)
+
+    def test_unknown_field_is_rejected(self):
+        create_activity(self.student, self.doctor)
+        response = self.client.get(self.url + '?fields=student,bogus')
+        self.assertEqual(response.status_code, 400)
+
+    def test_doctor_without_assignments_is_forbidden(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 403)
+
+
+class StudentListingQueryTests(QueryCountTestCase):
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', 'teacher@example.com', 'pass', role='teacher')
+        self.doctor = User.objects.create_user('doctor', 'doctor@example.com', 'pass', role='doctor')
+        self.parent = User.objects.create_user('parent', 'parent@example.com', 'pass', role='parent')
+        self.classroom = Classroom.objects.create(name='Class A', teacher=self.teacher)
+        self.client = APIClient()
+        self.client.force_authenticate(self.teacher)
+
+    def add_students(self, count, classroom=None):
+        for index in range(count):
+            student = create_student(self.teacher, name=f'Student {index}', classroom=classroom)
+            StudentUserLink.objects.create(student=student, user=self.teacher)
+            StudentUserLink.objects.create(student=student, user=self.doctor, role='doctor')
+            StudentUserLink.objects.create(student=student, user=self.parent, role='parent')
+
+    def assert_constant_queries(self, url, classroom=None):
+        self.add_students(1, classroom)
+        baseline, _ = self.count_queries(self.client, url)
+
+        self.add_students(10, classroom)
+        queries, response = self.count_queries(self.client, url)
+
+        self.assertEqual(queries, baseline)
+        return response
+
+    def test_classroom_students(self):
+        response = self.assert_constant_queries(f'/api/users/classrooms/{self.classroom.id}/students/', self.classroom)
+        self.assertEqual(response.data['total_students'], 11)
+        self.assertEqual(len(response.data['students'][0]['linked_users']), 3)
+        self.assertEqual(response.data['students'][0]['stage_progress']['current_stage'], 6)
+        self.assertEqual(response.data['students'][0]['classroom_name'], 'Class A')
+
+    def test_unassigned_students(self):
+        response = self.assert_constant_queries('/api/users/students/unassigned/')
+        self.assertEqual(response.data['total_students'], 11)
+
+    def test_student_list(self):
+        response = self.assert_constant_queries('/api/users/students/')
+        self.assertEqual(len(response.data), 11)
+        self.assertFalse(response.data[0]['case_completed'])
+
+
+class BulkTaskTests(TestCase):
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', 'teacher@example.com', 'pass', role='teacher')
+        self.doctor = User.objects.create_user('doctor', 'doctor@example.com', 'pass', role='doctor')
+        self.student = create_student(self.teacher)
+        StudentUserLink.objects.create(student=self.student, user=self.doctor, role='doctor')
+        self.client = APIClient()
+        self.base_url = f'/api/users/students/{self.student.student_id}/'
+
+    def test_add_tasks_is_all_or_nothing(self):
+        self.client.force_authenticate(self.doctor)
+        tasks = [{'task_name': f'Task {index}', 'max_score': 10} for index in range(3)]
+        response = self.client.post(self.base_url + 'add_tasks/', {'tasks': tasks + [{'task_name': 'Broken'}]}, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'max_score': ['This field is required.']})
+        self.assertFalse(self.student.tasks.exists())
+
+        response = self.client.post(self.base_url + 'add_tasks/', {'tasks': tasks}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([task['task_name'] for task in response.data['tasks']], ['Task 0', 'Task 1', 'Task 2'])
+        self.assertTrue(all(task['id'] for task in response.data['tasks']))
+
+    def test_score_tasks_validates_before_writing(self):
+        tasks = [self.student.tasks.create(task_name=f'Task {index}', max_score=10) for index in range(40)]
+        self.client.force_authenticate(self.teacher)
+
+        scores = [{'task_id': task.id, 'score': 5} for task in tasks]
+        response = self.client.post(self.base_url + 'score_tasks/', {'task_scores': scores + [{'task_id': tasks[0].id, 'score': 11}]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], "Score 11 for task 'Task 0' must be between 0 and 10")
+        self.assertFalse(self.student.tasks.filter(score_obtained__isnull=False).exists())
+
+        response = self.client.post(self.base_url + 'score_tasks/', {'task_scores': [{'task_id': 0, 'score': 1}]}, format='json')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.data['error'], 'Task with id 0 not found for this student.')
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(self.base_url + 'score_tasks/', {'task_scores': scores}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertLess(len(context.captured_queries), 10)
+        self.assertEqual(self.student.tasks.filter(score_obtained=5).count(), 40)
+
+
+class BulkActivityAssignmentTests(TestCase):
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', 'teacher@example.com', 'pass', role='teacher')
+        self.doctor = User.objects.create_user('doctor', 'doctor@example.com', 'pass', role='doctor')
+        self.student = create_student(self.teacher)
+        StudentUserLink.objects.create(student=self.student, user=self.doctor, role='doctor')
+        AssessmentSummary.objects.create(
+            student=self.student, doctor=self.doctor, cutoff_percentage=50, total_score=3,
+            total_max_score=10, percentage_score=30, risk_level='high'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.doctor)
+        self.url = f'/api/users/students/{self.student.student_id}/assign_activities/'
+
+    def activity(self, index):
+        return {
+            'activity_name': f'Activity {index}',
+            'activity_type': 'reading',
+            'description': 'Read aloud',
+            'instructions': 'Read one page',
+            'frequency': 'daily',
+            'duration_minutes': 15,
+            'target_audience': 'both',
+            'expected_outcomes': 'Better fluency',
+        }
+
+    def assign(self, count):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(self.url, {'activities': [self.activity(index) for index in range(count)]}, format='json')
+        self.assertEqual(response.status_code, 201)
+        return len(context.captured_queries), response
+
+    def test_fixed_query_count_for_large_plans(self):
+        small, _ = self.assign(1)
+        large, response = self.assign(60)
+
+        self.assertEqual(large, small)
+        self.assertEqual(len(response.data['activities']), 60)
+        self.assertTrue(all(activity['id'] and activity['created_at'] for activity in response.data['activities']))
+        self.assertEqual(response.data['activities'][0]['doctor'], self.doctor.id)
+
+    def test_invalid_activity_rejects_whole_plan(self):
+        activities = [self.activity(index) for index in range(3)]
+        activities[2]['activity_type'] = 'unknown'
+        response = self.client.post(self.url, {'activities': activities}, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('activity_type', response.data['error'])
+        self.assertFalse(ActivityAssignment.objects.exists())
+
+
+class TherapyResetTests(TestCase):
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', 'teacher@example.com', 'pass', role='teacher')
+        self.doctor = User.objects.create_user('doctor', 'doctor@example.com', 'pass', role='doctor')
+        self.student = create_student(self.teacher)
+        StudentUserLink.objects.create(student=self.student, user=self.doctor, role='doctor')
+        for index in range(3):
+            create_activity(self.student, self.doctor, sessions=4, activity_name=f'Activity {index}')
+        self.student.tasks.create(task_name='Task', max_score=10, score_obtained=5)
+        FinalEvaluation.objects.create(
+            student=self.student, doctor=self.doctor, handwriting_analysis_summary='-',
+            task_performance_summary='-', activity_progress_summary='-', final_diagnosis='mild_dyslexia',
+            supporting_evidence='-', intervention_priority='medium', short_term_goals='-',
+            long_term_goals='-', recommended_interventions='-', follow_up_timeline='-', monitoring_indicators='-'
+        )
+        self.client = APIClient()
+
+    def test_terminate_progress_clears_everything(self):
+        self.client.force_authenticate(self.teacher)
+        response = self.client.post(
+            f'/api/users/students/{self.student.student_id}/terminate_progress/',
+            {'confirm_termination': True}, format='json'
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(ActivityProgress.objects.exists())
+        self.assertFalse(ActivityAssignment.objects.exists())
+        self.assertFalse(self.student.tasks.exists())
+        self.assertFalse(FinalEvaluation.objects.exists())
+        self.assertEqual(StageProgress.objects.get(student=self.student).current_stage, 1)
+
+    def test_restart_therapy_snapshots_then_clears_activity_plan(self):
+        self.client.force_authenticate(self.doctor)
+        response = self.client.post(f'/api/users/students/{self.student.student_id}/restart-therapy/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['new_session_number'], 2)
+        self.assertFalse(ActivityProgress.objects.exists())
+        self.assertFalse(ActivityAssignment.objects.exists())
+        report = TherapySessionReport.objects.get(student=self.student)
+        self.assertEqual(len(report.get_snapshot()[1]), 12)
+        self.assertEqual(StageProgress.objects.get(student=self.student).current_stage, 5)
+
+
+class TherapySnapshotStorageTests(TestCase):
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', 'teacher@example.com', 'pass', role='teacher')
+        self.doctor = User.objects.create_user('doctor', 'doctor@example.com', 'pass', role='doctor')
+        self.student = create_student(self.teacher)
+        StudentUserLink.objects.create(student=self.student, user=self.doctor, role='doctor')
+        self.instructions = 'Read one page aloud, then retell the story in your own words. ' * 5
+        create_activity(self.student, self.doctor, sessions=2, instructions=self.instructions)
+
+    def test_repeated_texts_are_stored_once_and_rebuilt_on_read(self):
+        first = TherapySessionReport.create_report_from_current_data(self.student)
+        blobs_after_first = SnapshotBlob.objects.filter(student=self.student).count()
+        # A restart reassigns the same plan as new rows
+        self.student.clear_activity_plan()
+        create_activity(self.student, self.doctor, sessions=3, instructions=self.instructions)
+        second = TherapySessionReport.create_report_from_current_data(self.student)
+
+        self.assertEqual(blobs_after_first, 1)
+        self.assertEqual(SnapshotBlob.objects.filter(student=self.student).count(), 1)
+        self.assertEqual(second.activity_progress_data['format'], 'snapshot/1')
+        self.assertEqual(second.activity_progress_data['items'], 3)
+        self.assertNotIn(self.instructions, str(second.activity_assignments_data))
+
+        assignments, progress, evaluation = TherapySessionReport.objects.get(pk=second.pk).get_snapshot()
+        self.assertEqual(assignments[0]['instructions'], self.instructions)
+        self.assertEqual(assignments[0]['activity_name'], 'Reading practice')
+        self.assertEqual(len(progress), 3)
+        self.assertEqual(evaluation, {})
+
+        client = APIClient()
+        client.force_authenticate(self.doctor)
+        response = client.get(f'/api/users/students/{self.student.student_id}/therapy-reports/{first.session_number}/')
+        self.assertEqual(response.data['activity_assignments'][0]['instructions'], self.instructions)
+
+    def test_documents_round_trip_whatever_their_keys(self):
+        documents = (
+            [{'$blob': 'not a reference', 'notes': self.instructions}, 'plain'],
+            [],
+            {'format': 'snapshot/1', 'entry': 'x', 'goals': self.instructions},
+        )
+        envelopes = TherapySessionReport.compact_snapshot(self.student, *documents)
+        report = TherapySessionReport(student=self.student, activity_assignments_data=envelopes[0],
+                                      activity_progress_data=envelopes[1], final_evaluation_data=envelopes[2])
+
+        self.assertEqual(TherapySessionReport.expand_snapshots([report])[report.pk], documents)
+        # A column value that is not an envelope is an error, not a document
+        report.activity_assignments_data = documents[0]
+        with self.assertRaises(ValueError):
+            report.get_snapshot()
+
+
+class TherapyReportListingTests(TestCase):
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', 'teacher@example.com', 'pass', role='teacher')
+        self.doctor = User.objects.create_user('doctor', 'doctor@example.com', 'pass', role='doctor')
+        self.student = create_student(self.teacher)
+        StudentUserLink.objects.create(student=self.student, user=self.doctor, role='doctor')
+        self.url = f'/api/users/students/{self.student.student_id}/therapy-reports/'
+
+        create_activity(self.student, self.doctor, sessions=4, instructions='Trace each letter twice. ' * 10)
+        FinalEvaluation.objects.create(
+            student=self.student, doctor=self.doctor, handwriting_analysis_summary='Summary',
+            task_performance_summary='Summary', activity_progress_summary='Summary',
+            final_diagnosis='mild_dyslexia', supporting_evidence='Evidence', intervention_priority='medium',
+            short_term_goals='Goals', long_term_goals='Goals', recommended_interventions='Interventions',
+            follow_up_timeline='Monthly', monitoring_indicators='Indicators'
+        )
+        for _ in range(5):
+            TherapySessionReport.create_report_from_current_data(self.student)
+
+    def get(self, user, params=''):
+        client = APIClient()
+        client.force_authenticate(user)
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(self.url + params)
+        return response, [query['sql'] for query in queries.captured_queries]
+
+    def test_teacher_listing_extracts_summary_in_database(self):
+        response, queries = self.get(self.teacher)
+
+        self.assertEqual(response.status_code, 200)
+        report = response.data['reports'][0]
+        self.assertEqual(report['total_activities'], 1)
+        self.assertEqual(report['progress_records'], 4)
+        self.assertEqual(report['diagnosis'], 'mild_dyslexia')
+        self.assertEqual(report['intervention_priority'], 'medium')
+        self.assertEqual(report['recommendations'], 'Not available')
+
+        report_query = next(sql for sql in queries if 'summary' in sql)
+        for column in ('activity_assignments_data', 'activity_progress_data', 'final_evaluation_data'):
+            self.assertNotRegex(report_query, rf'"{column}"\s*(,|FROM)')
+
+    def test_keyset_pagination_over_session_number(self):
+        response, _ = self.get(self.doctor, '?limit=2')
+        self.assertEqual([report['session_number'] for report in response.data['reports']], [5, 4])
+        self.assertEqual(response.data['total_sessions'], 5)
+        self.assertEqual(response.data['next_before'], 4)
+        self.assertIn('Trace each letter', response.data['reports'][0]['activity_assignments_data'][0]['instructions'])
+
+        response, _ = self.get(self.teacher, '?limit=2&before=2')
+        self.assertEqual([report['session_number'] for report in response.data['reports']], [1])
+        self.assertIsNone(response.data['next_before'])
+
+        response, _ = self.get(self.teacher, '?limit=zero')
+        self.assertEqual(response.status_code, 400)
+
+
+class ActivityProgressHistoryTests(QueryCountTestCase):
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', 'teacher@example.com', 'pass', role='teacher')
+        self.doctor = User.objects.create_user('doctor', 'doctor@example.com', 'pass', role='doctor')
+        self.student = create_student(self.teacher)
+        self.activity = create_activity(self.student, self.doctor, sessions=10)
+        self.url = f'/api/users/students/{self.student.student_id}/activities/{self.activity.id}/history/'
+        self.client = APIClient()
+        self.client.force_authenticate(self.teacher)
+
+    def test_keyset_pages_cover_history_without_gaps(self):
+        # Parent sessions on the same dates exercise the id tie-breaker
+        for record in self.activity.progress_records.all()[:4]:
+            ActivityProgress.objects.create(
+                activity_assignment=self.activity, recorder=self.teacher, session_date=record.session_date,
+                status='completed', performer='parent'
+            )
+        expected = list(self.activity.progress_records.order_by('-session_date', '-id').values_list('id', flat=True))
+
+        seen, before = [], ''
+        while True:
+            response = self.client.get(f'{self.url}?limit=3{before}')
+            self.assertEqual(response.status_code, 200)
+            seen += [record['id'] for record in response.data['progress_history']]
+            if not response.data['next_before']:
+                break
+            before = f"&before={response.data['next_before']}"
+
+        self.assertEqual(seen, expected)
+        queries, _ = self.count_queries(self.client, f'{self.url}?limit=3')
+        self.assertEqual(self.count_queries(self.client, f'{self.url}?limit=9')[0], queries)
+
+    def test_history_without_limit_is_paginated(self):
+        ActivityProgress.objects.bulk_create(
+            ActivityProgress(
+                activity_assignment=self.activity, recorder=self.teacher, status='completed', performer='teacher',
+                session_date=date(2025, 2, 1) + timedelta(days=day)
+            )
+            for day in range(50)
+        )
+
+        response = self.client.get(self.url)
+        self.assertEqual(len(response.data['progress_history']), 50)
+        self.assertIsNotNone(response.data['next_before'])
+
+        response = self.client.get(f"{self.url}?before={response.data['next_before']}")
+        self.assertEqual(len(response.data['progress_history']), 10)
+        self.assertIsNone(response.data['next_before'])
+
+    def test_filters_and_summary_are_computed_in_database(self):
+        records = list(self.activity.progress_records.order_by('session_date'))
+        records[0].status = 'missed'
+        records[0].save()
+        date_from = records[1].session_date.isoformat()
+
+        response = self.client.get(f'{self.url}?date_from={date_from}&status=completed,in_progress')
+        self.assertEqual(len(response.data['progress_history']), 9)
+
+        response = self.client.get(f'{self.url}?summary=true&date_from={date_from}')
+        summary = response.data['summary']
+        self.assertEqual(summary['total_sessions'], 9)
+        self.assertIn('average_score', summary)
+        self.assertIn('average_engagement', summary)
+        self.assertNotIn('progress_history', response.data)
+
+        response = self.client.get(f'{self.url}?summary=true')
+        self.assertEqual(response.data['summary']['completion_rate'], round(response.data['summary']['completed_sessions'] / 10 * 100, 1))
+
+        self.assertEqual(self.client.get(f'{self.url}?status=done').status_code, 400)
+        self.assertEqual(self.client.get(f'{self.url}?before=yesterday').status_code, 400)
+
+
+class StudentAccessTests(TestCase):
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', 'teacher@example.com', 'pass', role='teacher')
+        self.parent = User.objects.create_user('parent', 'parent@example.com', 'pass', role='parent')
+        self.students = [create_student(self.teacher, name=f'Student {index}') for index in range(3)]
+        self.link = StudentUserLink.objects.create(student=self.students[0], user=self.parent, role='parent')
+        self.url = f'/api/users/students/{self.students[0].student_id}/therapy-reports/'
+        self.client = APIClient()
+        self.client.force_authenticate(self.parent)
+        cache.clear()
+
+    def link_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        return response, [query for query in queries.captured_queries if 'users_studentuserlink' in query['sql']]
+
+    def test_links_are_loaded_once(self):
+        access = StudentAccess(self.parent)
+        with self.assertNumQueries(1):
+            self.assertTrue(access.is_linked(self.students[0], role='parent'))
+            self.assertFalse(access.is_linked(self.students[0], role='doctor'))
+            self.assertFalse(access.is_linked(self.students[1]))
+            self.assertFalse(access.is_teacher_of(self.students[0]))
+
+    @override_settings(STUDENT_ACCESS_CACHE_TTL=60)
+    def test_cross_request_cache_is_invalidated_by_link_changes(self):
+        response, queries = self.link_queries()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 1)
+
+        response, queries = self.link_queries()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries, [])
+
+        self.link.student = self.students[1]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.link.save()
+        response, _ = self.link_queries()
+        self.assertEqual(response.status_code, 403)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.link.delete()
+        self.url = f'/api/users/students/{self.students[1].student_id}/therapy-reports/'
+        response, _ = self.link_queries()
+        self.assertEqual(response.status_code, 403)
+
+    @override_settings(STUDENT_ACCESS_CACHE_TTL=60)
+    def test_removed_link_grants_no_access_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                self.link.delete()
+                # A concurrent request before the commit still sees the link and caches it
+                cache.set(access_cache_key(self.parent.id), {self.students[0].pk: 'parent'})
+
+        response, _ = self.link_queries()
+        self.assertEqual(response.status_code, 403)
+
+
+class StudentAggregateCacheTests(QueryCountTestCase):
+    def setUp(self):
+        cache.clear()
+        self.teacher = User.objects.create_user('teacher', 'teacher@example.com', 'pass', role='teacher')
+        self.doctor = User.objects.create_user('doctor', 'doctor@example.com', 'pass', role='doctor')
+        self.student = create_student(self.teacher)
+        StudentUserLink.objects.create(student=self.student, user=self.doctor, role='doctor')
+        self.activity = create_activity(self.student, self.doctor, sessions=3)
+        self.teacher_client = APIClient()
+        self.teacher_client.force_authenticate(self.teacher)
+        self.doctor_client = APIClient()
+        self.doctor_client.force_authenticate(self.doctor)
+        self.tracking_url = f'/api/users/students/{self.student.student_id}/activities/tracking/'
+
+    def tracking(self, client):
+        return self.count_queries(client, self.tracking_url)
+
+    @override_settings(STUDENT_AGGREGATE_CACHE_TTL=60, STUDENT_AGGREGATE_CACHE_STATS=True)
+    def test_repeated_requests_hit_cache_per_viewer_role(self):
+        cold, response = self.tracking(self.teacher_client)
+        warm, cached = self.tracking(self.teacher_client)
+        self.assertLess(warm, cold)
+        self.assertEqual(cached.data, response.data)
+
+        # Another role gets its own entry
+        _, response = self.tracking(self.doctor_client)
+        self.assertEqual(len(response.data['activities']), 1)
+
+        staff = User.objects.create_user('admin', 'admin@example.com', 'pass', role='teacher', is_staff=True)
+        self.teacher_client.force_authenticate(staff)
+        stats = self.teacher_client.get('/api/users/cache-stats/').data
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+        self.assertEqual(self.doctor_client.get('/api/users/cache-stats/').status_code, 403)
+
+    @override_settings(STUDENT_AGGREGATE_CACHE_TTL=60)
+    def test_writes_invalidate_cached_aggregates(self):
+        self.tracking(self.teacher_client)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.teacher_client.post(f'/api/users/students/{self.student.student_id}/activities/progress/', {
+                'activity_assignment': self.activity.id, 'session_date': '2025-02-01', 'status': 'completed',
+            })
+        self.assertEqual(response.status_code, 201)
+        _, response = self.tracking(self.teacher_client)
+        self.assertEqual(response.data['activities'][0]['total_sessions'], 4)
+
+        # Raw deletes bypass signals and invalidate explicitly
+        with self.captureOnCommitCallbacks(execute=True):
+            self.student.clear_activity_plan()
+        _, response = self.tracking(self.teacher_client)
+        self.assertEqual(response.data['activities'], [])
+
+        # So do bulk inserts
+        with self.captureOnCommitCallbacks(execute=True):
+            create_activity(self.student, self.doctor, sessions=0)
+        comprehensive_url = f'/api/users/students/{self.student.student_id}/comprehensive-data/?fields=task_performance'
+        _, response = self.count_queries(self.doctor_client, comprehensive_url)
+        self.assertEqual(response.data['task_performance']['total_tasks'], 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.doctor_client.post(f'/api/users/students/{self.student.student_id}/add_tasks/', {
+                'tasks': [{'task_name': 'Spelling', 'max_score': 10}]
+            }, format='json')
+        self.assertEqual(response.status_code, 201)
+        _, response = self.count_queries(self.doctor_client, comprehensive_url)
+        self.assertEqual(response.data['task_performance']['total_tasks'], 1)
+
+        # Counters are off by default: lookups write nothing else to the cache
+        self.assertIsNone(cache.get(caching.HITS_KEY))
+        self.assertIsNone(cache.get(caching.MISSES_KEY))
+
+    @override_settings(STUDENT_AGGREGATE_CACHE_TTL=60)
+    def test_aggregate_rebuilt_before_commit_is_not_served_after_it(self):
+        def aggregate(value):
+            return caching.cached_student_aggregate(self.student.pk, 'tasks', ('teacher',), lambda: value)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                StudentTask.objects.create(student=self.student, task_name='Spelling', max_score=10)
+                # A concurrent request still sees the pre-commit rows and caches what it built from them
+                self.assertEqual(aggregate('pre-commit'), 'pre-commit')
+
+        self.assertEqual(aggregate('after'), 'after')
+
+
+ML_RESULT = {'dyslexia_score': 42.0, 'interpretation': 'Moderate', 'letter_counts': {'b': 3}}
+
+
+class HandwritingTestCase(TestCase):
+    """Uploads land in a throwaway MEDIA_ROOT and the ML service is mocked"""
+
+    def setUp(self):
+        cache.clear()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        patcher = mock.patch.object(handwriting, 'call_ml_service', return_value=dict(ML_RESULT))
+        self.ml_service = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.teacher = User.objects.create_user('teacher', 'teacher@example.com', 'pass', role='teacher')
+        self.client = APIClient()
+        self.client.force_authenticate(self.teacher)
+
+    def image(self, content=b'handwriting', name='sample.png'):
+        return SimpleUploadedFile(name, content, content_type='image/png')
+
+
+class HandwritingIdempotencyTests(HandwritingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.student = create_student(self.teacher)
+        self.save_url = f'/api/users/students/{self.student.student_id}/save_handwriting_sample/'
+
+    def save(self, content=b'handwriting', key='key-1'):
+        return self.client.post(self.save_url, {'image': self.image(content)}, HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_replayed_idempotency_key_returns_existing_sample(self):
+        first = self.save()
+        replay = self.save()
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(replay.status_code, 200)
+        self.assertEqual(replay.data['id'], first.data['id'])
+        self.assertEqual(HandwritingSample.objects.count(), 1)
+        self.ml_service.assert_called_once()
+
+        # A new key for the same image is a deliberate second sample, from the cached analysis
+        self.assertEqual(self.save(key='key-2').status_code, 201)
+        self.assertEqual(HandwritingSample.objects.count(), 2)
+        self.ml_service.assert_called_once()
+
+    def test_save_reuses_preview_from_analysis(self):
+        preview = self.client.post(
+            f'/api/users/students/{self.student.student_id}/analyze-handwriting/',
+            {'image': self.image(), 'temp_analysis': True}
+        )
+        self.assertEqual(preview.status_code, 200)
+        self.assertEqual(HandwritingSample.objects.count(), 0)
+
+        response = self.save()
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['dyslexia_score'], ML_RESULT['dyslexia_score'])
+        self.assertEqual(response.data['image_hash'], preview.data['image_hash'])
+        self.ml_service.assert_called_once()
+
+    def test_concurrent_insert_returns_the_winner(self):
+        image_hash = handwriting.hash_image(b'handwriting')
+        winner = HandwritingSample.objects.create(
+            student=self.student, image=self.image(), image_hash=image_hash, idempotency_key='key-1', **ML_RESULT
+        )
+        # The loser checked for a saved sample before the winner committed
+        lookups = iter([lambda *args: None, handwriting.find_saved_sample])
+        with mock.patch.object(handwriting, 'find_saved_sample', side_effect=lambda *args: next(lookups)(*args)):
+            sample, created = handwriting.save_sample(self.student, self.image(), image_hash, 'key-1', dict(ML_RESULT))
+
+        self.assertFalse(created)
+        self.assertEqual(sample.pk, winner.pk)
+        self.assertEqual(HandwritingSample.objects.count(), 1)
+
+
+@override_settings(HANDWRITING_BATCH_WORKERS=1)
+class ClassroomHandwritingBatchTests(HandwritingTestCase):
+    """Driven through the async client, which reads the stream as an ASGI server does"""
+
+    def setUp(self):
+        super().setUp()
+        self.classroom = Classroom.objects.create(name='Class A', teacher=self.teacher)
+        self.students = [create_student(self.teacher, name=f'Student {index}', classroom=self.classroom) for index in range(3)]
+        self.url = f'/api/users/classrooms/{self.classroom.id}/students/analyze-handwriting/'
+
+    async def upload(self, images):
+        response = await self.async_client.post(
+            self.url, images, headers={'Authorization': f'Bearer {AccessToken.for_user(self.teacher)}'}
+        )
+        self.assertEqual(response.status_code, 200)
+        return (json.loads(line) async for line in response.streaming_content)
+
+    async def test_streams_duplicates_failures_and_saved_samples_then_complete(self):
+        first, second, third = self.students
+        await HandwritingSample.objects.acreate(
+            student=first, image=self.image(b'first'), image_hash=handwriting.hash_image(b'first'), **ML_RESULT
+        )
+
+        def analyze(name, image_data, content_type):
+            if name == 'third.png':
+                raise handwriting.MLServiceError(503, 'overloaded')
+            return dict(ML_RESULT)
+
+        self.ml_service.side_effect = analyze
+        events = [event async for event in await self.upload({
+            f'image_{first.student_id}': self.image(b'first'),
+            f'image_{second.student_id}': self.image(b'second'),
+            f'image_{third.student_id}': self.image(b'third', name='third.png'),
+            'image_999999': self.image(b'stranger'),
+        })]
+
+        progress, complete = events[:-1], events[-1]
+        self.assertEqual([(event['student_id'], event['status']) for event in progress[:2]],
+                         [(999999, 'failed'), (first.student_id, 'duplicate')])
+        self.assertEqual(sorted((event['student_id'], event['status']) for event in progress[2:]),
+                         [(second.student_id, 'saved'), (third.student_id, 'failed')])
+        self.assertEqual([event['completed'] for event in progress], [1, 2, 3, 4])
+        self.assertEqual(complete['event'], 'complete')
+        self.assertEqual((complete['total'], complete['saved'], complete['duplicates'], complete['failed']), (4, 1, 1, 2))
+        saved = next(event for event in progress if event['status'] == 'saved')
+        self.assertEqual((await HandwritingSample.objects.aget(student=second)).pk, saved['sample_id'])
+        self.assertEqual(self.ml_service.call_count, 2)
+
+    @override_settings(HANDWRITING_BATCH_WORKERS=2)
+    async def test_each_result_is_sent_while_the_batch_is_still_running(self):
+        first, second, _ = self.students
+        release = threading.Event()
+
+        def analyze(name, image_data, content_type):
+            if image_data == b'slow':
+                self.assertTrue(release.wait(timeout=5))
+            return dict(ML_RESULT)
+
+        self.ml_service.side_effect = analyze
+        events = await self.upload({
+            f'image_{first.student_id}': self.image(b'fast'),
+            f'image_{second.student_id}': self.image(b'slow'),
+        })
+
+        # The fast result arrives, already saved, while the slow analysis is still blocked
+        event = await anext(events)
+        self.assertEqual((event['student_id'], event['status']), (first.student_id, 'saved'))
+        self.assertEqual([pk async for pk in HandwritingSample.objects.values_list('pk', flat=True)], [event['sample_id']])
+
+        release.set()
+        rest = [event async for event in events]
+        self.assertEqual([(event['student_id'], event['status']) for event in rest[:-1]], [(second.student_id, 'saved')])
+        self.assertEqual(rest[-1]['saved'], 2)
+
+    async def test_samples_are_saved_before_they_are_reported(self):
+        events = await self.upload({f'image_{student.student_id}': self.image(f'{student.pk}'.encode()) for student in self.students})
+
+        # The client goes away after the first event: the stream is never resumed
+        event = await anext(events)
+
+        self.assertEqual(event['status'], 'saved')
+        self.assertEqual([pk async for pk in HandwritingSample.objects.values_list('pk', flat=True)], [event['sample_id']])
+
+    async def test_lost_race_reports_duplicate_and_keeps_no_orphan_file(self):
+        student = self.students[0]
+        image_hash = handwriting.hash_image(b'page')
+        winner = await HandwritingSample.objects.acreate(student=student, image=self.image(b'page'), image_hash=image_hash, **ML_RESULT)
+        stored = set(os.listdir(os.path.dirname(winner.image.path)))
+
+        # The batch's up-front duplicate check ran before the winner committed, so
+        # its bulk INSERT fails and the per-sample fallback finds the winner
+        with mock.patch.object(HandwritingSample.objects, 'filter', wraps=HandwritingSample.objects.filter) as lookup:
+            lookup.side_effect = [HandwritingSample.objects.none(), HandwritingSample.objects.none(),
+                                  HandwritingSample.objects.filter(pk=winner.pk)]
+            events = [event async for event in await self.upload({f'image_{student.student_id}': self.image(b'page')})]
+
+        self.assertEqual((events[0]['status'], events[0]['sample_id']), ('duplicate', winner.pk))
+        self.assertEqual(events[-1]['duplicates'], 1)
+        self.assertEqual(await HandwritingSample.objects.acount(), 1)
+        self.assertEqual(set(os.listdir(os.path.dirname(winner.image.path))), stored)
+
+    def test_analyses_finished_together_are_saved_with_one_insert(self):
+        analyzed = [
+            (student, 'page.png', f'{student.pk}'.encode(), handwriting.hash_image(f'{student.pk}'.encode()), dict(ML_RESULT))
+            for student in self.students
+        ]
+
+        with CaptureQueriesContext(connection) as context:
+            saved = handwriting.save_samples(analyzed)
+
+        self.assertEqual(sum(query['sql'].startswith('INSERT') for query in context.captured_queries), 1)
+        self.assertEqual([(sample.student_id, created) for sample, created in saved], [(student.pk, True) for student in self.students])
+        self.assertTrue(all(os.path.exists(sample.image.path) for sample, _ in saved))
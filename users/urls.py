@@ -6,12 +6,12 @@ from .views import (UserListCreateView, RegisterView, ProfileView, PasswordChang
                    get_student_activities_for_tracking, record_activity_progress, 
                    get_activity_progress_history, update_activity_progress,
                    get_comprehensive_student_data, final_evaluation_view, 
-                   complete_final_evaluation, get_evaluation_summary,
+                   complete_final_evaluation, get_evaluation_summary, student_aggregate_cache_stats,
                    terminate_therapy_session, restart_therapy_from_stage5,
                    get_therapy_session_reports, get_detailed_therapy_report,
                    stakeholder_recommendations_view, get_all_stakeholder_recommendations,
                    ClassroomListCreateView, ClassroomDetailView, ClassroomStudentsView,
-                   ClassroomStudentRemoveView, UnassignedStudentsView)
+                   ClassroomHandwritingBatchView, ClassroomStudentRemoveView, UnassignedStudentsView)
 from rest_framework.routers import DefaultRouter
 
 router = DefaultRouter()
@@ -49,6 +49,7 @@ urlpatterns = [
     path('students/<int:student_id>/final-evaluation/', final_evaluation_view, name='final-evaluation'),
     path('students/<int:student_id>/complete-evaluation/', complete_final_evaluation, name='complete-final-evaluation'),
     path('students/<int:student_id>/evaluation-summary/', get_evaluation_summary, name='evaluation-summary'),
+    path('cache-stats/', student_aggregate_cache_stats, name='student-aggregate-cache-stats'),
     
     # Therapy Session Management URLs
     path('students/<int:student_id>/terminate-therapy/', terminate_therapy_session, name='terminate-therapy'),
@@ -66,5 +67,6 @@ urlpatterns = [
     path('classrooms/', ClassroomListCreateView.as_view(), name='classroom-list-create'),
     path('classrooms/<int:pk>/', ClassroomDetailView.as_view(), name='classroom-detail'),
     path('classrooms/<int:classroom_id>/students/', ClassroomStudentsView.as_view(), name='classroom-students'),
+    path('classrooms/<int:classroom_id>/students/analyze-handwriting/', ClassroomHandwritingBatchView.as_view(), name='classroom-batch-analyze-handwriting'),
     path('classrooms/<int:classroom_id>/students/<int:student_id>/', ClassroomStudentRemoveView.as_view(), name='classroom-student-remove'),
 ]
@@ -3,19 +3,28 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.decorators import api_view, permission_classes
 from .models import User, Student, StudentUserLink, StageProgress, HandwritingSample, StudentTask, AssessmentSummary, ActivityAssignment, ActivityProgress, FinalEvaluation, TherapySessionReport, StakeholderRecommendation, Classroom
-from .serializers import UserSerializer, RegisterSerializer, ProfileSerializer, ProfileUpdateSerializer, PasswordChangeSerializer, StudentSerializer, StudentUserLinkSerializer, LinkedUserSerializer, MyTokenObtainPairSerializer, HandwritingSampleSerializer, StudentTaskSerializer, AssessmentSummarySerializer, ActivityAssignmentSerializer, ActivityProgressSerializer, ActivityProgressCreateSerializer, FinalEvaluationSerializer, FinalEvaluationCreateSerializer, StakeholderRecommendationSerializer, StakeholderRecommendationCreateSerializer, ClassroomSerializer, ClassroomCreateUpdateSerializer, StudentClassroomSerializer
-from rest_framework.permissions import IsAuthenticated
+from .serializers import UserSerializer, RegisterSerializer, ProfileSerializer, ProfileUpdateSerializer, PasswordChangeSerializer, StudentSerializer, StudentUserLinkSerializer, LinkedUserSerializer, MyTokenObtainPairSerializer, HandwritingSampleSerializer, StudentTaskSerializer, AssessmentSummarySerializer, ActivityAssignmentSerializer, ActivityProgressSerializer, ActivityProgressCreateSerializer, FinalEvaluationSerializer, FinalEvaluationCreateSerializer, StakeholderRecommendationSerializer, StakeholderRecommendationCreateSerializer, ClassroomSerializer, ClassroomCreateUpdateSerializer, StudentClassroomSerializer, TaskScoreSerializer
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from .permissions import IsTeacherOrReadOnly, IsLinkedDoctorOrParentReadOnly
+from .access import get_student_access
+from .aggregates import COMPREHENSIVE_SECTIONS, build_comprehensive_data, get_comprehensive_student, get_doctor_access, parse_sections
+from .caching import aggregate_cache_stats, cached_student_aggregate, invalidate_student_aggregates
+from .handwriting import MLServiceError, analyze_batch, analyze_image, find_saved_sample, get_idempotency_key, hash_image, save_sample
 from rest_framework.decorators import action
 import requests
 import json
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.shortcuts import get_object_or_404
+from django.http import StreamingHttpResponse
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
 from datetime import datetime, timezone
 from django.utils import timezone as django_timezone
+from backend.pagination import parse_date_param, parse_positive_int, parse_progress_cursor
+from django.db import transaction
+from django.db.models import Avg, Count, Exists, OuterRef, Prefetch, Q
+from django.db.models.fields.json import KeyTransform
 
 class UserListCreateView(generics.ListCreateAPIView):
     queryset = User.objects.all()
@@ -100,6 +109,13 @@ class AccountDeleteView(APIView):
             "message": f"Account '{username}' has been permanently deleted."
         }, status=status.HTTP_200_OK)
 
+def first_item_errors(errors):
+    """Return the first failing item's errors from a many=True serializer"""
+    if isinstance(errors, dict):
+        return errors
+    return next(error for error in errors if error)
+
+
 class StudentViewSet(viewsets.ModelViewSet):
     queryset = Student.objects.all()
     serializer_class = StudentSerializer
@@ -112,10 +128,12 @@ class StudentViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         user = self.request.user
+        # StudentSerializer reads stage_progress and final_evaluation for every row
+        students = Student.objects.select_related('stage_progress', 'final_evaluation')
         if user.role == 'teacher':
-            return Student.objects.filter(teacher=user)
+            return students.filter(teacher=user)
         elif user.role in ['doctor', 'parent']:
-            return Student.objects.filter(student_links__user=user)
+            return students.filter(student_links__user=user)
         return Student.objects.none()
     
     @action(detail=True, methods=['get'], permission_classes=[permissions.IsAuthenticated])
@@ -221,35 +239,16 @@ class StudentViewSet(viewsets.ModelViewSet):
             return Response({"error": "Termination must be confirmed by setting 'confirm_termination' to true."}, status=400)
         
         try:
-            # Delete ALL therapy-related data to start completely fresh
-            
-            # 1. Delete handwriting samples (Stage 1) - start completely fresh
-            student.handwriting_samples.all().delete()
-            
-            # 2. Reset stage progress completely
-            progress.current_stage = 1
-            progress.completed_stages = []
-            progress.save()
-            
-            # 3. Clear tasks (Stage 2+)
-            student.tasks.all().delete()
-            
-            # 4. Clear assessment summary (Stage 3+)
-            if hasattr(student, 'assessment_summary'):
-                student.assessment_summary.delete()
-            
-            # 5. Clear activity assignments and progress (Stage 4+)
-            student.activity_assignments.all().delete()
-            
-            # 6. Clear final evaluation (Stage 6+)
-            if hasattr(student, 'final_evaluation'):
-                student.final_evaluation.delete()
-            
-            # 7. Clear therapy reports (Stage 7)
-            student.therapy_reports.all().delete()
-            
-            # 8. Clear stakeholder recommendations (Stage 7)
-            student.stakeholder_recommendations.all().delete()
+            # Delete ALL therapy-related data to start completely fresh, atomically
+            with transaction.atomic():
+                # Stages 1-7: samples, tasks, assessment, activities and progress,
+                # evaluation, therapy reports and stakeholder recommendations
+                student.clear_therapy_data()
+
+                # Reset stage progress completely
+                progress.current_stage = 1
+                progress.completed_stages = []
+                progress.save()
             
             return Response({
                 'status': 'progress terminated successfully',
@@ -280,16 +279,15 @@ class StudentViewSet(viewsets.ModelViewSet):
         if not tasks_data:
             return Response({"error": "No tasks provided."}, status=400)
 
-        created_tasks = []
-        for task in tasks_data:
-            serializer = StudentTaskSerializer(data=task)
-            if serializer.is_valid():
-                serializer.save(student=student)
-                created_tasks.append(serializer.data)
-            else:
-                return Response(serializer.errors, status=400)
+        # Validate every task first, then insert them all in one transaction
+        serializer = StudentTaskSerializer(data=tasks_data, many=True)
+        if not serializer.is_valid():
+            return Response(first_item_errors(serializer.errors), status=400)
 
-        return Response({"message": "Tasks added", "tasks": created_tasks}, status=201)
+        with transaction.atomic():
+            serializer.save(student=student)
+
+        return Response({"message": "Tasks added", "tasks": serializer.data}, status=201)
 
     @action(detail=True, methods=['get'], permission_classes=[permissions.IsAuthenticated])
     def get_tasks(self, request, pk=None):
@@ -320,35 +318,36 @@ class StudentViewSet(viewsets.ModelViewSet):
         student = self.get_object()
         
         # Only allow teachers who own the student
-        if request.user.role != 'teacher' or student.teacher != request.user:
+        if not get_student_access(request).is_teacher_of(student):
             return Response({"error": "Only the assigned teacher can save handwriting samples."}, status=403)
 
         image = request.FILES.get('image')
-        dyslexia_score = request.data.get('dyslexia_score')
-        interpretation = request.data.get('interpretation')
-        letter_counts = request.data.get('letter_counts')
+        if not image:
+            return Response({"error": "Missing required data: image"}, status=400)
 
-        if not all([image, dyslexia_score, interpretation, letter_counts]):
-            return Response({"error": "Missing required data: image, dyslexia_score, interpretation, or letter_counts"}, status=400)
+        # Idempotency: the same image and client key never create a second sample
+        image_data = image.read()
+        image_hash = hash_image(image_data)
+        idempotency_key = get_idempotency_key(request)
+
+        existing = find_saved_sample(student, image_hash, idempotency_key)
+        if existing:
+            return Response(HandwritingSampleSerializer(existing).data, status=status.HTTP_200_OK)
 
         try:
-            # Parse letter_counts if it's a string
-            if isinstance(letter_counts, str):
-                try:
-                    letter_counts = json.loads(letter_counts)
-                except json.JSONDecodeError:
-                    return Response({"error": "Invalid letter_counts format"}, status=400)
-            
-            # Save to database
-            sample = HandwritingSample.objects.create(
-                student=student,
-                image=image,
-                dyslexia_score=dyslexia_score,
-                interpretation=interpretation,
-                letter_counts=letter_counts,
+            # Reuse the cached Stage 1 preview instead of client-echoed scores
+            image_hash, result = analyze_image(student.pk, image.name, image_data, image.content_type)
+        except MLServiceError as e:
+            return Response({"error": "ML service error", "detail": e.detail}, status=e.status_code)
+        except requests.exceptions.RequestException as e:
+            return Response({"error": "ML service unreachable", "detail": str(e)}, status=500)
+
+        try:
+            sample, created = save_sample(student, image, image_hash, idempotency_key, result)
+            return Response(
+                HandwritingSampleSerializer(sample).data,
+                status=status.HTTP_201_CREATED if created else status.HTTP_200_OK
             )
-            
-            return Response(HandwritingSampleSerializer(sample).data, status=status.HTTP_201_CREATED)
         
         except Exception as e:
             return Response({"error": "Failed to save handwriting sample", "detail": str(e)}, status=500)
@@ -361,34 +360,43 @@ class StudentViewSet(viewsets.ModelViewSet):
         student = self.get_object()
 
         # Only allow teacher who owns the student
-        if request.user.role != 'teacher' or student.teacher != request.user:
+        if not get_student_access(request).is_teacher_of(student):
             return Response({"error": "Only the assigned teacher can score tasks."}, status=403)
 
         task_scores = request.data.get('task_scores', [])
         if not task_scores:
             return Response({"error": "No task scores provided."}, status=400)
 
+        scores_serializer = TaskScoreSerializer(data=task_scores, many=True)
+        if not scores_serializer.is_valid():
+            return Response(first_item_errors(scores_serializer.errors), status=400)
+        scores = scores_serializer.validated_data
+
+        # Load every referenced task at once and validate all scores before writing
+        tasks = student.tasks.in_bulk([item['task_id'] for item in scores])
+
         updated_tasks = []
-        for score_data in task_scores:
-            task_id = score_data.get('task_id')
-            score = score_data.get('score')
-            
-            try:
-                task = student.tasks.get(id=task_id)
-                
-                # Validate score is within max_score
-                if score < 0 or score > task.max_score:
-                    return Response({
-                        "error": f"Score {score} for task '{task.task_name}' must be between 0 and {task.max_score}"
-                    }, status=400)
-                
-                task.score_obtained = score
-                task.save()
-                updated_tasks.append(StudentTaskSerializer(task).data)
-                
-            except student.tasks.model.DoesNotExist:
+        for item in scores:
+            task_id = item['task_id']
+            score = item['score']
+
+            task = tasks.get(task_id)
+            if task is None:
                 return Response({"error": f"Task with id {task_id} not found for this student."}, status=404)
 
+            # Validate score is within max_score
+            if score < 0 or score > task.max_score:
+                return Response({
+                    "error": f"Score {score} for task '{task.task_name}' must be between 0 and {task.max_score}"
+                }, status=400)
+
+            task.score_obtained = score
+            updated_tasks.append(StudentTaskSerializer(task).data)
+
+        with transaction.atomic():
+            StudentTask.objects.bulk_update(tasks.values(), ['score_obtained'])
+        invalidate_student_aggregates(student.pk)
+
         return Response({"message": "Task scores updated", "tasks": updated_tasks}, status=200)
 
     @action(detail=True, methods=['get'], permission_classes=[permissions.IsAuthenticated])
@@ -417,7 +425,7 @@ class StudentViewSet(viewsets.ModelViewSet):
             return Response({"error": "Only doctors can create assessment summaries."}, status=403)
 
         # Check if doctor is linked to this student
-        if not StudentUserLink.objects.filter(student=student, user=request.user, role='doctor').exists():
+        if not get_student_access(request).is_linked(student, role='doctor'):
             return Response({"error": "You are not assigned to this student."}, status=403)
 
         # Get task scores from Stage 3
@@ -503,35 +511,35 @@ class StudentViewSet(viewsets.ModelViewSet):
         if request.user.role != 'doctor':
             return Response({"error": "Only doctors can assign activities."}, status=403)
 
+        # Check the doctor link and Stage 4 completion in a single query
+        checks = Student.objects.filter(pk=student.pk).annotate(
+            doctor_linked=Exists(StudentUserLink.objects.filter(student=OuterRef('pk'), user=request.user, role='doctor')),
+            has_assessment=Exists(AssessmentSummary.objects.filter(student=OuterRef('pk')))
+        ).values('doctor_linked', 'has_assessment').get()
+
         # Check if doctor is linked to this student
-        if not StudentUserLink.objects.filter(student=student, user=request.user, role='doctor').exists():
+        if not checks['doctor_linked']:
             return Response({"error": "You are not assigned to this student."}, status=403)
 
         # Check if Stage 4 is completed (assessment summary exists)
-        try:
-            assessment_summary = student.assessment_summary
-        except AssessmentSummary.DoesNotExist:
+        if not checks['has_assessment']:
             return Response({"error": "Stage 4 must be completed before assigning activities."}, status=400)
 
         activities_data = request.data.get('activities', [])
         if not activities_data:
             return Response({"error": "No activities provided."}, status=400)
 
-        created_activities = []
-        for activity_data in activities_data:
-            # Add student and doctor to the activity data
-            activity_data['student'] = student.pk
-            activity_data['doctor'] = request.user.pk
-            
-            serializer = ActivityAssignmentSerializer(data=activity_data)
-            if serializer.is_valid():
-                activity = serializer.save(student=student, doctor=request.user)
-                created_activities.append(ActivityAssignmentSerializer(activity).data)
-            else:
-                return Response({
-                    "error": f"Invalid activity data: {serializer.errors}"
-                }, status=400)
+        # Validate the whole plan first, then insert it in one transaction
+        serializer = ActivityAssignmentSerializer(data=activities_data, many=True)
+        if not serializer.is_valid():
+            return Response({
+                "error": f"Invalid activity data: {first_item_errors(serializer.errors)}"
+            }, status=400)
 
+        with transaction.atomic():
+            serializer.save(student=student, doctor=request.user)
+
+        created_activities = serializer.data
         return Response({
             "message": f"Successfully assigned {len(created_activities)} activities",
             "activities": created_activities
@@ -582,40 +590,52 @@ def get_student_activities_for_tracking(request, student_id):
 
     # Check if user has access to this student
     user_role = request.user.role
+    access = get_student_access(request)
     has_access = False
     
     if user_role == 'teacher':
-        has_access = student.teacher == request.user
+        has_access = access.is_teacher_of(student)
     elif user_role == 'parent':
-        has_access = StudentUserLink.objects.filter(student=student, user=request.user).exists()
+        has_access = access.is_linked(student)
     elif user_role == 'doctor':
         # Doctors can view activities they assigned to the student
-        has_access = ActivityAssignment.objects.filter(student=student, doctor=request.user).exists()
+        has_access = access.has_assigned(student)
     
     if not has_access:
         return Response({"error": "You don't have access to this student"}, status=403)
 
-    # Get active activities for this student
-    activities = student.activity_assignments.filter(is_active=True)
-    
-    # If user is a doctor, only show activities they assigned
-    if user_role == 'doctor':
-        activities = activities.filter(doctor=request.user)
-    
-    # Get progress records for each activity
-    activities_with_progress = []
-    for activity in activities:
-        progress_records = ActivityProgress.objects.filter(activity_assignment=activity)
-        activity_data = ActivityAssignmentSerializer(activity).data
-        activity_data['progress_records'] = ActivityProgressSerializer(progress_records, many=True).data
-        activity_data['total_sessions'] = progress_records.count()
-        activity_data['completed_sessions'] = progress_records.filter(status='completed').count()
-        activities_with_progress.append(activity_data)
+    def build_tracking():
+        # Get active activities for this student, with session counts computed in the DB
+        activities = student.activity_assignments.filter(is_active=True).annotate(
+            total_sessions=Count('progress_records'),
+            completed_sessions=Count('progress_records', filter=Q(progress_records__status='completed'))
+        )
+        
+        # If user is a doctor, only show activities they assigned
+        if user_role == 'doctor':
+            activities = activities.filter(doctor=request.user)
+        
+        # Load every activity's progress records in one extra query
+        activities = activities.prefetch_related(
+            Prefetch('progress_records', queryset=ActivityProgress.objects.all())
+        )
 
-    return Response({
-        "student": StudentSerializer(student).data,
-        "activities": activities_with_progress
-    })
+        activities_with_progress = []
+        for activity in activities:
+            activity_data = ActivityAssignmentSerializer(activity).data
+            activity_data['progress_records'] = ActivityProgressSerializer(activity.progress_records.all(), many=True).data
+            activity_data['total_sessions'] = activity.total_sessions
+            activity_data['completed_sessions'] = activity.completed_sessions
+            activities_with_progress.append(activity_data)
+
+        return {
+            "student": StudentSerializer(student).data,
+            "activities": activities_with_progress
+        }
+
+    # Doctors only see their own activities, so their payload is cached per doctor
+    variant = (user_role, request.user.id) if user_role == 'doctor' else (user_role,)
+    return Response(cached_student_aggregate(student.pk, 'activity_tracking', variant, build_tracking))
 
 
 @api_view(['POST'])
@@ -632,13 +652,14 @@ def record_activity_progress(request, student_id):
 
     # Check if user has access to this student
     user_role = request.user.role
+    access = get_student_access(request)
     has_access = False
     
     if user_role == 'teacher':
-        has_access = student.teacher == request.user
+        has_access = access.is_teacher_of(student)
         performer = 'teacher'
     elif user_role == 'parent':
-        has_access = StudentUserLink.objects.filter(student=student, user=request.user).exists()
+        has_access = access.is_linked(student)
         performer = 'parent'
     else:
         return Response({"error": "Only teachers and parents can record activity progress"}, status=403)
@@ -669,11 +690,21 @@ def record_activity_progress(request, student_id):
     return Response(serializer.errors, status=400)
 
 
+PROGRESS_HISTORY_PAGE_SIZE = 50
+PROGRESS_HISTORY_MAX_PAGE_SIZE = 200
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_activity_progress_history(request, student_id, activity_id):
     """
-    Get progress history for a specific activity
+    Get progress history for a specific activity, newest session first
+
+    Optional query parameters:
+    - date_from / date_to (YYYY-MM-DD) and status (comma separated) filter the sessions
+    - limit / before: keyset pagination on (session_date, id), 50 sessions per
+      page by default; pass the previous page's `next_before` as `before`
+    - summary=true returns aggregate statistics instead of the session rows
     """
     try:
         student = Student.objects.get(student_id=student_id)
@@ -683,23 +714,78 @@ def get_activity_progress_history(request, student_id, activity_id):
 
     # Check access permissions
     user_role = request.user.role
+    access = get_student_access(request)
     has_access = False
     
     if user_role == 'teacher':
-        has_access = student.teacher == request.user
+        has_access = access.is_teacher_of(student)
     elif user_role == 'parent':
-        has_access = StudentUserLink.objects.filter(student=student, user=request.user).exists()
+        has_access = access.is_linked(student)
     elif user_role == 'doctor':
-        has_access = activity.doctor == request.user
+        has_access = activity.doctor_id == request.user.id
     
     if not has_access:
         return Response({"error": "You don't have access to this activity"}, status=403)
 
-    progress_records = ActivityProgress.objects.filter(activity_assignment=activity)
+    try:
+        date_from = parse_date_param(request, 'date_from')
+        date_to = parse_date_param(request, 'date_to')
+        limit = parse_positive_int(request, 'limit', maximum=PROGRESS_HISTORY_MAX_PAGE_SIZE) or PROGRESS_HISTORY_PAGE_SIZE
+        before = request.query_params.get('before')
+        before = parse_progress_cursor(before) if before else None
+    except ValueError:
+        return Response({"error": "Invalid date_from, date_to, limit or before parameter"}, status=400)
+
+    statuses = [value for value in request.query_params.get('status', '').split(',') if value]
+    valid_statuses = dict(ActivityProgress.STATUS_CHOICES)
+    invalid_statuses = [value for value in statuses if value not in valid_statuses]
+    if invalid_statuses:
+        return Response({
+            "error": f"Invalid status: {', '.join(invalid_statuses)}",
+            "valid_statuses": list(valid_statuses)
+        }, status=400)
+
+    # Records loaded through the related manager reuse `activity` instead of querying it per row
+    progress_records = activity.progress_records.all()
+    if date_from:
+        progress_records = progress_records.filter(session_date__gte=date_from)
+    if date_to:
+        progress_records = progress_records.filter(session_date__lte=date_to)
+    if statuses:
+        progress_records = progress_records.filter(status__in=statuses)
+
+    if request.query_params.get('summary') == 'true':
+        summary = progress_records.aggregate(
+            total_sessions=Count('id'),
+            completed_sessions=Count('id', filter=Q(status='completed')),
+            average_score=Avg('score'),
+            average_engagement=Avg('student_engagement'),
+        )
+        total = summary['total_sessions']
+        summary['completion_rate'] = round(summary['completed_sessions'] / total * 100, 1) if total else None
+        return Response({
+            "activity": ActivityAssignmentSerializer(activity).data,
+            "summary": summary
+        })
+
+    progress_records = progress_records.order_by('-session_date', '-id')
+    if before:
+        before_date, before_id = before
+        progress_records = progress_records.filter(
+            Q(session_date__lt=before_date) | Q(session_date=before_date, id__lt=before_id)
+        )
+
+    progress_records = list(progress_records[:limit + 1])
+    next_before = None
+    if len(progress_records) > limit:
+        progress_records = progress_records[:limit]
+        last = progress_records[-1]
+        next_before = f"{last.session_date.isoformat()}:{last.id}"
     
     return Response({
         "activity": ActivityAssignmentSerializer(activity).data,
-        "progress_history": ActivityProgressSerializer(progress_records, many=True).data
+        "progress_history": ActivityProgressSerializer(progress_records, many=True).data,
+        "next_before": next_before
     })
 
 
@@ -764,36 +850,36 @@ class AnalyzeHandwritingView(APIView):
         try:
             # Read the file content safely
             image_data = image.read()
-            files = {'image': (image.name, image_data, image.content_type)}
-            
-            # Send the request to the FastAPI service
-            response = requests.post('http://localhost:8001/analyze-handwriting/', files=files)
+            idempotency_key = get_idempotency_key(request)
 
-            if response.status_code != 200:
-                return Response({"error": "ML service error", "detail": response.text}, status=response.status_code)
+            # Skip the ML call when this exact image was already analyzed or saved
+            if not temp_analysis:
+                existing = find_saved_sample(student, hash_image(image_data), idempotency_key)
+                if existing:
+                    return Response(HandwritingSampleSerializer(existing).data, status=status.HTTP_200_OK)
 
-            data = response.json()
+            image_hash, data = analyze_image(student.pk, image.name, image_data, image.content_type)
 
             # If temp_analysis is True, don't save to DB, just return the prediction
             if temp_analysis:
                 return Response({
-                    'dyslexia_score': data.get('dyslexia_score'),
-                    'interpretation': data.get('interpretation'),
-                    'letter_counts': data.get('letter_counts'),
+                    'dyslexia_score': data['dyslexia_score'],
+                    'interpretation': data['interpretation'],
+                    'letter_counts': data['letter_counts'],
+                    'image_hash': image_hash,
                     'temp_analysis': True
                 }, status=status.HTTP_200_OK)
 
             # Save to DB (original behavior)
-            sample = HandwritingSample.objects.create(
-                student=student,
-                image=image,
-                dyslexia_score=data.get('dyslexia_score'),
-                interpretation=data.get('interpretation'),
-                letter_counts=data.get('letter_counts'),
-            )
+            sample, created = save_sample(student, image, image_hash, idempotency_key, data)
 
-            return Response(HandwritingSampleSerializer(sample).data, status=status.HTTP_201_CREATED)
+            return Response(
+                HandwritingSampleSerializer(sample).data,
+                status=status.HTTP_201_CREATED if created else status.HTTP_200_OK
+            )
         
+        except MLServiceError as e:
+            return Response({"error": "ML service error", "detail": e.detail}, status=e.status_code)
         except requests.exceptions.RequestException as e:
             return Response({"error": "ML service unreachable", "detail": str(e)}, status=500)
 
@@ -950,60 +1036,33 @@ def get_comprehensive_student_data(request, student_id):
     """
     Get comprehensive data for Stage 7 final evaluation
     Only accessible by doctors
+    Optional ?fields=student,task_performance,... limits the sections returned
     """
     if request.user.role != 'doctor':
         return Response({"error": "Only doctors can access comprehensive evaluation data"}, status=403)
-    
-    try:
-        student = Student.objects.get(student_id=student_id)
-    except Student.DoesNotExist:
+
+    sections, invalid = parse_sections(request.query_params.get('fields'))
+    if invalid:
+        return Response({
+            "error": f"Unknown fields: {', '.join(invalid)}",
+            "valid_fields": list(COMPREHENSIVE_SECTIONS)
+        }, status=400)
+
+    # Access is checked on every request; only the payload is cached
+    doctor_has_access = get_doctor_access(student_id, request.user)
+    if doctor_has_access is None:
         return Response({"error": "Student not found"}, status=404)
 
     # Check if doctor has access to this student
-    if not ActivityAssignment.objects.filter(student=student, doctor=request.user).exists():
+    if not doctor_has_access:
         return Response({"error": "You don't have access to this student"}, status=403)
 
-    # Gather comprehensive data from all stages
-    data = {
-        'student': StudentSerializer(student).data,
-        'handwriting_analysis': [],
-        'task_performance': {},
-        'assessment_summary': {},
-        'activity_assignments': [],
-        'activity_progress': []
-    }
-
-    # Stage 1 & 2: Handwriting Analysis
-    handwriting_samples = student.handwriting_samples.all()
-    data['handwriting_analysis'] = HandwritingSampleSerializer(handwriting_samples, many=True).data
-
-    # Stage 3: Task Performance
-    tasks = student.tasks.all()
-    data['task_performance'] = {
-        'tasks': StudentTaskSerializer(tasks, many=True).data,
-        'total_tasks': tasks.count(),
-        'completed_tasks': tasks.filter(score_obtained__isnull=False).count()
-    }
-
-    # Stage 4: Assessment Summary
-    try:
-        assessment = student.assessment_summary
-        data['assessment_summary'] = AssessmentSummarySerializer(assessment).data
-    except AssessmentSummary.DoesNotExist:
-        data['assessment_summary'] = None
-
-    # Stage 5: Activity Assignments
-    activities = student.activity_assignments.filter(doctor=request.user)
-    data['activity_assignments'] = ActivityAssignmentSerializer(activities, many=True).data
-
-    # Stage 6: Activity Progress
-    progress_records = ActivityProgress.objects.filter(
-        activity_assignment__student=student,
-        activity_assignment__doctor=request.user
-    )
-    data['activity_progress'] = ActivityProgressSerializer(progress_records, many=True).data
+    # Gather comprehensive data from all requested stages
+    def build_data():
+        return build_comprehensive_data(get_comprehensive_student(student_id, request.user, sections), request.user, sections)
 
-    return Response(data)
+    variant = ('doctor', request.user.id, ','.join(sorted(sections)))
+    return Response(cached_student_aggregate(student_id, 'comprehensive', variant, build_data))
 
 
 @api_view(['GET', 'POST'])
@@ -1023,7 +1082,7 @@ def final_evaluation_view(request, student_id):
         return Response({"error": "Student not found"}, status=404)
 
     # Check if doctor has access to this student
-    if not ActivityAssignment.objects.filter(student=student, doctor=request.user).exists():
+    if not get_student_access(request).has_assigned(student):
         return Response({"error": "You don't have access to this student"}, status=403)
 
     if request.method == 'GET':
@@ -1098,22 +1157,47 @@ def get_evaluation_summary(request, student_id):
     """
     try:
         student = Student.objects.get(student_id=student_id)
-        evaluation = student.final_evaluation
     except Student.DoesNotExist:
         return Response({"error": "Student not found"}, status=404)
+
+    user_role = request.user.role
+
+    def build_summary():
+        evaluation = student.final_evaluation
+        summary = {
+            'doctor_id': evaluation.doctor_id,
+            'therapy_session_number': evaluation.therapy_session_number,
+        }
+        if user_role == 'doctor':
+            summary['data'] = FinalEvaluationSerializer(evaluation).data
+        else:
+            summary['data'] = {
+                'student_name': student.name,
+                'final_diagnosis': evaluation.final_diagnosis,
+                'intervention_priority': evaluation.intervention_priority,
+                'short_term_goals': evaluation.short_term_goals,
+                'long_term_goals': evaluation.long_term_goals,
+                'follow_up_timeline': evaluation.follow_up_timeline,
+                'case_completed': evaluation.case_completed,
+                'completion_date': evaluation.completion_date
+            }
+        return summary
+
+    try:
+        summary = cached_student_aggregate(student.pk, 'evaluation_summary', (user_role,), build_summary)
     except FinalEvaluation.DoesNotExist:
         return Response({"error": "Final evaluation not completed yet"}, status=404)
 
     # Check access permissions
-    user_role = request.user.role
+    access = get_student_access(request)
     has_access = False
     
     if user_role == 'teacher':
-        has_access = student.teacher == request.user
+        has_access = access.is_teacher_of(student)
     elif user_role == 'parent':
-        has_access = StudentUserLink.objects.filter(student=student, user=request.user).exists()
+        has_access = access.is_linked(student)
     elif user_role == 'doctor':
-        has_access = evaluation.doctor == request.user
+        has_access = summary['doctor_id'] == request.user.id
     
     if not has_access:
         return Response({"error": "You don't have access to this evaluation"}, status=403)
@@ -1121,27 +1205,18 @@ def get_evaluation_summary(request, student_id):
     # Return appropriate data based on user role
     if user_role == 'doctor':
         # Full access for doctor
-        return Response(FinalEvaluationSerializer(evaluation).data)
+        return Response(summary['data'])
     else:
         # Limited access for teachers and parents
-        summary_data = {
-            'student_name': student.name,
-            'final_diagnosis': evaluation.final_diagnosis,
-            'intervention_priority': evaluation.intervention_priority,
-            'short_term_goals': evaluation.short_term_goals,
-            'long_term_goals': evaluation.long_term_goals,
-            'follow_up_timeline': evaluation.follow_up_timeline,
-            'case_completed': evaluation.case_completed,
-            'completion_date': evaluation.completion_date
-        }
+        summary_data = dict(summary['data'])
         
-        # Get stakeholder recommendations for this user
+        # Get stakeholder recommendations for this user (not cached: they differ per user)
         try:
             # Get the most recent recommendation for the current therapy session
             user_recommendation = StakeholderRecommendation.objects.filter(
                 student__student_id=student_id,
                 stakeholder=request.user,
-                therapy_session_number=evaluation.therapy_session_number
+                therapy_session_number=summary['therapy_session_number']
             ).order_by('-submitted_at').first()
             
             if user_recommendation:
@@ -1154,6 +1229,15 @@ def get_evaluation_summary(request, student_id):
         return Response(summary_data)
 
 
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def student_aggregate_cache_stats(request):
+    """
+    Hit-rate metrics of the student aggregate cache (staff only)
+    """
+    return Response(aggregate_cache_stats())
+
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def terminate_therapy_session(request, student_id):
@@ -1169,7 +1253,7 @@ def terminate_therapy_session(request, student_id):
         evaluation = student.final_evaluation
         
         # Check if doctor has access to this student
-        if not StudentUserLink.objects.filter(student=student, user=request.user).exists():
+        if not get_student_access(request).is_linked(student):
             return Response({"error": "You don't have access to this student"}, status=403)
         
         # Get termination reason from request
@@ -1220,25 +1304,24 @@ def restart_therapy_from_stage5(request, student_id):
         evaluation = student.final_evaluation
         
         # Check if doctor has access to this student
-        if not StudentUserLink.objects.filter(student=student, user=request.user).exists():
+        if not get_student_access(request).is_linked(student):
             return Response({"error": "You don't have access to this student"}, status=403)
         
-        # Create therapy session report before restarting
-        from .models import TherapySessionReport
-        report = TherapySessionReport.create_report_from_current_data(student)
-        report.session_outcome = 'continued'
-        report.session_end_date = django_timezone.now()
-        report.save()
-        
-        # Clear current activity assignments and progress for new session
-        student.activity_assignments.all().delete()
-        ActivityProgress.objects.filter(activity_assignment__student=student).delete()
-        
-        # Increment therapy session number
-        evaluation.therapy_session_number += 1
-        
-        # Restart therapy from Stage 5
-        stage_progress = evaluation.restart_therapy_from_stage5()
+        with transaction.atomic():
+            # Create therapy session report before restarting
+            report = TherapySessionReport.create_report_from_current_data(student)
+            report.session_outcome = 'continued'
+            report.session_end_date = django_timezone.now()
+            report.save()
+            
+            # Clear current activity assignments and progress for new session
+            student.clear_activity_plan()
+            
+            # Increment therapy session number
+            evaluation.therapy_session_number += 1
+            
+            # Restart therapy from Stage 5
+            stage_progress = evaluation.restart_therapy_from_stage5()
         
         return Response({
             "message": "Therapy session restarted successfully",
@@ -1258,31 +1341,75 @@ def restart_therapy_from_stage5(request, student_id):
         return Response({"error": f"Internal error: {str(e)}"}, status=500)
 
 
+THERAPY_REPORTS_MAX_PAGE_SIZE = 100
+
+# Columns needed by every therapy report listing; the JSON snapshots are only loaded for doctors
+THERAPY_REPORT_LISTING_FIELDS = ('student', 'session_number', 'session_start_date', 'session_end_date', 'session_outcome', 'created_at')
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_therapy_session_reports(request, student_id):
     """
     Get all therapy session reports for a student
     Accessible by teachers, parents, and doctors with appropriate access
+
+    Optional keyset pagination: ?limit=N returns the N most recent sessions,
+    and ?before=<session_number> continues from `next_before` of the previous page.
     """
     try:
         student = Student.objects.get(student_id=student_id)
         
         # Check access permissions
         user_role = request.user.role
+        access = get_student_access(request)
         has_access = False
         
         if user_role == 'teacher':
-            has_access = student.teacher == request.user
+            has_access = access.is_teacher_of(student)
         elif user_role in ['parent', 'doctor']:
-            has_access = StudentUserLink.objects.filter(student=student, user=request.user).exists()
+            has_access = access.is_linked(student)
         
         if not has_access:
             return Response({"error": "You don't have access to this student's reports"}, status=403)
+
+        try:
+            limit = parse_positive_int(request, 'limit', maximum=THERAPY_REPORTS_MAX_PAGE_SIZE)
+            before = parse_positive_int(request, 'before')
+        except ValueError:
+            return Response({"error": "limit and before must be positive integers"}, status=400)
         
-        # Get all therapy session reports
-        from .models import TherapySessionReport
         reports = TherapySessionReport.objects.filter(student=student).order_by('-session_number')
+        total_sessions = reports.count() if limit or before else None
+        if before:
+            reports = reports.filter(session_number__lt=before)
+
+        if user_role == 'doctor':
+            reports = reports.only(
+                *THERAPY_REPORT_LISTING_FIELDS,
+                'activity_assignments_data', 'activity_progress_data', 'final_evaluation_data'
+            )
+        else:
+            # Teachers and parents only see counts and a few evaluation keys:
+            # read them from the snapshot envelopes, never the snapshot blobs
+            summary = KeyTransform('summary', 'final_evaluation_data')
+            reports = reports.only(*THERAPY_REPORT_LISTING_FIELDS).annotate(
+                total_activities=KeyTransform('items', 'activity_assignments_data'),
+                progress_records=KeyTransform('items', 'activity_progress_data'),
+                evaluation_items=KeyTransform('items', 'final_evaluation_data'),
+                diagnosis=KeyTransform('final_diagnosis', summary),
+                intervention_priority=KeyTransform('intervention_priority', summary),
+                recommendations=KeyTransform(f'{user_role}_recommendations', summary),
+            )
+
+        reports = list(reports[:limit + 1] if limit else reports)
+        next_before = None
+        if limit and len(reports) > limit:
+            reports = reports[:limit]
+            next_before = reports[-1].session_number
+        
+        # Doctors see full snapshots: rebuild them all with a single blob query
+        snapshots = TherapySessionReport.expand_snapshots(reports) if user_role == 'doctor' else {}
         
         reports_data = []
         for report in reports:
@@ -1297,33 +1424,30 @@ def get_therapy_session_reports(request, student_id):
             # Add appropriate data based on user role
             if user_role == 'doctor':
                 # Full access for doctors
+                assignments, progress, evaluation = snapshots[report.pk]
                 report_data.update({
-                    'activity_assignments_data': report.activity_assignments_data,
-                    'activity_progress_data': report.activity_progress_data,
-                    'final_evaluation_data': report.final_evaluation_data,
+                    'activity_assignments_data': assignments,
+                    'activity_progress_data': progress,
+                    'final_evaluation_data': evaluation,
                 })
             else:
                 # Limited access for teachers and parents
-                if report.final_evaluation_data:
-                    eval_data = report.final_evaluation_data
-                    report_data['diagnosis'] = eval_data.get('final_diagnosis', 'Not available')
-                    report_data['intervention_priority'] = eval_data.get('intervention_priority', 'Not available')
-                    
-                    if user_role == 'teacher':
-                        report_data['recommendations'] = eval_data.get('teacher_recommendations', 'Not available')
-                    elif user_role == 'parent':
-                        report_data['recommendations'] = eval_data.get('parent_recommendations', 'Not available')
+                if report.evaluation_items:
+                    for key in ('diagnosis', 'intervention_priority', 'recommendations'):
+                        value = getattr(report, key)
+                        report_data[key] = 'Not available' if value is None else value
                 
                 # Summary of activities and progress
-                report_data['total_activities'] = len(report.activity_assignments_data)
-                report_data['progress_records'] = len(report.activity_progress_data)
+                report_data['total_activities'] = report.total_activities
+                report_data['progress_records'] = report.progress_records
             
             reports_data.append(report_data)
         
         return Response({
             'student_name': student.name,
-            'total_sessions': len(reports_data),
-            'reports': reports_data
+            'total_sessions': len(reports_data) if total_sessions is None else total_sessions,
+            'reports': reports_data,
+            'next_before': next_before,
         })
         
     except Student.DoesNotExist:
@@ -1344,12 +1468,13 @@ def get_detailed_therapy_report(request, student_id, session_number):
         
         # Check access permissions
         user_role = request.user.role
+        access = get_student_access(request)
         has_access = False
         
         if user_role == 'teacher':
-            has_access = student.teacher == request.user
+            has_access = access.is_teacher_of(student)
         elif user_role in ['parent', 'doctor']:
-            has_access = StudentUserLink.objects.filter(student=student, user=request.user).exists()
+            has_access = access.is_linked(student)
         
         if not has_access:
             return Response({"error": "You don't have access to this student's reports"}, status=403)
@@ -1357,6 +1482,7 @@ def get_detailed_therapy_report(request, student_id, session_number):
         # Get specific therapy session report
         from .models import TherapySessionReport
         report = TherapySessionReport.objects.get(student=student, session_number=session_number)
+        activity_assignments, activity_progress, final_evaluation = report.get_snapshot()
         
         response_data = {
             'student_name': student.name,
@@ -1371,14 +1497,14 @@ def get_detailed_therapy_report(request, student_id, session_number):
         if user_role == 'doctor':
             # Full access for doctors
             response_data.update({
-                'activity_assignments': report.activity_assignments_data,
-                'activity_progress': report.activity_progress_data,
-                'final_evaluation': report.final_evaluation_data,
+                'activity_assignments': activity_assignments,
+                'activity_progress': activity_progress,
+                'final_evaluation': final_evaluation,
             })
         else:
             # Filtered access for teachers and parents
-            if report.final_evaluation_data:
-                eval_data = report.final_evaluation_data
+            if final_evaluation:
+                eval_data = final_evaluation
                 response_data['evaluation_summary'] = {
                     'diagnosis': eval_data.get('final_diagnosis'),
                     'intervention_priority': eval_data.get('intervention_priority'),
@@ -1394,9 +1520,9 @@ def get_detailed_therapy_report(request, student_id, session_number):
             
             # Summary of activities
             response_data['activities_summary'] = {
-                'total_activities': len(report.activity_assignments_data),
-                'activity_types': list(set([activity.get('activity_type', 'Unknown') for activity in report.activity_assignments_data])),
-                'progress_records': len(report.activity_progress_data),
+                'total_activities': len(activity_assignments),
+                'activity_types': list(set([activity.get('activity_type', 'Unknown') for activity in activity_assignments])),
+                'progress_records': len(activity_progress),
             }
         
         return Response(response_data)
@@ -1421,12 +1547,13 @@ def stakeholder_recommendations_view(request, student_id):
         
         # Check access permissions
         user_role = request.user.role
+        access = get_student_access(request)
         has_access = False
         
         if user_role == 'teacher':
-            has_access = student.teacher == request.user
+            has_access = access.is_teacher_of(student)
         elif user_role == 'parent':
-            has_access = StudentUserLink.objects.filter(student=student, user=request.user).exists()
+            has_access = access.is_linked(student)
         
         if not has_access:
             return Response({"error": "You don't have access to this student"}, status=403)
@@ -1491,7 +1618,7 @@ def get_all_stakeholder_recommendations(request, student_id):
         student = Student.objects.get(student_id=student_id)
         
         # Check if doctor has access to this student
-        if not StudentUserLink.objects.filter(student=student, user=request.user).exists():
+        if not get_student_access(request).is_linked(student):
             return Response({"error": "You don't have access to this student"}, status=403)
         
         # Get current therapy session number
@@ -1524,6 +1651,13 @@ def get_all_stakeholder_recommendations(request, student_id):
 
 # ============== CLASSROOM MANAGEMENT VIEWS ==============
 
+def with_classroom_listing_data(students):
+    """Eager-load everything StudentClassroomSerializer reads for each row"""
+    return students.select_related('classroom', 'stage_progress').prefetch_related(
+        Prefetch('student_links', queryset=StudentUserLink.objects.select_related('user'))
+    )
+
+
 class ClassroomListCreateView(generics.ListCreateAPIView):
     """
     List all classrooms for the authenticated teacher and create new classrooms
@@ -1586,14 +1720,14 @@ class ClassroomStudentsView(APIView):
     def get(self, request, classroom_id):
         """Get all students in a specific classroom"""
         try:
-            classroom = Classroom.objects.get(id=classroom_id, teacher=request.user)
-            students = Student.objects.filter(classroom=classroom)
+            classroom = Classroom.objects.select_related('teacher').get(id=classroom_id, teacher=request.user)
+            students = with_classroom_listing_data(Student.objects.filter(classroom=classroom))
             serializer = StudentClassroomSerializer(students, many=True)
             
             return Response({
                 'classroom': ClassroomSerializer(classroom).data,
                 'students': serializer.data,
-                'total_students': students.count()
+                'total_students': len(serializer.data)
             })
             
         except Classroom.DoesNotExist:
@@ -1642,6 +1776,40 @@ class ClassroomStudentsView(APIView):
             return Response({"error": "Classroom not found"}, status=status.HTTP_404_NOT_FOUND)
 
 
+class ClassroomHandwritingBatchView(APIView):
+    """
+    Analyze handwriting for a whole classroom in a single upload
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, classroom_id):
+        """
+        Accept one `image_<student_id>` file per student and stream
+        newline-delimited JSON progress events while the ML service works.
+        The events come from an async iterator, so under ASGI each one is sent
+        as soon as it is ready.
+        """
+        try:
+            classroom = Classroom.objects.get(id=classroom_id, teacher=request.user)
+        except Classroom.DoesNotExist:
+            return Response({"error": "Classroom not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        images = {}
+        for field, image in request.FILES.items():
+            if field.startswith('image_') and field[len('image_'):].isdigit():
+                images[int(field[len('image_'):])] = image
+
+        if not images:
+            return Response({"error": "No images provided. Upload one 'image_<student_id>' file per student."}, status=status.HTTP_400_BAD_REQUEST)
+
+        students = Student.objects.filter(classroom=classroom, student_id__in=images.keys()).in_bulk()
+        jobs = [(students[student_id], image) for student_id, image in images.items() if student_id in students]
+        unknown_ids = [student_id for student_id in images if student_id not in students]
+
+        events = (json.dumps(event, default=str) + '\n' async for event in analyze_batch(jobs, unknown_ids))
+        return StreamingHttpResponse(events, content_type='application/x-ndjson')
+
+
 class ClassroomStudentRemoveView(APIView):
     """
     Remove a student from a classroom
@@ -1680,14 +1848,14 @@ class UnassignedStudentsView(APIView):
     
     def get(self, request):
         """Get all unassigned students for the current teacher"""
-        students = Student.objects.filter(
+        students = with_classroom_listing_data(Student.objects.filter(
             teacher=request.user,
             classroom__isnull=True
-        )
+        ))
         
         serializer = StudentClassroomSerializer(students, many=True)
         
         return Response({
             'students': serializer.data,
-            'total_students': students.count()
+            'total_students': len(serializer.data)
         })